@@ -1,24 +1,77 @@
-from flask import Flask, render_template, request, jsonify, flash, redirect, url_for
+from flask import Flask, render_template, stream_template, request, jsonify, flash, redirect, url_for, g, Response
 import os
+import re
 import json
 from datetime import datetime
 from integrated_blog_tool import IntegratedBlogTool
-from perplexity_client import PerplexityClient
+from perplexity_client import PerplexityClient, load_environment
+from image_prefetch import MAX_WORKERS as MAX_PREFETCH_WORKERS, collect_ranked_titles, prefetch_images
+from usage_ledger import CALL_SITES, get_ledger, job_scope
+from llm_hedging import get_hedger
+from tracing import get_trace, recent_traces, start_trace
+from metrics import PAGE_RENDER_LATENCY, REGISTRY
+from state_store import StateStore
+from blob_store import content_hash
+from history_log import PREVIEW_LENGTH, get_history_log, history_key, parse_history_key, legacy_kind
+from article_pages import PagedText
+from prompt_compiler import PLACEHOLDERS, TemplateError, compile_template, load_template
+from jobs import JobManager, JobQueueFull
+from deadlines import deadline_scope, job_deadline_seconds
 import threading
 import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# .envファイルから環境変数を読み込み（使用量台帳の設定などを画面表示時にも反映する）
+load_environment()
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
-
-# グローバル変数で生成状態を管理
-generation_status = {
-    'is_generating': False,
-    'progress': 0,
-    'current_step': '',
-    'result': None,
-    'error': None
+# 複数ワーカーで動かす場合は FLASK_SECRET_KEY を設定する（ワーカーごとに鍵が違うと flash が消える）
+app.secret_key = os.getenv('FLASK_SECRET_KEY') or os.urandom(24)
+
+# 画面の状態の初期値（状態は StateStore に保存し、全ワーカーで共有する）
+STATE_DEFAULTS = {
+    # 記事生成の状態
+    'generation': {
+        'is_generating': False,
+        'progress': 0,
+        'current_step': '',
+        'result': None,
+        'error': None,
+        'tokens_used': 0,
+        'trace_id': None,
+        'timings': None,
+        'cancel_requested': False,
+        'deadline_seconds': None
+    },
+    # 画像キャッシュ事前取得の状態
+    'prefetch': {
+        'is_running': False,
+        'done': 0,
+        'total': 0,
+        'report': None,
+        'error': None
+    }
 }
 
+def create_app(config=None):
+    """
+    アプリケーションを構成して返す（wsgi.py・開発用サーバーの共通の入口）
+
+    Args:
+        config (dict): Flask の設定（STATE_DB: 状態を保存するSQLiteファイル など）
+    """
+    if config:
+        app.config.update(config)
+    app.extensions['state_store'] = StateStore(app.config.get('STATE_DB'), defaults=STATE_DEFAULTS)
+    return app
+
+def state_store():
+    """全ワーカーで共有する状態の保存先"""
+    if 'state_store' not in app.extensions:
+        create_app()
+    return app.extensions['state_store']
+
 def load_prompt_templates():
     """ローカルファイルからプロンプトテンプレートを動的に読み込み"""
     templates = {}
@@ -55,59 +108,61 @@ def load_prompt_templates():
                 lines = content.split('\n')
                 description = lines[0][:50] + '...' if len(lines[0]) > 50 else lines[0]
                 
+                # 変数を確認（解析結果はファイルが変わるまで使い回す）
+                try:
+                    variables, error = load_template(filename).variables, None
+                except TemplateError as e:
+                    variables, error = (), str(e)
+                
                 templates[template_name] = {
                     'name': display_name,
                     'file': filename,
                     'description': description,
                     'content': content,
-                    'size': len(content)
+                    'size': len(content),
+                    'variables': variables,
+                    'error': error
                 }
             except Exception as e:
                 print(f"テンプレートファイル {filename} の読み込みエラー: {e}")
     
     return templates
 
-# 利用可能なプロンプトテンプレート
-PROMPT_TEMPLATES = load_prompt_templates()
-
 @app.route('/')
 def index():
     """メインページ"""
-    global PROMPT_TEMPLATES
-    PROMPT_TEMPLATES = load_prompt_templates()  # 最新の状態を読み込み
-    return render_template('index.html', prompt_templates=PROMPT_TEMPLATES)
+    return render_template('index.html', prompt_templates=load_prompt_templates())
 
 @app.route('/generate', methods=['POST'])
 def generate_article():
     """記事生成API"""
-    global generation_status
-    
-    if generation_status['is_generating']:
-        return jsonify({'error': '既に記事生成中です。完了までお待ちください。'})
-    
     try:
         data = request.get_json()
         theme = data.get('theme', '').strip()
         prompt_type = data.get('prompt_type', 'default')
         status = data.get('status', 'draft')
         max_tokens = int(data.get('max_tokens', 4096))
+        # ジョブの期限（秒、省略時は BLOG_TOOL_JOB_DEADLINE）
+        deadline_seconds = float(data.get('deadline_seconds') or job_deadline_seconds())
+        # テーマ以外のテンプレート変数（ランキングの件数・想定読者など）
+        variables = {name: value for name, value in (data.get('variables') or {}).items() if value not in (None, '')}
         
         if not theme:
             return jsonify({'error': 'テーマを入力してください。'})
         
-        # 生成状態をリセット
-        generation_status.update({
-            'is_generating': True,
-            'progress': 0,
-            'current_step': '初期化中...',
-            'result': None,
-            'error': None
-        })
+        template = load_prompt_templates().get(prompt_type)
+        if template and template['error']:
+            return jsonify({'error': template['error']})
+        
+        # 生成状態をリセット（他のワーカーで生成中なら開始しない）
+        if not state_store().try_begin('generation', 'is_generating', current_step='初期化中...',
+                                       deadline_seconds=deadline_seconds or None):
+            return jsonify({'error': '既に記事生成中です。完了までお待ちください。'})
         
         # バックグラウンドで記事生成を実行
         thread = threading.Thread(
             target=generate_article_background,
-            args=(theme, prompt_type, status, max_tokens)
+            args=(theme, prompt_type, status, max_tokens, variables, deadline_seconds)
         )
         thread.daemon = True
         thread.start()
@@ -115,42 +170,50 @@ def generate_article():
         return jsonify({'message': '記事生成を開始しました。'})
         
     except Exception as e:
-        generation_status['error'] = str(e)
-        generation_status['is_generating'] = False
+        state_store().update('generation', error=str(e), is_generating=False)
         return jsonify({'error': f'エラーが発生しました: {str(e)}'})
 
-def generate_article_background(theme, prompt_type, status, max_tokens):
-    """バックグラウンドで記事生成を実行"""
-    global generation_status
+def generate_article_background(theme, prompt_type, status, max_tokens, variables=None, deadline_seconds=None):
+    """
+    バックグラウンドで記事生成を実行
+    
+    各処理は deadline_seconds 秒の期限の残り時間内で行う。/generate/cancel で取り消された場合
+    （どのワーカーで受け付けても StateStore の cancel_requested で伝わる）は投稿せずに終わる。
+    """
+    store = state_store()
     
     try:
-        # プロンプトテンプレートファイルを取得
-        prompt_template_file = PROMPT_TEMPLATES[prompt_type]['file']
+        # プロンプトテンプレートファイルを取得（他のワーカーで追加されたテンプレートも含めて読み込む）
+        prompt_template_file = load_prompt_templates()[prompt_type]['file']
         
-        generation_status['current_step'] = 'Perplexity APIに接続中...'
-        generation_status['progress'] = 10
+        store.update('generation', current_step='Perplexity APIに接続中...', progress=10)
         
         # ツールを初期化
         tool = IntegratedBlogTool()
         
-        generation_status['current_step'] = '記事を生成中...'
-        generation_status['progress'] = 30
+        store.update('generation', current_step='記事を生成中...', progress=30)
         
-        # 記事を生成
-        result = tool.generate_and_post_article(
-            theme=theme,
-            status=status,
-            prompt_template_file=prompt_template_file,
-            max_tokens=max_tokens
-        )
+        # 記事を生成（トークン使用量はジョブ単位で集計）
+        job_id = f"article-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        with job_scope(job_id, template=prompt_template_file), \
+                start_trace('article.job', job_id=job_id, theme=theme, template=prompt_template_file) as trace, \
+                deadline_scope(deadline_seconds, cancel_check=lambda: store.get('generation').get('cancel_requested')) \
+                as deadline:
+            store.update('generation', trace_id=trace.trace_id)
+            result = tool.generate_and_post_article(
+                theme=theme,
+                status=status,
+                prompt_template_file=prompt_template_file,
+                max_tokens=max_tokens,
+                variables=variables
+            )
+        store.update('generation', tokens_used=get_ledger().job_total(job_id), timings=trace.summary())
         
         # アニメランキング記事の場合、画像添付の進捗を更新
         if 'ランキング' in theme or 'ランキング' in prompt_template_file:
-            generation_status['progress'] = 70
-            generation_status['current_step'] = 'アニメ画像を検索・添付中...'
+            store.update('generation', progress=70, current_step='アニメ画像を検索・添付中...')
         
-        generation_status['progress'] = 90
-        generation_status['current_step'] = '完了処理中...'
+        store.update('generation', progress=90, current_step='完了処理中...')
         
         if result:
             # 生成履歴を保存
@@ -159,31 +222,199 @@ def generate_article_background(theme, prompt_type, status, max_tokens):
                 'prompt_type': prompt_type,
                 'status': status,
                 'max_tokens': max_tokens,
+                'variables': variables or {},
                 'result': result,
                 'created_at': datetime.now().isoformat(),
                 'source': 'article_generation'
             }
             
-            history_filename = f"article_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-            with open(history_filename, 'w', encoding='utf-8') as f:
-                json.dump(article_history, f, ensure_ascii=False, indent=2)
+            get_history_log().append('article', article_history)
             
-            generation_status['result'] = result
-            generation_status['progress'] = 100
-            generation_status['current_step'] = '完了！'
+            store.update('generation', result=result, progress=100, current_step='完了！')
+        elif deadline.cancelled:
+            store.update('generation', error='記事の生成を取り消しました（投稿はしていません）。')
+        elif deadline.remaining() == 0:
+            store.update('generation', error='記事の生成が期限内に終わりませんでした（投稿はしていません）。')
         else:
-            generation_status['error'] = '記事の生成に失敗しました。'
+            store.update('generation', error='記事の生成に失敗しました。')
             
     except Exception as e:
-        generation_status['error'] = f'エラーが発生しました: {str(e)}'
+        store.update('generation', error=f'エラーが発生しました: {str(e)}')
         print(f"記事生成エラー: {e}")
     finally:
-        generation_status['is_generating'] = False
+        store.update('generation', is_generating=False)
 
 @app.route('/status')
 def get_status():
     """生成状態を取得"""
-    return jsonify(generation_status)
+    return jsonify(state_store().get('generation'))
+
+@app.route('/generate/cancel', methods=['POST'])
+def cancel_generation():
+    """実行中の記事生成を取り消す（実行中の処理の区切りで止まり、投稿はしない）"""
+    store = state_store()
+    if not store.get('generation').get('is_generating'):
+        return jsonify({'error': '実行中の記事生成はありません。'}), 409
+    store.update('generation', cancel_requested=True, current_step='取り消し中...')
+    return jsonify({'message': '記事生成の取り消しを受け付けました。'})
+
+@app.route('/images/prefetch', methods=['POST'])
+def start_image_prefetch():
+    """画像キャッシュの事前取得をバックグラウンドで開始"""
+    data = request.get_json(silent=True) or {}
+    workers = data.get('workers', 4)
+    if isinstance(workers, bool) or not isinstance(workers, int):
+        return jsonify({'error': 'workers は整数で指定してください。'}), 400
+    workers = max(1, min(workers, MAX_PREFETCH_WORKERS))
+    try:
+        titles = [t for t in data.get('titles', []) if isinstance(t, str) and t.strip()]
+        if data.get('scan') or not titles:
+            titles.extend(title for _, _, title in collect_ranked_titles())
+        
+        if not titles:
+            return jsonify({'error': '事前取得する作品名がありません。'})
+        
+        if not state_store().try_begin('prefetch', 'is_running'):
+            return jsonify({'error': '既に画像の事前取得を実行中です。'})
+        
+        thread = threading.Thread(target=prefetch_images_background, args=(titles, workers))
+        thread.daemon = True
+        thread.start()
+        
+        return jsonify({'message': '画像の事前取得を開始しました。'})
+    except Exception as e:
+        state_store().update('prefetch', is_running=False)
+        return jsonify({'error': f'エラーが発生しました: {str(e)}'})
+
+def prefetch_images_background(titles, workers):
+    """バックグラウンドで画像キャッシュを温める"""
+    store = state_store()
+    
+    def on_progress(done, total, title, ok):
+        store.update('prefetch', done=done, total=total)
+    
+    try:
+        tool = IntegratedBlogTool()
+        report = prefetch_images(tool, titles, workers=workers, progress=on_progress)
+        report['strategies'] = tool.image_resolver.stats()
+        store.update('prefetch', report=report)
+    except Exception as e:
+        store.update('prefetch', error=f'エラーが発生しました: {str(e)}')
+        print(f"画像事前取得エラー: {e}")
+    finally:
+        store.update('prefetch', is_running=False)
+
+@app.route('/images/prefetch/status')
+def get_prefetch_status():
+    """画像キャッシュ事前取得の状態を取得"""
+    return jsonify(state_store().get('prefetch'))
+
+# ジョブの状態を保持する時間（秒）
+JOB_RETENTION_SECONDS = 3600
+
+def _save_job(job):
+    """ジョブの状態を保存し、どのワーカーからも /jobs/<ID> で参照できるようにする"""
+    state_store().reset(f"job:{job.job_id}", **job.to_dict())
+
+def _cancel_key(job_id):
+    """他のワーカーからの取り消しを記録する名前（_save_job が上書きしないよう、ジョブの状態とは別に持つ）"""
+    return f"jobcancel:{job_id}"
+
+def _submit_llm_job(kind, params):
+    """ジョブを登録し、状態の確認先を返す"""
+    try:
+        job = llm_jobs.submit(kind, params)
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 429
+    state_store().prune('job:', JOB_RETENTION_SECONDS)
+    state_store().prune('jobcancel:', JOB_RETENTION_SECONDS)
+    return jsonify({'job_id': job.job_id, 'status_url': url_for('get_job', job_id=job.job_id)}), 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """ジョブの状態を取得（status: queued/running/succeeded/failed/cancelled、完了後は result または error）"""
+    store = state_store()
+    job = store.get(f"job:{job_id}")
+    if not job:
+        return jsonify({'error': 'ジョブが見つかりません。'}), 404
+    if not job.get('cancel_requested') and store.get(_cancel_key(job_id)).get('requested'):
+        job['cancel_requested'] = True
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """ジョブを取り消す（他のワーカーで実行中のジョブには StateStore の jobcancel:<ID> で伝える）"""
+    job = llm_jobs.cancel(job_id)
+    if job:
+        return jsonify(job.to_dict())
+    store = state_store()
+    job = store.get(f"job:{job_id}")
+    if not job:
+        return jsonify({'error': 'ジョブが見つかりません。'}), 404
+    if job.get('status') in ('queued', 'running'):
+        store.update(_cancel_key(job_id), requested=True)
+        job['cancel_requested'] = True
+    return jsonify(job)
+
+def _job_cancel_requested(job):
+    """他のワーカーで受け付けた取り消し"""
+    return bool(state_store().get(_cancel_key(job.job_id)).get('requested'))
+
+@app.route('/usage')
+def usage_dashboard():
+    """トークン使用量ダッシュボード"""
+    days = request.args.get('days', 30, type=int)
+    summary = get_ledger().summary(days=days or None)
+    return render_template('usage.html', summary=summary, days=days, call_sites=CALL_SITES,
+                           hedging=get_hedger().snapshot())
+
+@app.route('/usage.json')
+def usage_json():
+    """トークン使用量の集計（JSON）"""
+    days = request.args.get('days', 30, type=int)
+    return jsonify(dict(get_ledger().summary(days=days or None), hedging=get_hedger().snapshot()))
+
+@app.route('/traces')
+def list_traces():
+    """直近のジョブのトレース一覧（JSON）"""
+    return jsonify([
+        {
+            'trace_id': trace.trace_id,
+            'name': trace.name,
+            'attributes': trace.attributes,
+            'created_at': datetime.fromtimestamp(trace.created_at).isoformat(),
+            'spans': len(trace.spans),
+            'summary': trace.summary()
+        }
+        for trace in recent_traces()
+    ])
+
+@app.route('/traces/<trace_id>')
+def get_trace_detail(trace_id):
+    """トレースの詳細（format=chrome で Chrome Trace Event Format）"""
+    trace = get_trace(trace_id)
+    if not trace:
+        return jsonify({'error': 'トレースが見つかりません。'}), 404
+    if request.args.get('format') == 'chrome':
+        return jsonify(trace.to_chrome_trace())
+    return jsonify(trace.to_dict())
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_render_time(response):
+    """画面ごとの描画時間を記録"""
+    started = g.pop('request_started', None)
+    if started is not None and request.endpoint not in (None, 'static', 'metrics'):
+        PAGE_RENDER_LATENCY.observe(time.perf_counter() - started, page=request.endpoint)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus形式のメトリクス"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/test-connections')
 def test_connections():
@@ -204,20 +435,34 @@ def history():
 def view_article(filename):
     """記事ファイルを表示"""
     try:
-        file_path = os.path.join('.', filename)
-        if not os.path.exists(file_path):
-            flash('ファイルが見つかりません。', 'error')
-            return redirect(url_for('history'))
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        entry_id = parse_history_key(filename)
+        if entry_id is not None:
+            # 記事の生成履歴（履歴ログ）
+            history_data = _load_history_entry(entry_id)
+            if history_data is None or history_data['type'] != 'article':
+                flash('履歴が見つかりません。', 'error')
+                return redirect(url_for('history'))
+            body = history_data['content']
+            theme = history_data.get('theme', '')
+            generated_at = history_data['created_at']
+        else:
+            file_path = os.path.join('.', filename)
+            if not os.path.exists(file_path):
+                flash('ファイルが見つかりません。', 'error')
+                return redirect(url_for('history'))
+            
+            body = PagedText.from_file(file_path)
+            theme = filename.replace('blog_article_', '').replace('.txt', '')
+            generated_at = datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%Y-%m-%d %H:%M:%S')
         
-        generated_at = datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%Y-%m-%d %H:%M:%S')
-        return render_template('view_article.html', 
-                             filename=filename, 
-                             content=content,
-                             theme=filename.replace('blog_article_', '').replace('.txt', ''),
-                             generated_at=generated_at)
+        # 本文は1ページ分を少しずつ読みながら送る（記事が大きくても全体は読み込まない）
+        page = body.clamp(request.args.get('page', 1, type=int))
+        return Response(stream_template('view_article.html', 
+                                        filename=filename, 
+                                        content=body.iter_page(page),
+                                        article_page={'page': page, 'pages': body.pages},
+                                        theme=theme,
+                                        generated_at=generated_at))
     except Exception as e:
         flash(f'ファイルの読み込みでエラーが発生しました: {str(e)}', 'error')
         return redirect(url_for('history'))
@@ -241,23 +486,84 @@ def delete_article(filename):
 @app.route('/prompts')
 def prompts():
     """プロンプトテンプレート管理ページ"""
-    global PROMPT_TEMPLATES
-    PROMPT_TEMPLATES = load_prompt_templates()  # 最新の状態を読み込み
-    return render_template('prompts.html', prompt_templates=PROMPT_TEMPLATES)
+    return render_template('prompts.html', prompt_templates=load_prompt_templates())
 
 @app.route('/prompts/view/<template_name>')
 def view_prompt(template_name):
     """プロンプトテンプレートの詳細表示"""
-    global PROMPT_TEMPLATES
-    PROMPT_TEMPLATES = load_prompt_templates()
+    prompt_templates = load_prompt_templates()
     
-    if template_name not in PROMPT_TEMPLATES:
+    if template_name not in prompt_templates:
         flash('テンプレートが見つかりません。', 'error')
         return redirect(url_for('prompts'))
     
-    template = PROMPT_TEMPLATES[template_name]
+    template = prompt_templates[template_name]
     return render_template('view_prompt.html', template=template, template_name=template_name)
 
+# 最後にテンプレートファイルを探したときのディレクトリの更新時刻（ワーカーごと）
+_template_dir_mtime = None
+
+def _template_refs():
+    """
+    テンプレートファイルと内容のハッシュの対応（本文ストアの名前 template:<ファイル名>）
+
+    対応がまだないテンプレートファイル（手動で置いたものなど）はここで登録する。ファイルの一覧は
+    ディレクトリの更新時刻（ファイルの追加・削除・名前の変更で変わる）が前回と同じなら読み直さない。
+    アプリが保存するテンプレートは _save_prompt_template で登録し、内容の変更は
+    _find_template_by_content で確かめる。
+    """
+    global _template_dir_mtime
+    blobs = get_history_log().blobs
+    # 一覧を読む前の時刻を記録する（読んでいる間に追加されたファイルは次回に見つかる）
+    mtime = os.stat('.').st_mtime_ns
+    if mtime == _template_dir_mtime:
+        return blobs
+    refs = blobs.names('template:')
+    for filename in os.listdir('.'):
+        is_template = filename.endswith('.txt') and (filename.startswith('prompt_') or filename.endswith('_prompt.txt'))
+        if is_template and f'template:{filename}' not in refs:
+            with open(filename, 'r', encoding='utf-8') as f:
+                refs[f'template:{filename}'] = blobs.put(f.read())
+            blobs.link(f'template:{filename}', refs[f'template:{filename}'])
+    _template_dir_mtime = mtime
+    return blobs
+
+def _find_template_by_content(content, blobs=None):
+    """同じ内容のテンプレートファイル名（なければ None。blobs: _template_refs() の戻り値）"""
+    blobs = blobs or _template_refs()
+    digest = content_hash(content)
+    for name in blobs.names_for(digest, 'template:'):
+        filename = name[len('template:'):]
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                if content_hash(f.read()) == digest:
+                    return filename
+        except FileNotFoundError:
+            pass
+        # アプリの外で編集・削除されたファイルの対応は消す
+        blobs.unlink(name)
+    return None
+
+def _save_prompt_template(filename, content, blobs=None):
+    """
+    プロンプトテンプレートをファイルに保存し、(ファイル名, 既存のテンプレートを使ったか) を返す
+
+    同じ内容のテンプレートがすでにあれば新しいファイルは作らない。ファイル名が使われている場合は、
+    内容のハッシュの先頭を付けた名前にする。
+    """
+    blobs = blobs or _template_refs()
+    existing = _find_template_by_content(content, blobs)
+    if existing:
+        return existing, True
+    
+    digest = blobs.put(content)
+    if os.path.exists(filename):
+        filename = f"{filename[:-len('.txt')]}_{digest[:8]}.txt"
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(content)
+    blobs.link(f'template:{filename}', digest)
+    return filename, False
+
 @app.route('/prompts/create', methods=['GET', 'POST'])
 def create_prompt():
     """新しいプロンプトテンプレートを作成"""
@@ -270,20 +576,19 @@ def create_prompt():
             if not template_name or not content:
                 return jsonify({'error': 'テンプレート名と内容を入力してください。'})
             
+            try:
+                compile_template(content, template_name)
+            except TemplateError as e:
+                return jsonify({'error': str(e)})
+            
             # ファイル名を生成
             filename = f"prompt_{template_name.lower().replace(' ', '_').replace('用', '').replace('テンプレート', '')}.txt"
             
-            # ファイル名の重複を避ける
-            counter = 1
-            original_filename = filename
-            while os.path.exists(filename):
-                name_part = original_filename.replace('.txt', '')
-                filename = f"{name_part}_{counter}.txt"
-                counter += 1
-            
-            # ファイルに保存
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(content)
+            # ファイルに保存（同じ内容のテンプレートがあればそれを使う）
+            filename, existing = _save_prompt_template(filename, content)
+            if existing:
+                flash(f'同じ内容のテンプレート "{filename}" がすでにあるため、新しいファイルは作成しませんでした。', 'info')
+                return jsonify({'success': True, 'filename': filename, 'existing': True})
             
             # 生成履歴を保存
             history_data = {
@@ -295,9 +600,7 @@ def create_prompt():
                 'source': 'manual'
             }
             
-            history_filename = f"prompt_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-            with open(history_filename, 'w', encoding='utf-8') as f:
-                json.dump(history_data, f, ensure_ascii=False, indent=2)
+            get_history_log().append('prompt', history_data)
             
             flash(f'テンプレート "{template_name}" を作成しました。', 'success')
             return jsonify({'success': True, 'filename': filename})
@@ -441,6 +744,7 @@ def generate_prompt():
 - 文字数制限や構成の指定
 - SEOを意識した内容（指定された場合）
 - {{theme}}プレースホルダーを使用（記事のテーマに置き換えられる）
+- プレースホルダーとして使える変数は {PLACEHOLDERS} のみ（それ以外の波括弧の変数は使わない）
 - 指定されたターゲット読者に適した内容
 - 指定されたスタイルとトーンに合わせた指示{ranking_instructions}
 
@@ -453,28 +757,11 @@ def generate_prompt():
 プロンプトテンプレートを作成してください。
 """
         
-        # Perplexity APIを使用してプロンプトを生成
-        client = PerplexityClient()
-        messages = [
-            {"role": "user", "content": ai_prompt}
-        ]
-        
-        response = client.chat_completion(messages, model="sonar", max_tokens=2048)
-        
-        if response:
-            generated_content = response.get('choices', [{}])[0].get('message', {}).get('content', '')
-            
-            # 生成された内容をクリーンアップ
-            generated_content = generated_content.strip()
-            
-            # 不要な装飾を削除
-            if generated_content.startswith('```'):
-                generated_content = generated_content.split('```', 2)[1]
-            if generated_content.endswith('```'):
-                generated_content = generated_content.rsplit('```', 1)[0]
-            
-            # 生成履歴を保存
-            history_data = {
+        # Perplexity APIでの生成はジョブとして実行（完了は /jobs/<ID> で確認）
+        return _submit_llm_job('prompt_generation', {
+            'ai_prompt': ai_prompt,
+            'prompt_type': prompt_type,
+            'history': {
                 'template_name': f"{prompt_type}用テンプレート",
                 'article_theme': article_theme,
                 'prompt_type': prompt_type,
@@ -489,65 +776,80 @@ def generate_prompt():
                 'ranking_criteria': ranking_criteria,
                 'ranking_format': ranking_format,
                 'ranking_elements': ranking_elements,
-                'ranking_introduction': ranking_introduction,
-                'generated_content': generated_content,
-                'created_at': datetime.now().isoformat(),
-                'source': 'ai_generated'
+                'ranking_introduction': ranking_introduction
             }
-            
-            history_filename = f"prompt_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-            with open(history_filename, 'w', encoding='utf-8') as f:
-                json.dump(history_data, f, ensure_ascii=False, indent=2)
-            
-            # 生成されたプロンプトをファイルとして保存
-            template_name = f"{prompt_type}用テンプレート"
-            filename = f"prompt_{template_name.lower().replace(' ', '_').replace('用', '').replace('テンプレート', '')}.txt"
-            
-            # ファイル名の重複を避ける
-            counter = 1
-            original_filename = filename
-            while os.path.exists(filename):
-                name_part = original_filename.replace('.txt', '')
-                filename = f"{name_part}_{counter}.txt"
-                counter += 1
-            
-            # ファイルに保存
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(generated_content)
-            
-            # 履歴データにファイル名を追加
-            history_data['filename'] = filename
-            with open(history_filename, 'w', encoding='utf-8') as f:
-                json.dump(history_data, f, ensure_ascii=False, indent=2)
-            
-            # プロンプトテンプレートを再読み込みして即座に反映
-            global PROMPT_TEMPLATES
-            PROMPT_TEMPLATES = load_prompt_templates()
-            
-            return jsonify({
-                'success': True,
-                'content': generated_content,
-                'suggested_name': template_name,
-                'filename': filename,
-                'message': f'プロンプトテンプレート「{template_name}」が正常に生成され、ファイル「{filename}」として保存されました。'
-            })
-        else:
-            return jsonify({'error': 'AIによるプロンプト生成に失敗しました。'})
+        })
             
     except Exception as e:
         return jsonify({'error': f'プロンプト生成でエラーが発生しました: {str(e)}'})
 
+def run_prompt_generation(params, job):
+    """プロンプトテンプレートを生成して保存（ジョブ）"""
+    prompt_type = params['prompt_type']
+    
+    # Perplexity APIを使用してプロンプトを生成
+    client = PerplexityClient()
+    messages = [
+        {"role": "user", "content": params['ai_prompt']}
+    ]
+    
+    response = client.chat_completion(messages, model="sonar", max_tokens=2048, call_site="prompt_generation")
+    
+    if not response:
+        raise RuntimeError('AIによるプロンプト生成に失敗しました。')
+    
+    generated_content = response.get('choices', [{}])[0].get('message', {}).get('content', '')
+    
+    # 生成された内容をクリーンアップ
+    generated_content = generated_content.strip()
+    
+    # 不要な装飾を削除
+    if generated_content.startswith('```'):
+        generated_content = generated_content.split('```', 2)[1]
+    if generated_content.endswith('```'):
+        generated_content = generated_content.rsplit('```', 1)[0]
+    
+    created_at = datetime.now().isoformat()
+    
+    # 生成されたプロンプトをファイルとして保存
+    template_name = f"{prompt_type}用テンプレート"
+    filename = f"prompt_{template_name.lower().replace(' ', '_').replace('用', '').replace('テンプレート', '')}.txt"
+    
+    # ファイルに保存（同じ内容のテンプレートがあればそれを使う）
+    try:
+        compile_template(generated_content, filename)
+    except TemplateError as e:
+        raise RuntimeError(f'生成されたテンプレートは使用できません: {e}')
+    filename, existing = _save_prompt_template(filename, generated_content)
+    
+    # 生成履歴を保存
+    history_data = dict(params['history'],
+                        generated_content=generated_content,
+                        created_at=created_at,
+                        source='ai_generated',
+                        filename=filename)
+    get_history_log().append('prompt', history_data)
+    
+    return {
+        'success': True,
+        'content': generated_content,
+        'suggested_name': template_name,
+        'filename': filename,
+        'existing': existing,
+        'message': (f'同じ内容のテンプレート「{filename}」がすでにあるため、新しいファイルは作成しませんでした。' if existing
+                    else f'プロンプトテンプレート「{template_name}」が正常に生成され、ファイル「{filename}」として保存されました。')
+    }
+
 @app.route('/prompts/edit/<template_name>', methods=['GET', 'POST'])
 def edit_prompt(template_name):
     """プロンプトテンプレートを編集"""
-    global PROMPT_TEMPLATES
-    PROMPT_TEMPLATES = load_prompt_templates()
+    prompt_templates = load_prompt_templates()
     
-    if template_name not in PROMPT_TEMPLATES:
+    if template_name not in prompt_templates:
         flash('テンプレートが見つかりません。', 'error')
         return redirect(url_for('prompts'))
     
-    template = PROMPT_TEMPLATES[template_name]
+    template = prompt_templates[template_name]
     
     if request.method == 'POST':
         try:
@@ -557,9 +859,16 @@ def edit_prompt(template_name):
             if not content:
                 return jsonify({'error': 'テンプレート内容を入力してください。'})
             
+            try:
+                compile_template(content, template['file'])
+            except TemplateError as e:
+                return jsonify({'error': str(e)})
+            
             # ファイルを更新
             with open(template['file'], 'w', encoding='utf-8') as f:
                 f.write(content)
+            blobs = get_history_log().blobs
+            blobs.link(f"template:{template['file']}", blobs.put(content))
             
             flash(f'テンプレート "{template["name"]}" を更新しました。', 'success')
             return jsonify({'success': True})
@@ -572,18 +881,18 @@ def edit_prompt(template_name):
 @app.route('/prompts/delete/<template_name>', methods=['POST'])
 def delete_prompt(template_name):
     """プロンプトテンプレートを削除"""
-    global PROMPT_TEMPLATES
-    PROMPT_TEMPLATES = load_prompt_templates()
+    prompt_templates = load_prompt_templates()
     
-    if template_name not in PROMPT_TEMPLATES:
+    if template_name not in prompt_templates:
         flash('テンプレートが見つかりません。', 'error')
         return redirect(url_for('prompts'))
     
-    template = PROMPT_TEMPLATES[template_name]
+    template = prompt_templates[template_name]
     
     try:
         # ファイルを削除
         os.remove(template['file'])
+        get_history_log().blobs.unlink(f"template:{template['file']}")
         flash(f'テンプレート "{template["name"]}" を削除しました。', 'success')
     except Exception as e:
         flash(f'テンプレートの削除でエラーが発生しました: {str(e)}', 'error')
@@ -592,47 +901,79 @@ def delete_prompt(template_name):
 
 @app.route('/prompts/refresh')
 def refresh_prompts():
-    """プロンプトテンプレートを再読み込み"""
-    global PROMPT_TEMPLATES
-    PROMPT_TEMPLATES = load_prompt_templates()
+    """プロンプトテンプレートを再読み込み（テンプレートは画面表示のたびにファイルから読み込む）"""
     flash('プロンプトテンプレートを再読み込みしました。', 'success')
     return redirect(url_for('prompts'))
 
+# 履歴から復元したかどうかの印（復元は前回の復元より後の履歴だけを対象にする）
+RESTORE_MARKER = 'restored'
+
 @app.route('/prompts/restore-from-history')
 def restore_prompts_from_history():
-    """生成履歴からプロンプトテンプレートを復元"""
+    """生成履歴からプロンプトテンプレートを復元（dry_run=1 の場合は復元の予定を表示するだけ）"""
+    dry_run = request.args.get('dry_run') == '1'
+    plan = []
     try:
+        log = get_history_log()
+        blobs = _template_refs()
+        planned = {}
         restored_count = 0
+        last_id = None
         
-        # プロンプト生成履歴を検索
-        for filename in os.listdir('.'):
-            if filename.startswith('prompt_history_') and filename.endswith('.json'):
-                try:
-                    with open(filename, 'r', encoding='utf-8') as f:
-                        history_data = json.load(f)
-                    
-                    # AI生成されたプロンプトのみを対象
-                    if history_data.get('source') == 'ai_generated':
-                        generated_content = history_data.get('generated_content', '')
-                        template_name = history_data.get('template_name', '')
-                        
-                        if generated_content and template_name:
-                            # ファイル名を生成
-                            filename_base = f"prompt_{template_name.lower().replace(' ', '_').replace('用', '').replace('テンプレート', '')}.txt"
-                            
-                            # ファイルが存在しない場合のみ作成
-                            if not os.path.exists(filename_base):
-                                with open(filename_base, 'w', encoding='utf-8') as f:
-                                    f.write(generated_content)
-                                restored_count += 1
-                                print(f"復元されたテンプレート: {filename_base}")
+        # 前回の復元より後に保存されたプロンプト生成履歴だけを確認
+        for entry in log.unmarked(RESTORE_MARKER, 'prompt'):
+            try:
+                # AI生成されたプロンプトのみを対象（作成元が索引にない古い履歴は内容で確認）
+                if entry['source'] is not None and entry['source'] != 'ai_generated':
+                    last_id = entry['id']
+                    continue
+                history_data = log.get(entry['id']) or {}
+                generated_content = history_data.get('generated_content', '')
+                template_name = history_data.get('template_name', '')
+                if history_data.get('source') != 'ai_generated' or not generated_content or not template_name:
+                    last_id = entry['id']
+                    continue
+                
+                # ファイル名を生成
+                filename_base = f"prompt_{template_name.lower().replace(' ', '_').replace('用', '').replace('テンプレート', '')}.txt"
                 
-                except Exception as e:
-                    print(f"履歴ファイル {filename} の処理エラー: {e}")
+                # 同じ内容のテンプレートも同じ名前のファイルもない場合のみ作成
+                digest = content_hash(generated_content)
+                existing = planned.get(digest) or _find_template_by_content(generated_content, blobs)
+                if existing:
+                    action, filename = 'existing', existing
+                elif filename_base in planned.values() or os.path.exists(filename_base):
+                    action, filename = 'name_taken', filename_base
+                else:
+                    action, filename = 'restore', filename_base
+                
+                if not dry_run:
+                    if action == 'restore':
+                        _save_prompt_template(filename_base, generated_content, blobs)
+                        restored_count += 1
+                        print(f"復元されたテンプレート: {filename_base}")
+                    log.mark(RESTORE_MARKER, entry['id'], f"{action}:{filename}")
+                elif action == 'restore':
+                    planned[digest] = filename_base
+                
+                plan.append({
+                    'key': history_key(entry['id']),
+                    'created_at': datetime.fromisoformat(entry['created_at']).strftime('%Y-%m-%d %H:%M:%S'),
+                    'template_name': template_name,
+                    'action': action,
+                    'filename': filename
+                })
+                last_id = entry['id']
+            except Exception as e:
+                # 処理できなかった履歴は次回もう一度確認する
+                print(f"履歴 {history_key(entry['id'])} の処理エラー: {e}")
+                break
         
-        # プロンプトテンプレートを再読み込み
-        global PROMPT_TEMPLATES
-        PROMPT_TEMPLATES = load_prompt_templates()
+        if dry_run:
+            return render_template('restore_preview.html', plan=plan)
+        
+        if last_id is not None:
+            log.advance(RESTORE_MARKER, last_id)
         
         if restored_count > 0:
             flash(f'{restored_count}個のプロンプトテンプレートを履歴から復元しました。', 'success')
@@ -648,37 +989,98 @@ def restore_prompts_from_history():
 @app.route('/prompts/evaluate/<template_name>', methods=['GET', 'POST'])
 def evaluate_prompt(template_name):
     """プロンプトテンプレートを評価・改善"""
-    global PROMPT_TEMPLATES
-    PROMPT_TEMPLATES = load_prompt_templates()
+    prompt_templates = load_prompt_templates()
     
-    if template_name not in PROMPT_TEMPLATES:
+    if template_name not in prompt_templates:
         flash('テンプレートが見つかりません。', 'error')
         return redirect(url_for('prompts'))
     
-    template = PROMPT_TEMPLATES[template_name]
+    template = prompt_templates[template_name]
     
     if request.method == 'POST':
         try:
             data = request.get_json()
-            evaluation_type = data.get('evaluation_type', 'general')
-            specific_feedback = data.get('specific_feedback', '')
-            
-            # 評価用のプロンプトを作成
-            evaluation_prompts = {
-                'general': 'このプロンプトテンプレートを全体的に改善し、より効果的で実用的なものにしてください。',
-                'clarity': 'このプロンプトテンプレートをより明確で分かりやすい指示に改善してください。',
-                'structure': 'このプロンプトテンプレートの構造を改善し、より論理的で実行しやすいものにしてください。',
-                'seo': 'このプロンプトテンプレートをSEO最適化の観点から改善してください。',
-                'engagement': 'このプロンプトテンプレートを読者の興味を引く記事生成に改善してください。',
-                'custom': specific_feedback
-            }
-            
-            evaluation_prompt = evaluation_prompts.get(evaluation_type, evaluation_prompts['general'])
-            
-            # AIを使用してプロンプトを評価・改善
-            client = PerplexityClient()
-            messages = [
-                {"role": "user", "content": f"""
+            if data.get('mode') == 'compare':
+                # 複数の観点を並列に評価し、サンプル記事で比較
+                evaluation_types = [t for t in data.get('evaluation_types') or COMPARISON_TYPES
+                                    if t in EVALUATION_PROMPTS or (t == 'custom' and data.get('specific_feedback'))]
+                themes = [t.strip() for t in data.get('themes', []) if isinstance(t, str) and t.strip()]
+                if not evaluation_types:
+                    return jsonify({'error': '評価する観点を選択してください。'})
+                if len(themes) > MAX_COMPARISON_THEMES:
+                    return jsonify({'error': f'比較用のテーマは{MAX_COMPARISON_THEMES}件までです。'})
+                return _submit_llm_job('evaluation_comparison', {
+                    'template_name': template_name,
+                    'template_file': template['file'],
+                    'evaluation_types': evaluation_types,
+                    'specific_feedback': data.get('specific_feedback', ''),
+                    'themes': themes,
+                    'max_tokens': int(data.get('max_tokens', 1024)),
+                    'parallel': int(os.getenv('BLOG_TOOL_EVAL_PARALLEL', '5'))
+                })
+            return _submit_llm_job('evaluation', {
+                'template_name': template_name,
+                'template_file': template['file'],
+                'evaluation_type': data.get('evaluation_type', 'general'),
+                'specific_feedback': data.get('specific_feedback', '')
+            })
+        except Exception as e:
+            return jsonify({'error': f'プロンプトの評価・改善でエラーが発生しました: {str(e)}'})
+    
+    return render_template('evaluate_prompt.html', template=template, template_name=template_name)
+
+# 評価の種類ごとの改善指示（custom は利用者の指示をそのまま使う）
+EVALUATION_PROMPTS = {
+    'general': 'このプロンプトテンプレートを全体的に改善し、より効果的で実用的なものにしてください。',
+    'clarity': 'このプロンプトテンプレートをより明確で分かりやすい指示に改善してください。',
+    'structure': 'このプロンプトテンプレートの構造を改善し、より論理的で実行しやすいものにしてください。',
+    'seo': 'このプロンプトテンプレートをSEO最適化の観点から改善してください。',
+    'engagement': 'このプロンプトテンプレートを読者の興味を引く記事生成に改善してください。'
+}
+
+EVALUATION_LABELS = {
+    'general': '全体的な改善',
+    'clarity': '明確性の向上',
+    'structure': '構造の改善',
+    'seo': 'SEO最適化',
+    'engagement': '読者エンゲージメント',
+    'custom': 'カスタム評価'
+}
+
+# 比較モードで評価する観点の既定値
+COMPARISON_TYPES = ('general', 'clarity', 'structure', 'seo', 'engagement')
+# 比較モードでサンプル記事を生成するテーマの上限
+MAX_COMPARISON_THEMES = 3
+
+def _response_text(response):
+    return response.get('choices', [{}])[0].get('message', {}).get('content', '')
+
+def _response_tokens(response):
+    usage = response.get('usage') or {}
+    return int(usage.get('total_tokens') or (int(usage.get('prompt_tokens') or 0) + int(usage.get('completion_tokens') or 0)))
+
+# 評価・改善の応答で改善されたテンプレートを囲む行
+IMPROVED_TEMPLATE_BEGIN = '=== 改善されたテンプレート ==='
+IMPROVED_TEMPLATE_END = '=== 改善されたテンプレートここまで ==='
+_IMPROVED_TEMPLATE = re.compile(re.escape(IMPROVED_TEMPLATE_BEGIN) + r'\s*\n(.*?)\n\s*' + re.escape(IMPROVED_TEMPLATE_END),
+                                re.DOTALL)
+
+def _evaluate_template(template, evaluation_type, specific_feedback=''):
+    """
+    テンプレートを1つの観点で評価・改善
+
+    Returns:
+        tuple: (応答の本文（改善されたプロンプトと改善点の説明。_extract_improved_template で分ける）, APIレスポンス)
+    """
+    if evaluation_type == 'custom':
+        evaluation_prompt = specific_feedback
+    else:
+        evaluation_prompt = EVALUATION_PROMPTS.get(evaluation_type, EVALUATION_PROMPTS['general'])
+    
+    # AIを使用してプロンプトを評価・改善
+    client = PerplexityClient()
+    messages = [
+        {"role": "user", "content": f"""
 以下のプロンプトテンプレートを評価・改善してください。
 
 #評価・改善指示
@@ -692,56 +1094,231 @@ def evaluate_prompt(template_name):
 - より明確で実行可能な指示に改善
 - 構造化された形式を維持
 - {{theme}}プレースホルダーを保持
+- プレースホルダーとして使える変数は {PLACEHOLDERS} のみ（それ以外の波括弧の変数は使わない）
 - 実用的で効果的なプロンプトに改善
 
 #出力形式
-改善されたプロンプトテンプレートを出力してください。
-改善点の説明も含めてください。
+改善されたプロンプトテンプレートを、次の2行の間に出力してください（この2行はそのまま書いてください）。
+{IMPROVED_TEMPLATE_BEGIN}
+（改善されたプロンプトテンプレート）
+{IMPROVED_TEMPLATE_END}
+改善点の説明は、この範囲の外（後）に書いてください。
 """}
-            ]
-            
-            response = client.chat_completion(messages, model="sonar", max_tokens=2048)
-            
-            if response:
-                improved_content = response.get('choices', [{}])[0].get('message', {}).get('content', '')
-                
-                # 改善された内容をクリーンアップ
-                improved_content = improved_content.strip()
-                
-                # 不要な装飾を削除
-                if improved_content.startswith('```'):
-                    improved_content = improved_content.split('```', 2)[1]
-                if improved_content.endswith('```'):
-                    improved_content = improved_content.rsplit('```', 1)[0]
-                
-                # 評価履歴を保存
-                evaluation_history = {
-                    'template_name': template_name,
-                    'template_file': template['file'],
-                    'evaluation_type': evaluation_type,
-                    'specific_feedback': specific_feedback,
-                    'original_content': template['content'],
-                    'improved_content': improved_content,
-                    'created_at': datetime.now().isoformat(),
-                    'source': 'ai_evaluation'
-                }
-                
-                history_filename = f"evaluation_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-                with open(history_filename, 'w', encoding='utf-8') as f:
-                    json.dump(evaluation_history, f, ensure_ascii=False, indent=2)
-                
-                return jsonify({
-                    'success': True,
-                    'improved_content': improved_content,
-                    'original_content': template['content']
-                })
-            else:
-                return jsonify({'error': 'プロンプトの評価・改善に失敗しました。'})
-                
+    ]
+    
+    response = client.chat_completion(messages, model="sonar", max_tokens=2048,
+                                      call_site="evaluation", template=template['file'])
+    
+    if not response:
+        raise RuntimeError('プロンプトの評価・改善に失敗しました。')
+    
+    # 改善された内容をクリーンアップ
+    improved_content = _response_text(response).strip()
+    
+    # 不要な装飾を削除
+    if improved_content.startswith('```'):
+        improved_content = improved_content.split('```', 2)[1]
+    if improved_content.endswith('```'):
+        improved_content = improved_content.rsplit('```', 1)[0]
+    
+    return improved_content, response
+
+def _extract_improved_template(improved_content):
+    """
+    評価・改善の応答から改善されたテンプレートだけを取り出す
+
+    テンプレートは IMPROVED_TEMPLATE_BEGIN 〜 IMPROVED_TEMPLATE_END の間（改善点の説明はその外）。
+    取り出したテンプレートは解析し、{theme} があることも確かめる。
+
+    Returns:
+        tuple: (テンプレート, 改善点の説明)
+
+    Raises:
+        TemplateError: 範囲が見つからない・解析できない・{theme} がない場合
+    """
+    match = _IMPROVED_TEMPLATE.search(improved_content)
+    if not match:
+        raise TemplateError('応答に改善されたテンプレートの範囲がありません。')
+    improved_template = match.group(1).strip()
+    if improved_template.startswith('```'):
+        improved_template = improved_template.split('\n', 1)[-1]
+    if improved_template.endswith('```'):
+        improved_template = improved_template[:-3]
+    improved_template = improved_template.strip()
+    compiled = compile_template(improved_template, '改善案')
+    if 'theme' not in compiled.variables:
+        raise TemplateError('改善案に {theme} がありません。')
+    explanation = (improved_content[:match.start()] + improved_content[match.end():]).strip()
+    return improved_template, explanation
+
+def _save_evaluation_history(template_name, template, evaluation_type, specific_feedback, improved_content, **extra):
+    """評価履歴を保存し、履歴のキーを返す"""
+    evaluation_history = {
+        'template_name': template_name,
+        'template_file': template['file'],
+        'evaluation_type': evaluation_type,
+        'specific_feedback': specific_feedback,
+        'original_content': template['content'],
+        'improved_content': improved_content,
+        'created_at': datetime.now().isoformat(),
+        'source': 'ai_evaluation'
+    }
+    evaluation_history.update(extra)
+    
+    return history_key(get_history_log().append('evaluation', evaluation_history))
+
+def _generate_sample_article(prompt_template, theme, template_file, max_tokens=1024):
+    """テンプレートにテーマを当てはめて記事を生成し、APIレスポンスを返す"""
+    client = PerplexityClient()
+    messages = [
+        {"role": "user", "content": compile_template(prompt_template, template_file).render(theme=theme)}
+    ]
+    response = client.chat_completion(messages, model="sonar", max_tokens=max_tokens,
+                                      call_site="preview", template=template_file)
+    if not response:
+        raise RuntimeError('記事の生成に失敗しました。')
+    return response
+
+def run_prompt_evaluation(params, job):
+    """プロンプトテンプレートを評価・改善（ジョブ）"""
+    template_name = params['template_name']
+    evaluation_type = params.get('evaluation_type', 'general')
+    specific_feedback = params.get('specific_feedback', '')
+    
+    template = load_prompt_templates().get(template_name)
+    if not template:
+        raise RuntimeError('テンプレートが見つかりません。')
+    
+    improved_content, _ = _evaluate_template(template, evaluation_type, specific_feedback)
+    _save_evaluation_history(template_name, template, evaluation_type, specific_feedback, improved_content)
+    
+    try:
+        improved_template, explanation = _extract_improved_template(improved_content)
+    except TemplateError as e:
+        # 取り出せない場合は応答全体を表示する（適用前に編集してもらう）
+        print(f"改善案の取り出しエラー（{template_name}）: {e}")
+        improved_template, explanation = improved_content, ''
+    
+    return {
+        'success': True,
+        'improved_content': improved_template,
+        'explanation': explanation,
+        'original_content': template['content']
+    }
+
+def run_prompt_comparison(params, job):
+    """
+    複数の観点での評価・改善を並列に実行し、改善案ごとのサンプル記事を並べて比較（ジョブ）
+
+    1. 観点ごとの評価・改善を同時に実行
+    2. 元のテンプレートと各改善案で、テーマごとのサンプル記事を同時に生成
+    改善案は応答から取り出したテンプレート（_extract_improved_template）で、取り出せない案・{theme} のない案は
+    無効としてサンプル記事を作らない。改善案ごとにトークン数と所要時間（API呼び出しの合計）を返す。
+    """
+    template_name = params['template_name']
+    specific_feedback = params.get('specific_feedback', '')
+    evaluation_types = params.get('evaluation_types') or list(COMPARISON_TYPES)
+    themes = params.get('themes') or []
+    max_tokens = int(params.get('max_tokens', 1024))
+    
+    template = load_prompt_templates().get(template_name)
+    if not template:
+        raise RuntimeError('テンプレートが見つかりません。')
+    
+    started = time.perf_counter()
+    calls = [0, len(evaluation_types) * (1 + len(themes)) + len(themes)]
+    
+    def report_progress(step):
+        calls[0] += 1
+        job.progress = {'done': calls[0], 'total': calls[1], 'step': step}
+        _save_job(job)
+    
+    def timed(func, *args):
+        # 呼び出しごとの所要時間を測る（例外は結果として返し、他の改善案の処理は続ける）
+        t0 = time.perf_counter()
+        try:
+            return func(*args), None, time.perf_counter() - t0
         except Exception as e:
-            return jsonify({'error': f'プロンプトの評価・改善でエラーが発生しました: {str(e)}'})
+            return None, str(e), time.perf_counter() - t0
     
-    return render_template('evaluate_prompt.html', template=template, template_name=template_name)
+    def submit(executor, func, *args):
+        # ジョブのスコープ（トークンの集計先）とトレースをスレッドに引き継ぐ
+        return executor.submit(contextvars.copy_context().run, timed, func, *args)
+    
+    variants = [{
+        'name': 'original',
+        'label': '元のテンプレート',
+        'content': template['content'],
+        'explanation': '',
+        'error': None,
+        'evaluation_tokens': 0,
+        'evaluation_seconds': 0.0
+    }]
+    parallel = max(1, int(params.get('parallel') or len(evaluation_types)))
+    with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix='evaluation') as executor:
+        futures = [(evaluation_type, submit(executor, _evaluate_template, template, evaluation_type, specific_feedback))
+                   for evaluation_type in evaluation_types]
+        for evaluation_type, future in futures:
+            result, error, seconds = future.result()
+            report_progress(f"評価: {evaluation_type}")
+            improved_content, response = result if result else (None, None)
+            # サンプル記事は応答から取り出したテンプレートだけで作る（説明文を含めず、{theme} のない案は無効）
+            improved_template, explanation = None, ''
+            if improved_content:
+                try:
+                    improved_template, explanation = _extract_improved_template(improved_content)
+                except TemplateError as e:
+                    error = f"無効な改善案: {e}"
+            variant = {
+                'name': evaluation_type,
+                'label': EVALUATION_LABELS.get(evaluation_type, evaluation_type),
+                'content': improved_template,
+                'explanation': explanation,
+                'error': error,
+                'evaluation_tokens': _response_tokens(response) if response else 0,
+                'evaluation_seconds': round(seconds, 2)
+            }
+            if improved_content:
+                variant['history_key'] = _save_evaluation_history(
+                    template_name, template, evaluation_type, specific_feedback, improved_content,
+                    comparison_job_id=job.job_id)
+            variants.append(variant)
+        
+        # 評価に失敗した改善案・無効な改善案はサンプル記事を作らない
+        sample_futures = [(variant, theme, submit(executor, _generate_sample_article, variant['content'], theme,
+                                                   template['file'], max_tokens))
+                          for variant in variants if variant['content'] for theme in themes]
+        calls[1] = calls[0] + len(sample_futures)
+        for variant in variants:
+            variant['samples'] = []
+        for variant, theme, future in sample_futures:
+            response, error, seconds = future.result()
+            report_progress(f"サンプル記事: {variant['name']} / {theme}")
+            variant['samples'].append({
+                'theme': theme,
+                'article': _response_text(response) if response else None,
+                'error': error,
+                'tokens': _response_tokens(response) if response else 0,
+                'seconds': round(seconds, 2)
+            })
+    
+    for variant in variants:
+        variant['tokens'] = variant['evaluation_tokens'] + sum(s['tokens'] for s in variant['samples'])
+        variant['seconds'] = round(variant['evaluation_seconds'] + sum(s['seconds'] for s in variant['samples']), 2)
+    if not any(v['content'] for v in variants[1:]):
+        raise RuntimeError('すべての観点で評価・改善に失敗しました。')
+    
+    return {
+        'success': True,
+        'mode': 'compare',
+        'template_name': template_name,
+        'themes': themes,
+        'variants': variants,
+        'total_tokens': sum(v['tokens'] for v in variants),
+        # API呼び出しを1件ずつ順に実行した場合の所要時間と、並列実行での実際の所要時間
+        'serial_seconds': round(sum(v['seconds'] for v in variants), 2),
+        'wall_seconds': round(time.perf_counter() - started, 2)
+    }
 
 # 生成履歴の保存と管理
 @app.route('/generation-history')
@@ -756,10 +1333,14 @@ def generation_history():
     search_filter = request.args.get('search', '')
     
     history_items = []
+    # 履歴ログに未取り込みの個別ファイル（*_history_*.json）の数
+    legacy_count = 0
     
     # 記事生成履歴
     for filename in os.listdir('.'):
-        if filename.startswith('blog_article_') and filename.endswith('.txt'):
+        if legacy_kind(filename):
+            legacy_count += 1
+        elif filename.startswith('blog_article_') and filename.endswith('.txt'):
             try:
                 file_path = filename
                 file_size = os.path.getsize(filename)
@@ -785,10 +1366,10 @@ def generation_history():
                 if search_filter and search_filter.lower() not in theme.lower():
                     continue
                 
-                # ファイル内容のプレビューを取得
+                # ファイル内容のプレビューを取得（先頭の PREVIEW_LENGTH 文字だけを読む）
                 with open(filename, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    preview_content = content[:200] + '...' if len(content) > 200 else content
+                    content = f.read(PREVIEW_LENGTH + 1)
+                    preview_content = content[:PREVIEW_LENGTH] + '...' if len(content) > PREVIEW_LENGTH else content
                 
                 history_items.append({
                     'filename': filename,
@@ -806,20 +1387,14 @@ def generation_history():
             except Exception as e:
                 print(f"記事ファイル {filename} の読み込みエラー: {e}")
     
-    # 記事履歴（JSONファイル）
-    for filename in os.listdir('.'):
-        if filename.startswith('article_history_') and filename.endswith('.json'):
+    # 記事・プロンプト・評価の履歴（履歴ログの索引のみを読む）
+    type_displays = {'article': '記事生成', 'prompt': 'プロンプト生成', 'evaluation': 'プロンプト評価'}
+    title_prefixes = {'article': '記事', 'prompt': 'プロンプト', 'evaluation': '評価'}
+    if type_filter in ('', 'article', 'prompt', 'evaluation'):
+        for entry in get_history_log().entries(type_filter or None):
             try:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    history_data = json.load(f)
-                
-                file_time = datetime.fromisoformat(history_data.get('created_at', ''))
-                theme = history_data.get('theme', '')
+                file_time = datetime.fromisoformat(entry['created_at'])
                 
-                # フィルタリング
-                if type_filter and type_filter != 'article':
-                    continue
-                    
                 if date_filter:
                     if date_filter == 'today' and file_time.date() != datetime.now().date():
                         continue
@@ -830,112 +1405,28 @@ def generation_history():
                     elif date_filter == 'year' and (datetime.now() - file_time).days > 365:
                         continue
                 
-                if search_filter and search_filter.lower() not in theme.lower():
+                # 記事はテーマ、プロンプト・評価はテンプレート名で検索
+                name = entry['theme'] if entry['kind'] == 'article' else entry['template_name']
+                if search_filter and search_filter.lower() not in (name or '').lower():
                     continue
                 
-                result = history_data.get('result', {})
-                preview_content = f"タイトル: {result.get('title', '')}\nステータス: {result.get('status', '')}\n投稿ID: {result.get('post_id', '')}\nURL: {result.get('post_url', '')}"
-                
-                history_items.append({
-                    'filename': filename,
-                    'title': f'記事: {theme}',
-                    'type': 'article',
-                    'type_display': '記事生成',
-                    'theme': theme,
-                    'file_size': os.path.getsize(filename),
+                item = {
+                    'filename': history_key(entry['id']),
+                    'title': f"{title_prefixes[entry['kind']]}: {name or ''}",
+                    'type': entry['kind'],
+                    'type_display': type_displays[entry['kind']],
+                    'file_size': entry['length'],
                     'created_at': file_time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'preview_content': preview_content,
-                    'can_view_local': False,
-                    'post_url': result.get('post_url')
-                })
-            except Exception as e:
-                print(f"記事履歴ファイル {filename} の読み込みエラー: {e}")
-    
-    # プロンプト生成履歴
-    for filename in os.listdir('.'):
-        if filename.startswith('prompt_history_') and filename.endswith('.json'):
-            try:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    history_data = json.load(f)
-                
-                file_time = datetime.fromisoformat(history_data.get('created_at', ''))
-                
-                # フィルタリング
-                if type_filter and type_filter != 'prompt':
-                    continue
-                    
-                if date_filter:
-                    if date_filter == 'today' and file_time.date() != datetime.now().date():
-                        continue
-                    elif date_filter == 'week' and (datetime.now() - file_time).days > 7:
-                        continue
-                    elif date_filter == 'month' and (datetime.now() - file_time).days > 30:
-                        continue
-                    elif date_filter == 'year' and (datetime.now() - file_time).days > 365:
-                        continue
-                
-                if search_filter:
-                    template_name = history_data.get('template_name', '')
-                    if search_filter.lower() not in template_name.lower():
-                        continue
-                
-                preview_content = history_data.get('generated_content', '')[:200] + '...' if len(history_data.get('generated_content', '')) > 200 else history_data.get('generated_content', '')
-                
-                history_items.append({
-                    'filename': filename,
-                    'title': f'プロンプト: {history_data.get("template_name", "")}',
-                    'type': 'prompt',
-                    'type_display': 'プロンプト生成',
-                    'template_name': history_data.get('template_name', ''),
-                    'file_size': os.path.getsize(filename),
-                    'created_at': file_time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'preview_content': preview_content
-                })
-            except Exception as e:
-                print(f"プロンプト履歴ファイル {filename} の読み込みエラー: {e}")
-    
-    # 評価履歴
-    for filename in os.listdir('.'):
-        if filename.startswith('evaluation_history_') and filename.endswith('.json'):
-            try:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    history_data = json.load(f)
-                
-                file_time = datetime.fromisoformat(history_data.get('created_at', ''))
-                
-                # フィルタリング
-                if type_filter and type_filter != 'evaluation':
-                    continue
-                    
-                if date_filter:
-                    if date_filter == 'today' and file_time.date() != datetime.now().date():
-                        continue
-                    elif date_filter == 'week' and (datetime.now() - file_time).days > 7:
-                        continue
-                    elif date_filter == 'month' and (datetime.now() - file_time).days > 30:
-                        continue
-                    elif date_filter == 'year' and (datetime.now() - file_time).days > 365:
-                        continue
-                
-                if search_filter:
-                    template_name = history_data.get('template_name', '')
-                    if search_filter.lower() not in template_name.lower():
-                        continue
-                
-                preview_content = history_data.get('improved_content', '')[:200] + '...' if len(history_data.get('improved_content', '')) > 200 else history_data.get('improved_content', '')
-                
-                history_items.append({
-                    'filename': filename,
-                    'title': f'評価: {history_data.get("template_name", "")}',
-                    'type': 'evaluation',
-                    'type_display': 'プロンプト評価',
-                    'template_name': history_data.get('template_name', ''),
-                    'file_size': os.path.getsize(filename),
-                    'created_at': file_time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'preview_content': preview_content
-                })
+                    'preview_content': entry['preview']
+                }
+                if entry['kind'] == 'article':
+                    item.update(theme=name, can_view_local=False,
+                                post_url=entry['post_url'] or None)
+                else:
+                    item['template_name'] = name
+                history_items.append(item)
             except Exception as e:
-                print(f"評価履歴ファイル {filename} の読み込みエラー: {e}")
+                print(f"履歴 {history_key(entry['id'])} の読み込みエラー: {e}")
     
     # 作成日時でソート（新しい順）
     history_items.sort(key=lambda x: x['created_at'], reverse=True)
@@ -965,28 +1456,34 @@ def generation_history():
     
     return render_template('generation_history.html', 
                          history_items=paginated_items, 
-                         pagination=pagination)
+                         pagination=pagination,
+                         legacy_count=legacy_count)
 
 @app.route('/history/detail/<filename>')
 def view_history_detail(filename):
     """生成履歴の詳細表示"""
     try:
+        entry_id = parse_history_key(filename)
+        if entry_id is not None:
+            history_data = _load_history_entry(entry_id)
+            if history_data is None:
+                flash('履歴が見つかりません。', 'error')
+                return redirect(url_for('generation_history'))
+            return _stream_history_detail(filename, history_data)
+        
         file_path = os.path.join('.', filename)
         if not os.path.exists(file_path):
             flash('履歴ファイルが見つかりません。', 'error')
             return redirect(url_for('generation_history'))
         
         if filename.startswith('blog_article_'):
-            # 記事ファイルの場合
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
+            # 記事ファイルの場合（本文は表示しながら読む）
             theme = filename.replace('blog_article_', '').replace('.txt', '')
             history_data = {
                 'type': 'article',
                 'title': f'記事: {theme}',
                 'theme': theme,
-                'content': content,
+                'content': PagedText.from_file(file_path),
                 'created_at': datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%Y-%m-%d %H:%M:%S'),
                 'file_size': os.path.getsize(file_path)
             }
@@ -1008,19 +1505,76 @@ def view_history_detail(filename):
             history_data['title'] = f"{'プロンプト' if history_data['type'] == 'prompt' else '評価'}: {history_data.get('template_name', '')}"
             history_data['file_size'] = os.path.getsize(file_path)
         
-        return render_template('view_history_detail.html', 
-                             filename=filename, 
-                             history_data=history_data)
+        return _stream_history_detail(filename, history_data)
     except Exception as e:
         flash(f'履歴ファイルの読み込みでエラーが発生しました: {str(e)}', 'error')
         return redirect(url_for('generation_history'))
 
+# 詳細表示で本文として流す項目（PagedText の場合）
+HISTORY_BODY_FIELDS = ('content', 'generated_content', 'original_content', 'improved_content')
+
+def _stream_history_detail(filename, history_data):
+    """履歴の詳細を、本文（PagedText）を少しずつ読みながら送る"""
+    history_data = dict(history_data)
+    article_page = None
+    for field in HISTORY_BODY_FIELDS:
+        body = history_data.get(field)
+        if not isinstance(body, PagedText):
+            continue
+        if history_data['type'] == 'article' and field == 'content':
+            # 記事本文はページに分ける
+            page = body.clamp(request.args.get('page', 1, type=int))
+            article_page = {'page': page, 'pages': body.pages}
+            history_data[field] = body.iter_page(page)
+        else:
+            history_data[field] = body.iter_text()
+    return Response(stream_template('view_history_detail.html', 
+                                    filename=filename, 
+                                    history_data=history_data,
+                                    article_page=article_page))
+
+def _load_history_entry(entry_id):
+    """
+    履歴ログの1件を詳細表示用に読み込む（なければ None）
+    
+    本文の項目（HISTORY_BODY_FIELDS）は本文ストアから読み込まず、PagedText にして返す。
+    """
+    log = get_history_log()
+    entry = log.entry(entry_id)
+    data = log.get(entry_id, resolve=False) if entry else None
+    if data is None:
+        return None
+    
+    history_data = dict(data)
+    history_data['type'] = entry['kind']
+    history_data['file_size'] = entry['length']
+    history_data['created_at'] = datetime.fromisoformat(entry['created_at']).strftime('%Y-%m-%d %H:%M:%S')
+    history_data['marks'] = log.marks(entry_id)
+    if entry['kind'] == 'article':
+        history_data['title'] = f'記事: {data.get("theme", "")}'
+        history_data['content'] = (data.get('result') or {}).get('content', '')
+    else:
+        history_data['title'] = f"{'プロンプト' if entry['kind'] == 'prompt' else '評価'}: {data.get('template_name', '')}"
+        if entry['kind'] == 'prompt' and not history_data.get('generated_content'):
+            # 手動で作成したテンプレートは content に本文がある
+            history_data['generated_content'] = data.get('content', '')
+    for field in HISTORY_BODY_FIELDS:
+        if field in history_data:
+            history_data[field] = PagedText.from_value(history_data[field], log.blobs)
+    return history_data
+
 @app.route('/history/delete/<filename>', methods=['POST'])
 def delete_history_item(filename):
     """生成履歴アイテムを削除"""
     try:
+        entry_id = parse_history_key(filename)
         file_path = os.path.join('.', filename)
-        if os.path.exists(file_path):
+        if entry_id is not None:
+            if get_history_log().delete(entry_id):
+                flash('履歴を削除しました。', 'success')
+            else:
+                flash('履歴が見つかりません。', 'error')
+        elif os.path.exists(file_path):
             os.remove(file_path)
             flash('履歴を削除しました。', 'success')
         else:
@@ -1034,18 +1588,20 @@ def delete_history_item(filename):
 @app.route('/prompts/preview/<template_name>')
 def preview_prompt(template_name):
     """プロンプトテンプレートのプレビュー"""
-    global PROMPT_TEMPLATES
-    PROMPT_TEMPLATES = load_prompt_templates()
+    prompt_templates = load_prompt_templates()
     
-    if template_name not in PROMPT_TEMPLATES:
+    if template_name not in prompt_templates:
         flash('テンプレートが見つかりません。', 'error')
         return redirect(url_for('prompts'))
     
-    template = PROMPT_TEMPLATES[template_name]
+    template = prompt_templates[template_name]
     
-    # サンプルテーマでプレビュー
+    # サンプルテーマでプレビュー（記事生成と同じ規則で変数を置き換える）
     sample_theme = "健康な食事の作り方"
-    preview_content = template['content'].replace('{theme}', sample_theme)
+    if template['error']:
+        flash(template['error'], 'error')
+        return redirect(url_for('view_prompt', template_name=template_name))
+    preview_content = load_template(template['file']).render(theme=sample_theme)
     
     return render_template('preview_prompt.html', 
                          template=template, 
@@ -1053,29 +1609,36 @@ def preview_prompt(template_name):
                          preview_content=preview_content,
                          sample_theme=sample_theme)
 
+@app.route('/preview/history/<filename>', methods=['POST'])
+def start_history_preview(filename):
+    """履歴から記事プレビューの生成を開始（ジョブ。完了後は preview_from_history で表示）"""
+    # テーマ推定
+    theme = filename.replace('blog_article_', '').replace('.txt', '')
+    # 既存テンプレートから最も近いものを選ぶ（ランキング優先）
+    tmpl_file = 'prompt_アニメランキングSEO最適化.txt' if 'ランキング' in theme else 'prompt_template.txt'
+    return _submit_llm_job('history_preview', {'theme': theme, 'template_file': tmpl_file})
+
 @app.route('/preview/history/<filename>')
 def preview_from_history(filename):
-    """履歴から記事プレビュー（投稿せずにHTML表示）"""
-    try:
-        # テーマ推定
-        theme = filename.replace('blog_article_', '').replace('.txt', '')
-        # 既存テンプレートから最も近いものを選ぶ（ランキング優先）
-        global PROMPT_TEMPLATES
-        PROMPT_TEMPLATES = load_prompt_templates()
-        tmpl_file = 'prompt_アニメランキングSEO最適化.txt' if 'ランキング' in theme else 'prompt_template.txt'
-        tool = IntegratedBlogTool()
-        result = tool.generate_article_content(theme, tmpl_file, 2048)
-        if not result:
-            flash('プレビューの生成に失敗しました。', 'error')
-            return redirect(url_for('generation_history'))
-        return render_template('view_article.html', 
-                             filename=filename,
-                             content=result['html'],
-                             theme=result['title'],
-                             generated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    except Exception as e:
-        flash(f'プレビュー生成でエラーが発生しました: {str(e)}', 'error')
+    """履歴から記事プレビュー（投稿せずにHTML表示。?job=<ID> は start_history_preview のジョブ）"""
+    job = state_store().get(f"job:{request.args.get('job', '')}")
+    if job.get('kind') != 'history_preview' or job.get('status') != 'succeeded':
+        flash(job.get('error') or 'プレビューが見つかりません。生成履歴の画面からもう一度開始してください。', 'error')
         return redirect(url_for('generation_history'))
+    result = job['result']
+    return render_template('view_article.html', 
+                         filename=filename,
+                         content=result['html'],
+                         theme=result['title'],
+                         generated_at=datetime.fromtimestamp(job['finished_at']).strftime('%Y-%m-%d %H:%M:%S'))
+
+def run_history_preview(params, job):
+    """履歴のテーマで記事本文を生成（ジョブ、投稿はしない）"""
+    tool = IntegratedBlogTool()
+    result = tool.generate_article_content(params['theme'], params['template_file'], 2048)
+    if not result:
+        raise RuntimeError('プレビューの生成に失敗しました。')
+    return {'success': True, 'title': result['title'], 'html': result['html']}
 
 @app.route('/prompts/preview/generate', methods=['POST'])
 def generate_preview():
@@ -1088,37 +1651,44 @@ def generate_preview():
         if not template_name or not theme:
             return jsonify({'error': 'テンプレート名とテーマを入力してください。'})
         
-        global PROMPT_TEMPLATES
-        PROMPT_TEMPLATES = load_prompt_templates()
+        prompt_templates = load_prompt_templates()
         
-        if template_name not in PROMPT_TEMPLATES:
+        if template_name not in prompt_templates:
             return jsonify({'error': 'テンプレートが見つかりません。'})
         
-        template = PROMPT_TEMPLATES[template_name]
-        
-        # プロンプトテンプレートを適用
-        prompt_content = template['content'].replace('{theme}', theme)
-        
-        # Perplexity APIを使用して記事を生成
-        client = PerplexityClient()
-        messages = [
-            {"role": "user", "content": prompt_content}
-        ]
-        
-        response = client.chat_completion(messages, model="sonar", max_tokens=1024)
+        template = prompt_templates[template_name]
         
-        if response:
-            generated_article = response.get('choices', [{}])[0].get('message', {}).get('content', '')
-            
-            return jsonify({
-                'success': True,
-                'article': generated_article
-            })
-        else:
-            return jsonify({'error': '記事の生成に失敗しました。'})
+        return _submit_llm_job('preview', {
+            'template_name': template_name,
+            'template_file': template['file'],
+            'theme': theme
+        })
             
     except Exception as e:
         return jsonify({'error': f'プレビュー生成でエラーが発生しました: {str(e)}'})
 
+def run_preview_generation(params, job):
+    """プレビュー用の記事を生成（ジョブ）"""
+    template = load_prompt_templates().get(params['template_name'])
+    if not template:
+        raise RuntimeError('テンプレートが見つかりません。')
+    
+    response = _generate_sample_article(template['content'], params['theme'], template['file'])
+    
+    return {
+        'success': True,
+        'article': _response_text(response)
+    }
+
+# LLMの応答を待つ処理（プロンプト生成・評価・プレビュー）はリクエストのスレッドを占有しないよう、ジョブとして実行する
+llm_jobs = JobManager(max_workers=int(os.getenv('BLOG_TOOL_LLM_JOBS', '4')), max_pending=50, listener=_save_job,
+                      cancel_check=_job_cancel_requested)
+llm_jobs.register('prompt_generation', run_prompt_generation)
+llm_jobs.register('evaluation', run_prompt_evaluation, template_param='template_file')
+llm_jobs.register('evaluation_comparison', run_prompt_comparison, template_param='template_file')
+llm_jobs.register('preview', run_preview_generation, template_param='template_file')
+llm_jobs.register('history_preview', run_history_preview, template_param='template_file')
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=8080)
+    # 開発用サーバー（本番は wsgi.py をWSGIサーバーで起動する）
+    create_app().run(debug=True, host='0.0.0.0', port=8080)
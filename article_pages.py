@@ -0,0 +1,231 @@
+import io
+import os
+import re
+import codecs
+
+# 記事を表示するときの1ページの大きさ（バイト）
+PAGE_BYTES = int(os.getenv('BLOG_TOOL_ARTICLE_PAGE_BYTES', str(256 * 1024)))
+# 1度に読み込んで画面に送る大きさ（バイト）
+CHUNK_BYTES = 16 * 1024
+# ページの境目をブロックの先頭に合わせるために先読みする最大バイト数
+ALIGN_BYTES = 64 * 1024
+# ブロックの先頭（空行の直後か、見出しで始まる行の先頭）。本文は |safe で表示するため、要素の途中でページを切らない
+_BLOCK_START = re.compile(rb'\n(?:\n|(?=<h[23][\s>]|#{2,3} ))')
+
+
+class _Reader:
+    """先読みした分を戻せる読み込み（ファイルと本文ストアの展開を同じように扱う）"""
+
+    def __init__(self, f):
+        self._f = f
+        self._pending = b''
+
+    def read(self, n):
+        if self._pending:
+            data, self._pending = self._pending[:n], self._pending[n:]
+            return data
+        return self._f.read(n)
+
+    def read_full(self, n):
+        """n バイト読む（終わりに達した場合を除き、短く返さない）"""
+        data = b''
+        while len(data) < n:
+            chunk = self.read(n - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def unread(self, data):
+        self._pending = data + self._pending
+
+    def skip(self, n):
+        """n バイト読み飛ばす（シークできる場合は読み込まない）"""
+        if not self._pending and n > 0 and self._f.seekable():
+            self._f.seek(n, os.SEEK_CUR)
+            return
+        while n > 0:
+            data = self.read(min(n, CHUNK_BYTES))
+            if not data:
+                break
+            n -= len(data)
+
+
+def _block_start(data, previous):
+    """
+    data の中で最初のブロックの先頭の位置（見つからない場合は -1）
+
+    ブロックの先頭は、空行の直後か、<h2>・<h3>（Markdown の ##・###）で始まる行の先頭とする。
+    previous は data の直前の2バイト（本文の先頭に近い場合は短い）。
+    """
+    offset = len(previous)
+    for match in _BLOCK_START.finditer(previous + data):
+        if match.end() >= offset:
+            return match.end() - offset
+    return -1
+
+
+def _boundary(reader, previous):
+    """
+    ページの境目までのバイト列を読む
+
+    境目は ALIGN_BYTES 以内の最初のブロックの先頭（_block_start）か、本文の終わりとする。どちらもない場合
+    （ひとつのブロックが長い場合）は直後の改行の次、改行もなければ次の文字の先頭にする。
+    previous は現在位置の直前の2バイト（先頭の場合は b''）。
+    """
+    if previous == b'':
+        return b''
+    data = reader.read_full(ALIGN_BYTES)
+    end = _block_start(data, previous)
+    if end < 0 and len(data) < ALIGN_BYTES:
+        end = len(data)
+    if end < 0:
+        end = 0 if previous.endswith(b'\n') else data.find(b'\n') + 1
+        if not end:
+            # UTF-8 の続きのバイト（10xxxxxx）の途中では切らない
+            while end < len(data) and data[end] & 0xC0 == 0x80:
+                end += 1
+    reader.unread(data[end:])
+    return data[:end]
+
+
+def _skip_to_page(reader, start):
+    """start バイト目から始まるページの先頭（境目）まで読み飛ばし、start から境目までのバイト数を返す"""
+    if start <= 0:
+        return 0
+    reader.skip(start - min(start, 2))
+    return len(_boundary(reader, reader.read_full(min(start, 2))))
+
+
+def iter_page(f, page, page_bytes=None):
+    """
+    本文の page ページ目（0 始まり）を文字列の断片で順に返す
+
+    ページは page_bytes バイトごとに区切り、境目は _boundary でブロックの先頭に合わせる。前後のページも同じ規則で
+    区切るため、ページをまたいで重なったり抜けたりしない。読み込むのはそのページと境目の先読み分だけで、
+    1度に持つのは CHUNK_BYTES 程度になる。
+
+    Args:
+        f: バイナリで開いた本文（read が使えるもの。seek が使える場合は前のページを読み飛ばさない）
+        page (int): ページ番号（0 始まり）
+        page_bytes (int): 1ページの大きさ（None の場合は PAGE_BYTES）
+    """
+    page_bytes = page_bytes or PAGE_BYTES
+    reader = _Reader(f)
+    # 前のページの終わりの境目までを読み飛ばす
+    remaining = page_bytes - _skip_to_page(reader, page * page_bytes)
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    previous = b''
+    while remaining > 0:
+        data = reader.read(min(remaining, CHUNK_BYTES))
+        if not data:
+            break
+        remaining -= len(data)
+        previous = (previous + data)[-2:]
+        text = decoder.decode(data)
+        if text:
+            yield text
+    tail = _boundary(reader, previous) if remaining <= 0 else b''
+    text = decoder.decode(tail, final=True)
+    if text:
+        yield text
+
+
+def page_count(size, page_bytes=None):
+    """size バイトの本文のページ数（空の場合も1）"""
+    page_bytes = page_bytes or PAGE_BYTES
+    return max(1, -(-size // page_bytes))
+
+
+class PagedText:
+    """
+    ページ単位で少しずつ読む本文
+
+    記事ファイル・本文ストア（blob_store.BlobStore）の本文・文字列を同じように扱い、画面には
+    iter_page / iter_text の断片をそのまま流す（stream_template）。本文全体は読み込まない。
+    """
+
+    def __init__(self, opener, size, page_bytes=None):
+        """
+        Args:
+            opener: 本文をバイナリで開く関数（with で使えるものを返す）
+            size (int): 本文の大きさ（バイト、UTF-8）
+            page_bytes (int): 1ページの大きさ（None の場合は PAGE_BYTES）
+        """
+        self._opener = opener
+        self.size = size
+        self.page_bytes = page_bytes or PAGE_BYTES
+        self._pages = None
+
+    @classmethod
+    def from_file(cls, path):
+        """記事ファイル（UTF-8）"""
+        return cls(lambda: open(path, 'rb'), os.path.getsize(path))
+
+    @classmethod
+    def from_value(cls, value, blobs):
+        """
+        履歴の項目（文字列、または本文ストアへの参照 {'$blob': ハッシュ, 'size': バイト数}）
+
+        本文ストアにない場合は FileNotFoundError（表示を始める前に分かるようにする）。
+        """
+        if isinstance(value, dict) and '$blob' in value:
+            digest = value['$blob']
+            size = value.get('size')
+            if size is None:
+                # 大きさを記録する前に保存した履歴
+                size = blobs.length(digest)
+            elif not blobs.exists(digest):
+                raise FileNotFoundError(blobs.path(digest))
+            return cls(lambda: blobs.open(digest), size)
+        data = (value or '').encode('utf-8')
+        return cls(lambda: io.BytesIO(data), len(data))
+
+    @property
+    def pages(self):
+        """
+        ページ数
+
+        最後のブロックは次のページに分けないため、末尾のページが空になる場合はそのページを数えない
+        （末尾の境目の先読み分だけを読む）。
+        """
+        if self._pages is None:
+            pages = page_count(self.size, self.page_bytes)
+            try:
+                while pages > 1:
+                    start = (pages - 1) * self.page_bytes
+                    with self._opener() as f:
+                        if start + _skip_to_page(_Reader(f), start) < self.size:
+                            break
+                    pages -= 1
+            except Exception as e:
+                print(f"本文の読み込みエラー: {e}")
+            self._pages = pages
+        return self._pages
+
+    def clamp(self, page):
+        """ページ番号（1 始まり）を範囲内に収める"""
+        return min(max(page, 1), self.pages)
+
+    def iter_page(self, page):
+        """page ページ目（1 始まり）の断片（表示中に読めなくなった場合はそこまで）"""
+        try:
+            with self._opener() as f:
+                yield from iter_page(f, page - 1, self.page_bytes)
+        except Exception as e:
+            print(f"本文の読み込みエラー: {e}")
+
+    def iter_text(self):
+        """本文全体の断片（ページに分けない）"""
+        try:
+            with self._opener() as f:
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                while True:
+                    data = f.read(CHUNK_BYTES)
+                    text = decoder.decode(data, final=not data)
+                    if text:
+                        yield text
+                    if not data:
+                        break
+        except Exception as e:
+            print(f"本文の読み込みエラー: {e}")
@@ -0,0 +1,173 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+from prompt_compiler import TemplateError, load_template
+from perplexity_client import PROMPT_FORMATS, PerplexityClient, build_article_messages
+from usage_ledger import cached_prompt_tokens, get_ledger, job_scope
+from metrics import percentile
+
+
+def load_themes(path):
+    """テーマを1行ずつ記載したファイル（空行と # で始まる行は除く）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+def _empty_stats():
+    return {'calls': 0, 'errors': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0,
+            'latencies': [], 'output_chars': 0, 'headings': 0}
+
+
+def compare_formats(client, template_file, themes, max_tokens=4096, variables=None, output_dir=None,
+                    formats=PROMPT_FORMATS):
+    """
+    テーマごとに各メッセージ形式で記事本文を生成し、入力トークン・所要時間・出力を比べる
+
+    形式を実行する順序はテーマごとに入れ替え、API 側の状態（直前の呼び出しなど）が片方にだけ有利に
+    働かないようにする。output_dir を指定すると、出力を <番号>_<形式>.txt として保存する（品質の比較用）。
+
+    Returns:
+        dict: {形式: {'calls', 'errors', 'prompt_tokens', 'cached_tokens', 'completion_tokens',
+                      'latencies', 'output_chars', 'headings'}}
+    """
+    template = load_template(template_file)
+    results = {prompt_format: _empty_stats() for prompt_format in formats}
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    for number, theme in enumerate(themes, 1):
+        order = formats if number % 2 else tuple(reversed(formats))
+        for prompt_format in order:
+            stats = results[prompt_format]
+            messages = build_article_messages(template, theme, variables, prompt_format)
+            started = time.perf_counter()
+            response = client.chat_completion(messages, model="sonar", max_tokens=max_tokens,
+                                              call_site="article", template=template_file)
+            elapsed = time.perf_counter() - started
+            stats['calls'] += 1
+            if not response:
+                stats['errors'] += 1
+                print(f"[{number}/{len(themes)}] {prompt_format}: ✗ {theme}")
+                continue
+            usage = response.get('usage') or {}
+            content = response.get('choices', [{}])[0].get('message', {}).get('content', '')
+            stats['prompt_tokens'] += int(usage.get('prompt_tokens') or 0)
+            stats['cached_tokens'] += cached_prompt_tokens(usage)
+            stats['completion_tokens'] += int(usage.get('completion_tokens') or 0)
+            stats['latencies'].append(elapsed)
+            stats['output_chars'] += len(content)
+            # 見出し（Markdown / HTML）の数: テンプレートの構成に従っているかの目安
+            stats['headings'] += len(re.findall(r'^#{2,3}\s|<h[23][\s>]', content, flags=re.MULTILINE))
+            if output_dir:
+                with open(os.path.join(output_dir, f"{number:03d}_{prompt_format}.txt"), 'w', encoding='utf-8') as f:
+                    f.write(f"{theme}\n\n{content}")
+            print(f"[{number}/{len(themes)}] {prompt_format}: ✓ {theme} "
+                  f"（入力 {usage.get('prompt_tokens', '-')} / 出力 {usage.get('completion_tokens', '-')} トークン、{elapsed:.1f}秒）")
+    return results
+
+
+def format_comparison(results):
+    """compare_formats の結果を表にする（single を基準にした入力トークンの削減率付き）"""
+    lines = [f"{'形式':<8}{'成功':>6}{'入力':>10}{'うち再利用':>10}{'出力':>10}{'p50':>8}{'p95':>8}{'文字数':>8}{'見出し':>7}"]
+
+    def average(stats, key):
+        ok = stats['calls'] - stats['errors']
+        return stats[key] / ok if ok else 0
+
+    for prompt_format, stats in results.items():
+        succeeded = f"{stats['calls'] - stats['errors']}/{stats['calls']}"
+        lines.append(f"{prompt_format:<8}{succeeded:>6}{average(stats, 'prompt_tokens'):>10.0f}"
+                     f"{average(stats, 'cached_tokens'):>10.0f}{average(stats, 'completion_tokens'):>10.0f}"
+                     f"{percentile(stats['latencies'], 50):>7.1f}s{percentile(stats['latencies'], 95):>7.1f}s"
+                     f"{average(stats, 'output_chars'):>8.0f}{average(stats, 'headings'):>7.1f}")
+    base, shared = results.get('single'), results.get('shared')
+    if base and shared and average(base, 'prompt_tokens') and average(shared, 'prompt_tokens'):
+        uncached = lambda stats: average(stats, 'prompt_tokens') - average(stats, 'cached_tokens')
+        saving = 1 - uncached(shared) / uncached(base)
+        lines.append(f"shared の入力トークン（再利用分を除く）: single 比 {saving:.1%} 削減" if saving >= 0
+                     else f"shared の入力トークン（再利用分を除く）: single 比 {-saving:.1%} 増加")
+    return '\n'.join(lines)
+
+
+def run_batch(themes, template_file, prompt_format='shared', status='draft', max_tokens=4096, variables=None):
+    """
+    同じテンプレートでテーマごとに記事を生成して投稿する
+
+    Returns:
+        dict: {'posted', 'failed', 'job_id', 'prompt_tokens', 'cached_tokens', 'completion_tokens'}
+    """
+    from integrated_blog_tool import IntegratedBlogTool
+
+    tool = IntegratedBlogTool()
+    tool.prompt_format = prompt_format
+    job_id = f"batch-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    report = {'posted': 0, 'failed': 0, 'job_id': job_id}
+    with job_scope(job_id, template=template_file):
+        for number, theme in enumerate(themes, 1):
+            print(f"[{number}/{len(themes)}] {theme}")
+            try:
+                result = tool.generate_and_post_article(theme, status, template_file, max_tokens, variables)
+            except Exception as e:
+                print(f"記事生成エラー: {e}")
+                result = None
+            report['posted' if result else 'failed'] += 1
+    # 使用量台帳からこのバッチの呼び出し（記事生成・画像検索を含む）を集計
+    records = [r for r in get_ledger().records() if r.get('job_id') == job_id]
+    for key in ('prompt_tokens', 'cached_tokens', 'completion_tokens'):
+        report[key] = sum(r.get(key, 0) for r in records)
+    return report
+
+
+def main():
+    """同じテンプレートを使う記事のまとめて生成・メッセージ形式の比較"""
+    parser = argparse.ArgumentParser(description='同じテンプレートで複数テーマの記事をまとめて生成')
+    parser.add_argument('themes', help='テーマを1行ずつ記載したファイル')
+    parser.add_argument('--template', default='prompt_template.txt', help='プロンプトテンプレートファイル')
+    parser.add_argument('--format', choices=PROMPT_FORMATS, default='shared',
+                        help='メッセージ形式（shared: 固定部分をシステムメッセージに分ける、single: 従来の1メッセージ）')
+    parser.add_argument('--status', default='draft', help='投稿ステータス（draft / publish）')
+    parser.add_argument('--max-tokens', type=int, default=4096, help='最大トークン数')
+    parser.add_argument('--var', action='append', default=[], metavar='名前=値',
+                        help='テーマ以外のテンプレート変数（例: --var ranking_count=20、複数指定可）')
+    parser.add_argument('--compare', action='store_true',
+                        help='投稿せず、テーマごとに single / shared の両方で本文を生成して比較する')
+    parser.add_argument('--out', help='--compare の出力と結果（summary.json）の保存先（既定: batch_results/<日時>）')
+    args = parser.parse_args()
+
+    themes = load_themes(args.themes)
+    if not themes:
+        print("テーマがありません。")
+        return
+    variables = dict(item.split('=', 1) for item in args.var if '=' in item)
+    try:
+        load_template(args.template)
+    except (OSError, TemplateError) as e:
+        print(f"テンプレートエラー: {e}")
+        sys.exit(1)
+
+    try:
+        if args.compare:
+            output_dir = args.out or os.path.join('batch_results', datetime.now().strftime('%Y%m%d_%H%M%S'))
+            results = compare_formats(PerplexityClient(), args.template, themes, args.max_tokens, variables, output_dir)
+            print("=" * 50)
+            print(format_comparison(results))
+            with open(os.path.join(output_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+                json.dump({'template': args.template, 'themes': themes, 'results': results}, f,
+                          ensure_ascii=False, indent=2)
+            print(f"出力と結果を {output_dir} に保存しました。")
+        else:
+            report = run_batch(themes, args.template, args.format, args.status, args.max_tokens, variables)
+            print("=" * 50)
+            print(f"投稿: {report['posted']}件  失敗: {report['failed']}件  （ジョブ {report['job_id']}）")
+            print(f"入力トークン: {report['prompt_tokens']}（うち再利用 {report['cached_tokens']}）  "
+                  f"出力トークン: {report['completion_tokens']}")
+    except ValueError as e:
+        print(f"設定エラー: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
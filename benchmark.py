@@ -0,0 +1,788 @@
+import io
+import os
+import re
+import sys
+import json
+import glob
+import math
+import time
+import subprocess
+import shutil
+import socket
+import argparse
+import importlib.util
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from image_prefetch import collect_ranked_titles, unique_titles
+from history_log import HistoryLog, get_history_log, iter_history_data, template_samples
+from prompt_compiler import compile_template
+from metrics import percentile
+
+# オフラインベンチマークの作業ディレクトリにコピーするファイル
+OFFLINE_FIXTURES = ('prompt_template.txt', 'anime_prompt.txt', 'custom_prompt.txt', 'prompt_*.txt',
+                    'article_history_*.json')
+
+
+def bench_cache(args):
+    """画像キャッシュのヒット率（生キー vs 正規化/あいまい一致）を比較"""
+    from image_cache import ImageCache
+
+    titles = collect_ranked_titles()
+    if not titles:
+        print("ランキング見出しが見つかりませんでした。")
+        return
+
+    # 従来方式: 見出し文字列をそのままキーにする
+    raw_cache = {}
+    raw_hits = 0
+    for _, _, title in titles:
+        if title in raw_cache:
+            raw_hits += 1
+        else:
+            raw_cache[title] = {'url': f'https://example.invalid/{len(raw_cache)}.jpg', 'source': None}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ImageCache(os.path.join(tmp, 'image_cache.json'), fuzzy_threshold=args.threshold)
+        for _, _, title in titles:
+            if cache.get(title) is None:
+                cache.set(title, {'url': f'https://example.invalid/{len(cache)}.jpg', 'source': None}, save=False)
+
+    total = len(titles)
+    print(f"対象見出し数: {total}")
+    print(f"従来（生キー）: ヒット {raw_hits} / {total} ({raw_hits / total:.1%})  解決回数 {len(raw_cache)}")
+    hits = total - cache.stats['miss']
+    print(f"正規化+あいまい一致: ヒット {hits} / {total} ({cache.hit_rate():.1%})  解決回数 {cache.stats['miss']}")
+    print(f"  内訳: {cache.stats}")
+
+
+def _print_latency(label, latencies, wall_seconds, counts=None, units=None):
+    """件数・スループット・p50/p95 と、1件あたりのリクエスト数を表示"""
+    n = len(latencies)
+    print(f"[{label}]")
+    if not n:
+        print("  実行結果がありません。")
+        return
+    print(f"  件数: {n}  所要時間: {wall_seconds:.2f}秒  スループット: {n / wall_seconds:.2f}件/秒")
+    print(f"  レイテンシ: p50 {percentile(latencies, 50) * 1000:.0f}ms  "
+          f"p95 {percentile(latencies, 95) * 1000:.0f}ms  最大 {max(latencies) * 1000:.0f}ms")
+    if counts:
+        per = units or n
+        total = sum(counts.values())
+        print(f"  リクエスト数（1件あたり）: {total / per:.1f}")
+        for route, count in sorted(counts.items()):
+            print(f"    {route:<18} {count / per:.1f}")
+
+
+@contextlib.contextmanager
+def _quiet(enabled):
+    """パイプライン内の print 出力を抑止"""
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def bench_offline(args):
+    """ローカルのスタンドインサーバーを相手に、記事生成の一連の処理を計測（APIトークンを消費しない）"""
+    from standin_servers import StandInServer, load_canned_articles
+
+    articles = load_canned_articles()
+    if not articles:
+        print("定型文に使う記事の生成履歴が見つかりませんでした。")
+        return
+
+    latency = {
+        'chat': args.llm_latency,
+        'search': args.search_latency,
+        'site': args.site_latency,
+        'wp': args.wp_latency,
+    }
+    with StandInServer(articles, latency) as server, _offline_workspace(server):
+        print(f"スタンドインサーバー: {server.base_url}  "
+              f"（遅延: チャット {args.llm_latency * 1000:.0f}ms / 検索 {args.search_latency * 1000:.0f}ms / "
+              f"公式サイト {args.site_latency * 1000:.0f}ms / WordPress {args.wp_latency * 1000:.0f}ms）")
+        print(f"定型記事: {len(articles)}件")
+        print("=" * 60)
+        _offline_resolver(server, args)
+        _offline_articles(server, args)
+        if args.routes:
+            _offline_routes(server, args)
+
+
+@contextlib.contextmanager
+def _offline_workspace(server):
+    """
+    フィクスチャをコピーした一時ディレクトリに移動し、接続先をスタンドインサーバーに向ける
+
+    実APIや本番のキャッシュ・台帳・状態に触れないよう、接続先と保存先をすべて差し替える。
+    """
+    source_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        for pattern in OFFLINE_FIXTURES:
+            for filename in glob.glob(pattern):
+                shutil.copy(filename, workdir)
+        # 生成履歴は写しを使い、計測中に生成した記事を本番の履歴に残さない
+        history_dir = get_history_log().directory
+        if os.path.isdir(history_dir):
+            get_history_log().sync()
+            shutil.copytree(history_dir, os.path.join(workdir, 'history'))
+
+        os.environ.update({
+            'PERPLEXITY_API_KEY': 'standin',
+            'PERPLEXITY_BASE_URL': server.perplexity_base_url,
+            'WP_URL': server.wp_url,
+            'USAGE_LEDGER_PATH': os.path.join(workdir, 'usage_ledger.jsonl'),
+            'USAGE_DAILY_TOKEN_LIMIT': '0',
+            'USAGE_JOB_TOKEN_LIMIT': '0',
+            'BLOG_TOOL_STATE_DB': os.path.join(workdir, 'app_state.sqlite3'),
+            'BLOG_TOOL_HISTORY_DIR': os.path.join(workdir, 'history'),
+            'NO_PROXY': ','.join(filter(None, [os.getenv('NO_PROXY'), '127.0.0.1', 'localhost'])),
+        })
+        os.environ.pop('BLOG_TOOL_TRACE_FILE', None)
+        os.chdir(workdir)
+        try:
+            yield workdir
+        finally:
+            os.chdir(source_dir)
+
+
+def _offline_resolver(server, args):
+    """履歴の全作品名を空のキャッシュから解決"""
+    from integrated_blog_tool import IntegratedBlogTool
+
+    titles = unique_titles(title for _, _, title in collect_ranked_titles())
+    with _quiet(not args.verbose):
+        tool = IntegratedBlogTool()
+    server.reset_counts()
+    started = time.perf_counter()
+    with _quiet(not args.verbose):
+        results = tool.search_anime_images(titles)
+    elapsed = time.perf_counter() - started
+    resolved = sum(1 for r in results.values() if r)
+    print(f"[画像検索] 作品数: {len(titles)}  解決: {resolved}  所要時間: {elapsed:.2f}秒")
+    counts = server.counts()
+    if titles:
+        print(f"  リクエスト数（1作品あたり）: {sum(counts.values()) / len(titles):.2f}")
+        for route, count in sorted(counts.items()):
+            print(f"    {route:<18} {count / len(titles):.2f}")
+    print(tool.image_resolver.format_stats())
+    # 記事生成の計測は空のキャッシュから始める
+    if os.path.exists(tool._image_cache_path):
+        os.remove(tool._image_cache_path)
+
+
+def _offline_articles(server, args):
+    """generate_and_post_article を並列に実行（記事ごとに新しいツール = Webアプリと同じ使い方）"""
+    from integrated_blog_tool import IntegratedBlogTool
+
+    def run(i):
+        started = time.perf_counter()
+        tool = IntegratedBlogTool()
+        result = tool.generate_and_post_article(f"ベンチマーク用アニメランキング{i}", 'draft',
+                                                'prompt_ランキング記事.txt', 4096)
+        return time.perf_counter() - started, bool(result)
+
+    server.reset_counts()
+    started = time.perf_counter()
+    with _quiet(not args.verbose), ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        outcomes = list(executor.map(run, range(args.articles)))
+    wall = time.perf_counter() - started
+    failed = sum(1 for _, ok in outcomes if not ok)
+    _print_latency(f"記事生成+投稿（同時実行 {args.concurrency}）", [t for t, _ in outcomes], wall,
+                   server.counts(), args.articles)
+    if failed:
+        print(f"  失敗: {failed}件")
+
+
+def _offline_routes(server, args):
+    """Flaskのルートを test_client 経由で実行"""
+    with _quiet(True):
+        import app as web
+
+    client = web.app.test_client()
+    server.reset_counts()
+    latencies = []
+    started = time.perf_counter()
+    with _quiet(not args.verbose):
+        for i in range(args.routes):
+            t0 = time.perf_counter()
+            client.post('/generate', json={'theme': f"ベンチマーク用アニメランキング{i}", 'prompt_type': 'ランキング記事'})
+            while client.get('/status').get_json()['is_generating']:
+                time.sleep(0.01)
+            latencies.append(time.perf_counter() - t0)
+    _print_latency("POST /generate → /status 完了まで", latencies, time.perf_counter() - started,
+                   server.counts(), args.routes)
+
+    for path in ('/', '/generation-history', '/usage', '/metrics'):
+        latencies = []
+        started = time.perf_counter()
+        with _quiet(not args.verbose):
+            for _ in range(args.page_requests):
+                t0 = time.perf_counter()
+                client.get(path)
+                latencies.append(time.perf_counter() - t0)
+        _print_latency(f"GET {path}", latencies, time.perf_counter() - started)
+
+
+# 負荷試験で編集者が使うテンプレート（作業ディレクトリに編集者ごとに作成）
+LOAD_TEMPLATE = 'prompt_load_editor{}.txt'
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _start_web_server(args, workdir, port):
+    """wsgi.py を gunicorn（またはスレッド付きの werkzeug）で別プロセスとして起動"""
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=source_dir, FLASK_SECRET_KEY='load-test')
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(source_dir, 'gunicorn.conf.py'),
+                   '--bind', f"127.0.0.1:{port}", '--workers', str(args.workers), '--threads', str(args.threads),
+                   'wsgi:app']
+    else:
+        command = [sys.executable, os.path.join(source_dir, 'wsgi.py'), '--port', str(port)]
+    output = None if args.verbose else subprocess.DEVNULL
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=output, stderr=output)
+
+
+def _wait_until_ready(base_url, process, timeout=30):
+    import requests
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            requests.get(f"{base_url}/status", timeout=1)
+            return True
+        except requests.RequestException:
+            time.sleep(0.1)
+    return False
+
+
+def _load_editor(base_url, editor, stop_at):
+    """
+    1人の編集者の操作を stop_at まで繰り返す
+
+    画面の閲覧・自分のテンプレートの編集・記事生成の開始と進捗確認・プレビュー（LLMジョブ）の登録を順に行う。
+    記事生成を開始できた直後の /status（別のワーカーが応答しうる）が生成中を返さなければ、
+    状態がワーカー間で共有されていないとみなして数える。
+    """
+    import requests
+
+    template = LOAD_TEMPLATE.format(editor).replace('prompt_', '').replace('.txt', '')
+    actions = [
+        ('GET /', lambda s: s.get(f"{base_url}/")),
+        ('GET /prompts', lambda s: s.get(f"{base_url}/prompts")),
+        ('POST /prompts/edit', lambda s: s.post(f"{base_url}/prompts/edit/{template}",
+                                                json={'content': f"{{theme}}について書いてください。{time.time()}"})),
+        ('GET /prompts/view', lambda s: s.get(f"{base_url}/prompts/view/{template}")),
+        ('GET /generation-history', lambda s: s.get(f"{base_url}/generation-history")),
+        ('POST /generate', lambda s: s.post(f"{base_url}/generate",
+                                            json={'theme': f"負荷試験{editor}", 'prompt_type': template})),
+        ('GET /status', lambda s: s.get(f"{base_url}/status")),
+        ('POST /prompts/preview/generate', lambda s: s.post(f"{base_url}/prompts/preview/generate",
+                                                            json={'template_name': template, 'theme': '負荷試験'})),
+    ]
+    latencies = {}
+    counts = {'errors': 0, 'rejected': 0, 'generations': 0, 'stale_status': 0}
+    session = requests.Session()
+    i = editor
+    while time.monotonic() < stop_at:
+        name, action = actions[i % len(actions)]
+        i += 1
+        t0 = time.perf_counter()
+        try:
+            response = action(session)
+        except requests.RequestException:
+            counts['errors'] += 1
+            continue
+        latencies.setdefault(name, []).append(time.perf_counter() - t0)
+        if response.status_code == 429:
+            # LLMジョブの実行待ちが上限に達した（過負荷時の想定どおりの拒否）
+            counts['rejected'] += 1
+        elif response.status_code >= 400:
+            counts['errors'] += 1
+        elif name == 'POST /generate' and 'message' in response.json():
+            counts['generations'] += 1
+            # 新しい接続で確認し、別のワーカーに振り分けられるようにする
+            if not requests.get(f"{base_url}/status").json().get('is_generating'):
+                counts['stale_status'] += 1
+    return latencies, counts
+
+
+def bench_load(args):
+    """gunicorn（複数ワーカー）で起動したWebアプリに、複数の編集者が同時に操作したときのスループットを計測"""
+    from standin_servers import StandInServer, load_canned_articles
+
+    if args.server == 'gunicorn' and importlib.util.find_spec('gunicorn') is None:
+        print("gunicorn がインストールされていません（pip install gunicorn）。--server werkzeug で1プロセスのまま計測できます。")
+        sys.exit(1)
+
+    latency = {'chat': args.llm_latency, 'search': 0.0, 'site': 0.0, 'wp': 0.0}
+    with StandInServer(load_canned_articles(), latency) as server, _offline_workspace(server) as workdir:
+        for editor in range(args.editors):
+            with open(LOAD_TEMPLATE.format(editor), 'w', encoding='utf-8') as f:
+                f.write('{theme}について書いてください。')
+
+        port = _free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        process = _start_web_server(args, workdir, port)
+        try:
+            if not _wait_until_ready(base_url, process):
+                print("Webアプリの起動に失敗しました（--verbose でログを表示）。")
+                sys.exit(1)
+            concurrency = f"{args.workers}ワーカー × {args.threads}スレッド" if args.server == 'gunicorn' else '1プロセス（スレッド）'
+            print(f"サーバー: {args.server}（{concurrency}）  編集者: {args.editors}人  時間: {args.duration:.0f}秒")
+            print("=" * 60)
+
+            stop_at = time.monotonic() + args.duration
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.editors) as executor:
+                outcomes = list(executor.map(lambda e: _load_editor(base_url, e, stop_at), range(args.editors)))
+            wall_seconds = time.perf_counter() - started
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    latencies = {}
+    totals = {}
+    for per_editor, counts in outcomes:
+        for name, values in per_editor.items():
+            latencies.setdefault(name, []).extend(values)
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + value
+    all_latencies = [v for values in latencies.values() for v in values]
+
+    _print_latency("全リクエスト", all_latencies, wall_seconds)
+    for name in sorted(latencies):
+        _print_latency(name, latencies[name], wall_seconds)
+    print("=" * 60)
+    print(f"エラー応答: {totals['errors']}件  混雑による拒否（429）: {totals['rejected']}件")
+    print(f"記事生成の開始: {totals['generations']}件（生成中は他の編集者の開始を拒否）")
+    print(f"開始直後に /status が生成中を返さなかった回数: {totals['stale_status']}件")
+
+    if not args.no_save:
+        record = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'revision': _git_revision(),
+                  'case': f"load:{args.server}", 'scale': args.editors,
+                  'seconds': percentile(all_latencies, 50), 'p95_seconds': percentile(all_latencies, 95),
+                  'throughput': len(all_latencies) / wall_seconds, 'workers': args.workers,
+                  'threads': args.threads, **totals}
+        with open(args.results, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        print(f"結果を {args.results} に追記しました。")
+
+
+# マイクロベンチマークの結果の保存先（実行ごとに追記）
+MICRO_RESULTS_FILE = 'benchmark_results.jsonl'
+
+
+def _scale_article(text, factor):
+    """記事を factor 回連結する（順位は通し番号に振り直し、見出しが重複しないようにする）"""
+    ranks = [int(n) for n in re.findall(r'第(\d+)位', text)]
+    step = max(ranks) if ranks else 0
+    parts = []
+    for i in range(factor):
+        offset = step * i
+        parts.append(re.sub(r'第(\d+)位', lambda m: f"第{int(m.group(1)) + offset}位", text) if offset else text)
+    return '\n'.join(parts)
+
+
+def _micro_inputs():
+    """生成履歴の記事本文（HTML）と blog_article_*.txt（Markdown）を入力として集める"""
+    from standin_servers import load_canned_articles
+
+    html = '\n'.join(a for a in load_canned_articles() if '<h3' in a)
+    markdown_parts = []
+    for filename in sorted(glob.glob('blog_article_*.txt')):
+        with open(filename, 'r', encoding='utf-8') as f:
+            markdown_parts.append(f.read())
+    return html, '\n'.join(markdown_parts)
+
+
+def _micro_cases(tool, html, markdown):
+    """(名前, 入力, 実行関数) の一覧"""
+    fenced = f"```html\n<h1>ベンチマーク記事</h1>\n{html}\n```"
+    with_images = tool.add_images_to_anime_ranking(html)
+
+    def extract_article(text):
+        # generate_article_content と同じ順でコードフェンス除去・タイトル抽出・本文抽出
+        article_text = tool._strip_code_fence(text)
+        tool._extract_title(article_text, 'ベンチマーク')
+        return tool._extract_body_html(article_text)
+
+    # プロンプトテンプレート: 記事の各行に {theme} を入れたもの（記事中の波括弧はエスケープ）
+    template_text = html.replace('{', '{{').replace('}', '}}').replace('\n', '{theme}\n')
+    compiled = compile_template(template_text, 'benchmark')
+
+    return [
+        ('convert_to_html', markdown, tool._convert_to_html),
+        ('extract_article', fenced, extract_article),
+        ('add_images', html, tool.add_images_to_anime_ranking),
+        ('add_images_markdown', markdown, tool.add_images_to_anime_ranking),
+        ('inject_toc', with_images, tool._inject_rank_title_toc),
+        ('postprocess_html', with_images, tool._postprocess_html),
+        ('compile_template', template_text, compile_template),
+        ('render_template', template_text, lambda text: compiled.render(theme='ベンチマーク')),
+    ]
+
+
+def _time_call(func, arg, min_time):
+    """min_time 秒以上になるまで繰り返し、1回あたりの最短時間（秒）を返す"""
+    best = float('inf')
+    total = 0.0
+    runs = 0
+    while total < min_time or runs < 3:
+        started = time.perf_counter()
+        func(arg)
+        elapsed = time.perf_counter() - started
+        best = min(best, elapsed)
+        total += elapsed
+        runs += 1
+    return best, runs
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _previous_micro_results(path):
+    """前回までの結果（関数名・倍率ごとの最新値）"""
+    previous = {}
+    if not os.path.exists(path):
+        return previous
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            previous[(record.get('case'), record.get('scale'))] = record
+    return previous
+
+
+def bench_micro(args):
+    """HTML/正規表現の後処理関数・プロンプトテンプレートの解析と描画を記事サイズ 1x/10x/100x で計測し、非線形な増加を検出"""
+    from integrated_blog_tool import IntegratedBlogTool
+
+    class StubImageTool(IntegratedBlogTool):
+        """API・キャッシュを使わず、全作品に固定の画像を返すツール"""
+
+        def __init__(self):
+            pass
+
+        def search_anime_images(self, anime_titles):
+            return {
+                title: {'url': f"https://example.invalid/kv/{i}.jpg", 'source': 'https://example.invalid/'}
+                for i, title in enumerate(anime_titles)
+            }
+
+    html, markdown = _micro_inputs()
+    if not html:
+        print("入力に使う記事の生成履歴が見つかりませんでした。")
+        return
+
+    tool = StubImageTool()
+    scales = sorted(set(args.scales))
+    previous = _previous_micro_results(args.results)
+    revision = _git_revision()
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    records = []
+    flagged = []
+
+    print(f"{'関数':<20}{'倍率':>6}{'入力':>10}{'時間':>12}{'前回比':>9}{'次数':>7}")
+    for scale in scales:
+        with _quiet(True):
+            cases = _micro_cases(tool, _scale_article(html, scale), _scale_article(markdown, scale))
+        for name, text, func in cases:
+            if args.case and name not in args.case:
+                continue
+            with _quiet(True):
+                seconds, runs = _time_call(func, text, args.min_time)
+            record = {'timestamp': timestamp, 'revision': revision, 'case': name, 'scale': scale,
+                      'input_chars': len(text), 'seconds': seconds, 'runs': runs}
+
+            # 1x からの伸びを次数（時間 ∝ サイズ^次数）として推定
+            base = next((r for r in records if r['case'] == name and r['scale'] == scales[0]), None)
+            exponent = None
+            if base and scale > scales[0] and base['seconds'] > 0:
+                exponent = math.log(seconds / base['seconds']) / math.log(len(text) / base['input_chars'])
+                record['exponent'] = round(exponent, 2)
+                if exponent > args.max_exponent:
+                    flagged.append(record)
+            records.append(record)
+
+            before = previous.get((name, scale))
+            change = f"{(seconds / before['seconds'] - 1) * 100:+.0f}%" if before and before.get('seconds') else '-'
+            print(f"{name:<20}{scale:>5}x{len(text):>10}{seconds * 1000:>10.2f}ms{change:>9}"
+                  f"{(f'{exponent:.2f}' if exponent is not None else '-'):>7}")
+
+    if not args.no_save:
+        with open(args.results, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        print(f"結果を {args.results} に追記しました。")
+
+    if flagged:
+        print(f"⚠ 入力サイズに対して非線形に増加しています（次数 > {args.max_exponent}）:")
+        for record in flagged:
+            print(f"  {record['case']} {record['scale']}x: 次数 {record['exponent']}")
+        sys.exit(2)
+
+
+# 起動時間を計測するエントリポイントと、使用方法を表示してすぐ終了する引数
+STARTUP_TARGETS = {
+    'perplexity_client': [],
+    'integrated_blog_tool': [],
+    'image_prefetch': ['--help'],
+}
+
+
+def _parse_importtime(stderr):
+    """-X importtime の出力を [(モジュール名, 自身の時間μs, 累積時間μs, 深さ), ...] に変換"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            parts = line[len('import time:'):].split('|')
+            self_us, cumulative_us, raw_name = int(parts[0]), int(parts[1]), parts[2]
+        except (ValueError, IndexError):
+            continue
+        depth = (len(raw_name) - len(raw_name.lstrip(' ')) - 1) // 2
+        rows.append((raw_name.strip(), self_us, cumulative_us, depth))
+    return rows
+
+
+def _run_python(args, runs):
+    """Pythonをサブプロセスで runs 回実行し、所要時間（秒）のリストと最後の stderr を返す"""
+    times = []
+    stderr = ''
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    for _ in range(runs):
+        started = time.perf_counter()
+        completed = subprocess.run([sys.executable] + args, capture_output=True, text=True, env=env)
+        times.append(time.perf_counter() - started)
+        stderr = completed.stderr
+    return times, stderr
+
+
+def bench_startup(args):
+    """CLIエントリポイントの起動時間（import時間の内訳とプロセス全体）を計測"""
+    targets = args.target or list(STARTUP_TARGETS)
+    baseline, _ = _run_python(['-c', 'pass'], args.runs)
+    baseline_ms = percentile(baseline, 50) * 1000
+    print(f"Python自体の起動: {baseline_ms:.0f}ms（中央値、{args.runs}回）")
+    print("=" * 60)
+
+    revision = _git_revision()
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    records = []
+    over_budget = []
+    for target in targets:
+        # import時間の内訳（-X importtime）
+        _, stderr = _run_python(['-X', 'importtime', '-c', f'import {target}'], 1)
+        rows = _parse_importtime(stderr)
+        # 出力は子→親の順のため、対象モジュールの行から遡って直前のトップレベルまでがその内訳
+        position = next((i for i, r in enumerate(rows) if r[0] == target and r[3] == 0), None)
+        own = rows[position] if position is not None else None
+        subtree = []
+        if position is not None:
+            for row in reversed(rows[:position + 1]):
+                if row[3] == 0 and row is not own:
+                    break
+                subtree.append(row)
+
+        # CLI全体（使用方法を表示して終了するまで）の所要時間
+        wall, _ = _run_python([f'{target}.py'] + STARTUP_TARGETS.get(target, []), args.runs)
+        wall_ms = percentile(wall, 50) * 1000
+        overhead_ms = wall_ms - baseline_ms
+
+        print(f"[{target}]")
+        if own:
+            print(f"  import: {own[2] / 1000:.1f}ms")
+        print(f"  CLI起動（Python自体を除く）: {overhead_ms:.0f}ms  （全体 {wall_ms:.0f}ms、予算 {args.budget_ms:.0f}ms）")
+        if args.top:
+            print("  import時間の大きいモジュール（自身の時間）:")
+            for name, self_us, cumulative_us, _ in sorted(subtree, key=lambda r: r[1], reverse=True)[:args.top]:
+                print(f"    {name:<32}{self_us / 1000:>8.1f}ms  （累積 {cumulative_us / 1000:.1f}ms）")
+        if overhead_ms > args.budget_ms:
+            over_budget.append((target, overhead_ms))
+        records.append({'timestamp': timestamp, 'revision': revision, 'case': f"startup:{target}", 'scale': 1,
+                        'seconds': overhead_ms / 1000, 'import_seconds': own[2] / 1e6 if own else None,
+                        'runs': args.runs})
+
+    if not args.no_save:
+        with open(args.results, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        print(f"結果を {args.results} に追記しました。")
+
+    if over_budget:
+        print(f"⚠ 起動時間が予算（{args.budget_ms:.0f}ms）を超えています:")
+        for target, overhead_ms in over_budget:
+            print(f"  {target}: {overhead_ms:.0f}ms")
+        sys.exit(2)
+
+
+def _history_formats(tmp, train_samples):
+    """(名前, 保存関数, 読み込み関数, サイズ関数) の一覧。保存関数は1件を保存して読み込み用のキーを返す"""
+    legacy_dir = os.path.join(tmp, 'legacy')
+    os.makedirs(legacy_dir)
+
+    def save_legacy(index, kind, data):
+        # 以前の形式: 1件1ファイル、indent=2 の JSON
+        path = os.path.join(legacy_dir, f"{kind}_history_{index:06d}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        return path
+
+    def load_legacy(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    formats = [('個別ファイル（indent=2）', save_legacy, load_legacy,
+                lambda: sum(os.path.getsize(os.path.join(legacy_dir, f)) for f in os.listdir(legacy_dir)))]
+    for name, codec, trained in (('ログ（JSON）', 'none', False), ('ログ（zlib）', 'zlib', False),
+                                 ('ログ（zlib＋辞書）', 'zlib', True)):
+        log = HistoryLog(os.path.join(tmp, name), codec=codec)
+        if trained:
+            log.train_dictionary(train_samples)
+
+        def size(log=log):
+            log.sync()
+            return sum(os.path.getsize(log.segment_path(s)) for s in log._segments()) + log.blobs.size()
+        formats.append((name, lambda index, kind, data, log=log: log.append(kind, data), log.get, size))
+    return formats
+
+
+def bench_history(args):
+    """生成履歴の保存形式ごとのサイズ（ログは本文ストアを含む）と、1件の保存・読み込み時間を比較"""
+    records = [(kind, data) for kind in ('article', 'prompt', 'evaluation') for _, data in iter_history_data(kind)]
+    if not records:
+        print("生成履歴が見つかりませんでした。")
+        return
+    records.sort(key=lambda r: r[1].get('created_at') or '')
+    # 辞書は古い半分とテンプレートから作り、新しい半分（辞書にない履歴）で計測する
+    split = len(records) // 2 if len(records) >= 4 else 0
+    train_samples = [json.dumps(data, ensure_ascii=False) for _, data in records[:split]] + template_samples()
+    measured = records[split:]
+
+    print(f"計測する履歴: {len(measured)}件（辞書の学習: {split}件＋テンプレート）  読み込み: 各{args.repeat}回")
+    print("=" * 60)
+    print(f"{'形式':<18}{'サイズ':>10}{'比率':>8}{'保存 p50':>10}{'読込 p50':>10}{'読込 p95':>10}")
+
+    revision = _git_revision()
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    records_out = []
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, save, load, size in _history_formats(tmp, train_samples):
+            write_times = []
+            keys = []
+            for index, (kind, data) in enumerate(measured):
+                started = time.perf_counter()
+                keys.append(save(index, kind, data))
+                write_times.append(time.perf_counter() - started)
+            read_times = []
+            for _ in range(args.repeat):
+                for key, (_, data) in zip(keys, measured):
+                    started = time.perf_counter()
+                    loaded = load(key)
+                    read_times.append(time.perf_counter() - started)
+                    if loaded != data:
+                        print(f"⚠ {name}: 読み込んだ内容が一致しません")
+            total_bytes = size()
+            baseline = baseline or total_bytes
+            print(f"{name:<18}{total_bytes / 1024:>8.1f}KB{total_bytes / baseline:>8.2f}"
+                  f"{percentile(write_times, 50) * 1000:>8.2f}ms{percentile(read_times, 50) * 1000:>8.2f}ms"
+                  f"{percentile(read_times, 95) * 1000:>8.2f}ms")
+            records_out.append({'timestamp': timestamp, 'revision': revision, 'case': f"history:{name}",
+                                'scale': len(measured), 'seconds': percentile(read_times, 50),
+                                'p95_seconds': percentile(read_times, 95),
+                                'write_seconds': percentile(write_times, 50), 'bytes': total_bytes})
+
+    if not args.no_save:
+        with open(args.results, 'a', encoding='utf-8') as f:
+            for record in records_out:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        print(f"結果を {args.results} に追記しました。")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ブログツールのベンチマーク')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p_cache = subparsers.add_parser('cache', help='画像キャッシュのヒット率を計測')
+    p_cache.add_argument('--threshold', type=float, default=0.8, help='あいまい一致の閾値')
+    p_cache.set_defaults(func=bench_cache)
+
+    p_offline = subparsers.add_parser('offline', help='ローカルのスタンドインサーバーで記事生成を計測（APIトークン不要）')
+    p_offline.add_argument('--articles', type=int, default=6, help='生成する記事数')
+    p_offline.add_argument('--concurrency', type=int, default=2, help='記事生成の同時実行数')
+    p_offline.add_argument('--routes', type=int, default=2, help='Flask の /generate を実行する回数（0で省略）')
+    p_offline.add_argument('--page-requests', type=int, default=20, help='画面ごとのGETリクエスト数')
+    p_offline.add_argument('--llm-latency', type=float, default=0.2, help='チャットAPIの応答遅延（秒）')
+    p_offline.add_argument('--search-latency', type=float, default=0.05, help='Search APIの応答遅延（秒）')
+    p_offline.add_argument('--site-latency', type=float, default=0.02, help='公式サイトの応答遅延（秒）')
+    p_offline.add_argument('--wp-latency', type=float, default=0.05, help='WordPress APIの応答遅延（秒）')
+    p_offline.add_argument('--verbose', action='store_true', help='処理中のログを表示')
+    p_offline.set_defaults(func=bench_offline)
+
+    p_micro = subparsers.add_parser('micro', help='HTML後処理関数・テンプレート描画のマイクロベンチマーク（1x/10x/100x）')
+    p_micro.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help='記事サイズの倍率')
+    p_micro.add_argument('--case', action='append', help='計測する関数（複数指定可、省略時はすべて）')
+    p_micro.add_argument('--min-time', type=float, default=0.2, help='1計測あたりの最短実行時間（秒）')
+    p_micro.add_argument('--max-exponent', type=float, default=1.3, help='この次数を超えたら非線形として警告')
+    p_micro.add_argument('--results', default=MICRO_RESULTS_FILE, help='結果の追記先（JSON Lines）')
+    p_micro.add_argument('--no-save', action='store_true', help='結果を保存しない')
+    p_micro.set_defaults(func=bench_micro)
+
+    p_startup = subparsers.add_parser('startup', help='CLIエントリポイントの起動時間を計測（-X importtime の内訳付き）')
+    p_startup.add_argument('--target', action='append', help=f"計測するモジュール（省略時: {', '.join(STARTUP_TARGETS)}）")
+    p_startup.add_argument('--runs', type=int, default=5, help='起動を繰り返す回数（中央値を採用）')
+    p_startup.add_argument('--budget-ms', type=float, default=100.0, help='Python自体の起動を除いた起動時間の予算（ミリ秒）')
+    p_startup.add_argument('--top', type=int, default=8, help='表示するimport時間上位のモジュール数')
+    p_startup.add_argument('--results', default=MICRO_RESULTS_FILE, help='結果の追記先（JSON Lines）')
+    p_startup.add_argument('--no-save', action='store_true', help='結果を保存しない')
+    p_startup.set_defaults(func=bench_startup)
+
+    p_load = subparsers.add_parser('load', help='複数の編集者が同時に操作したときのWebアプリのスループットを計測')
+    p_load.add_argument('--server', choices=['gunicorn', 'werkzeug'], default='gunicorn', help='WSGIサーバー')
+    p_load.add_argument('--workers', type=int, default=4, help='gunicorn のワーカープロセス数')
+    p_load.add_argument('--threads', type=int, default=8, help='gunicorn のワーカーあたりのスレッド数')
+    p_load.add_argument('--editors', type=int, default=8, help='同時に操作する編集者の数')
+    p_load.add_argument('--duration', type=float, default=10.0, help='計測時間（秒）')
+    p_load.add_argument('--llm-latency', type=float, default=0.5, help='チャットAPIの応答遅延（秒）')
+    p_load.add_argument('--results', default=MICRO_RESULTS_FILE, help='結果の追記先（JSON Lines）')
+    p_load.add_argument('--no-save', action='store_true', help='結果を保存しない')
+    p_load.add_argument('--verbose', action='store_true', help='Webアプリのログを表示')
+    p_load.set_defaults(func=bench_load)
+
+    p_history = subparsers.add_parser('history', help='生成履歴の保存形式ごとのサイズと保存・読み込み時間を比較')
+    p_history.add_argument('--repeat', type=int, default=20, help='1件あたりの読み込み回数')
+    p_history.add_argument('--results', default=MICRO_RESULTS_FILE, help='結果の追記先（JSON Lines）')
+    p_history.add_argument('--no-save', action='store_true', help='結果を保存しない')
+    p_history.set_defaults(func=bench_history)
+
+    args = parser.parse_args()
+    if not getattr(args, 'func', None):
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
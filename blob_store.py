@@ -0,0 +1,203 @@
+import os
+import zlib
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+
+
+def content_hash(text):
+    """本文のハッシュ（SHA-256、UTF-8）"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# 本文を少しずつ展開するときに1度に読み込む大きさ（バイト、圧縮後）
+READ_BYTES = 16 * 1024
+
+
+class BlobReader:
+    """
+    保存された本文を少しずつ展開して読む（read と close のみ、シークはできない）
+
+    展開後の大きさは read に指定した分までに抑えるため、本文が大きくても使うメモリは増えない。
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b''
+
+    def read(self, n=-1):
+        """展開後の本文を最大 n バイト返す（n を省略した場合は残り全部、終わりでは b''）"""
+        chunks = [self._buffer]
+        size = len(self._buffer)
+        while (n < 0 or size < n) and not self._decompressor.eof:
+            compressed = self._decompressor.unconsumed_tail or self._f.read(READ_BYTES)
+            if not compressed:
+                break
+            data = self._decompressor.decompress(compressed, n - size if n >= 0 else 0)
+            chunks.append(data)
+            size += len(data)
+        data = b''.join(chunks)
+        if n < 0:
+            self._buffer = b''
+            return data
+        self._buffer = data[n:]
+        return data[:n]
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BlobStore:
+    """
+    プロンプトや記事本文を内容のハッシュで保存するストア
+
+    本文は blobs/<先頭2文字>/<ハッシュ>.z に zlib で圧縮して保存する。同じ内容は同じファイルになるため、
+    何度保存しても1つ分の容量で済み、保存済みかどうかはハッシュから直接確認できる。
+    名前（テンプレートのファイル名など）からハッシュへの対応は refs.sqlite3 に持つ。
+    """
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (str): 保存先
+        """
+        self.directory = directory
+        self.refs_path = os.path.join(directory, 'refs.sqlite3')
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.refs_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS refs ('
+                         'name TEXT PRIMARY KEY, hash TEXT NOT NULL, updated_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS refs_hash ON refs (hash)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # --- 本文 ---
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], f"{digest}.z")
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, text):
+        """
+        本文を保存してハッシュを返す（保存済みの内容は書き込まない）
+
+        Returns:
+            str: 本文のハッシュ
+        """
+        digest = content_hash(text)
+        path = self.path(digest)
+        if os.path.exists(path):
+            # 未参照の本文の削除（remove_unreferenced）の対象にならないよう、保存し直した時刻にする
+            os.utime(path)
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 同じ内容を複数のプロセスが同時に保存しても壊れないよう、一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(text.encode('utf-8'), 9))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest
+
+    def get(self, digest):
+        """ハッシュから本文を読み込む（ない場合は FileNotFoundError）"""
+        with open(self.path(digest), 'rb') as f:
+            return zlib.decompress(f.read()).decode('utf-8')
+
+    def open(self, digest):
+        """ハッシュの本文を少しずつ展開して読むファイル（ない場合は FileNotFoundError）"""
+        return BlobReader(open(self.path(digest), 'rb'))
+
+    def length(self, digest):
+        """本文の大きさ（バイト、展開後）。本文全体は読み込まず、展開しながら数える"""
+        size = 0
+        with self.open(digest) as f:
+            while True:
+                data = f.read(READ_BYTES)
+                if not data:
+                    return size
+                size += len(data)
+
+    def digests(self):
+        """保存されている本文のハッシュ"""
+        if not os.path.isdir(self.directory):
+            return []
+        return [name[:-2] for sub in os.listdir(self.directory) if len(sub) == 2
+                for name in os.listdir(os.path.join(self.directory, sub)) if name.endswith('.z')]
+
+    def size(self):
+        """本文の合計サイズ（バイト、圧縮後）"""
+        return sum(os.path.getsize(self.path(digest)) for digest in self.digests())
+
+    def remove_unreferenced(self, referenced, min_age=3600):
+        """
+        referenced にも名前の対応にも含まれない本文を削除
+
+        保存してから名前を対応づけるまでの間に消さないよう、min_age 秒以内に保存したものは残す。
+
+        Returns:
+            int: 削除した件数
+        """
+        keep = set(referenced)
+        keep.update(row[0] for row in self._connect().execute('SELECT DISTINCT hash FROM refs'))
+        removed = 0
+        for digest in self.digests():
+            path = self.path(digest)
+            if digest not in keep and time.time() - os.path.getmtime(path) >= min_age:
+                os.remove(path)
+                removed += 1
+        return removed
+
+    # --- 名前 ---
+
+    def link(self, name, digest):
+        """名前をハッシュに対応づける（既存の対応は置き換える）"""
+        self._connect().execute('INSERT OR REPLACE INTO refs (name, hash, updated_at) VALUES (?, ?, ?)',
+                                (name, digest, time.time()))
+
+    def unlink(self, name):
+        self._connect().execute('DELETE FROM refs WHERE name = ?', (name,))
+
+    def resolve(self, name):
+        """名前に対応するハッシュ（ない場合は None）"""
+        row = self._connect().execute('SELECT hash FROM refs WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def names(self, prefix=''):
+        """prefix で始まる名前とハッシュの対応"""
+        return dict(self._connect().execute(
+            'SELECT name, hash FROM refs WHERE substr(name, 1, ?) = ?', (len(prefix), prefix)).fetchall())
+
+    def names_for(self, digest, prefix=''):
+        """ハッシュに対応づけられた名前（prefix で始まるもの）"""
+        return [row[0] for row in self._connect().execute(
+            'SELECT name FROM refs WHERE hash = ? AND substr(name, 1, ?) = ? ORDER BY updated_at',
+            (digest, len(prefix), prefix))]
@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# 接続の確立を待つ最大秒数（HTTP のタイムアウトは (接続, 読み込み) の組で指定する）
+CONNECT_TIMEOUT = 10
+# 取り消しを確認する間隔（秒）
+POLL_SECONDS = 0.5
+
+# 実行中のジョブの期限（deadline_scope で設定）
+_current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """ジョブの期限を過ぎた"""
+
+
+class JobCancelled(Exception):
+    """ジョブが取り消された"""
+
+
+def job_deadline_seconds():
+    """ジョブの期限の既定値（BLOG_TOOL_JOB_DEADLINE 秒、0 の場合は期限なし）"""
+    return float(os.getenv('BLOG_TOOL_JOB_DEADLINE', '900') or 0)
+
+
+def llm_timeout():
+    """LLM の1回の呼び出しを待つ最大秒数（BLOG_TOOL_LLM_TIMEOUT）"""
+    return float(os.getenv('BLOG_TOOL_LLM_TIMEOUT', '300'))
+
+
+def wp_timeout():
+    """WordPress への投稿を待つ最大秒数（BLOG_TOOL_WP_TIMEOUT）"""
+    return float(os.getenv('BLOG_TOOL_WP_TIMEOUT', '60'))
+
+
+def post_reserve_seconds():
+    """投稿のために残しておく秒数（残りがこれを下回ると画像検索を省略する、BLOG_TOOL_POST_RESERVE）"""
+    return float(os.getenv('BLOG_TOOL_POST_RESERVE', '30'))
+
+
+class Deadline:
+    """
+    ジョブの期限と取り消し
+
+    各処理（LLM 呼び出し・画像検索・公式サイトの取得・WordPress への投稿）は current_deadline() の
+    残り時間をタイムアウトに使い、取り消されていれば JobCancelled、期限を過ぎていれば DeadlineExceeded で
+    止まる。入れ子の Deadline は外側の残り時間と取り消しも引き継ぐ。
+    """
+
+    def __init__(self, seconds=None, cancel_check=None, parent=None):
+        """
+        Args:
+            seconds (float): 期限までの秒数（None・0 の場合は期限なし）
+            cancel_check (callable): 取り消されたかを返す関数（別のプロセスからの取り消しなど。POLL_SECONDS ごとに確認）
+            parent (Deadline): 外側の期限
+        """
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        self._cancel_check = cancel_check
+        self._parent = parent
+        self._cancelled = threading.Event()
+        self._checked_at = 0.0
+
+    @property
+    def bounded(self):
+        """期限か取り消しの手段があるか"""
+        return (self.expires_at is not None or self._cancel_check is not None or self._cancelled.is_set()
+                or (self._parent is not None and self._parent.bounded))
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        if self._cancelled.is_set():
+            return True
+        if self._parent is not None and self._parent.cancelled:
+            return True
+        if self._cancel_check is not None and time.monotonic() - self._checked_at >= POLL_SECONDS:
+            self._checked_at = time.monotonic()
+            try:
+                if self._cancel_check():
+                    self._cancelled.set()
+            except Exception as e:
+                print(f"取り消しの確認エラー: {e}")
+        return self._cancelled.is_set()
+
+    def remaining(self):
+        """期限までの秒数（期限がない場合は None）"""
+        remaining = None if self.expires_at is None else max(0.0, self.expires_at - time.monotonic())
+        parent = self._parent.remaining() if self._parent is not None else None
+        if parent is not None and (remaining is None or parent < remaining):
+            return parent
+        return remaining
+
+    def check(self, stage=''):
+        """取り消されていれば JobCancelled、期限を過ぎていれば DeadlineExceeded を送出する"""
+        label = f"{stage}: " if stage else ''
+        if self.cancelled:
+            raise JobCancelled(f"{label}ジョブが取り消されました。")
+        if self.remaining() == 0:
+            raise DeadlineExceeded(f"{label}ジョブの期限を過ぎました。")
+
+    def allows(self, seconds):
+        """残り時間が seconds より長いか（取り消された場合は False。省略できる処理を続けるかの判断に使う）"""
+        if self.cancelled:
+            return False
+        remaining = self.remaining()
+        return remaining is None or remaining > seconds
+
+    def timeout(self, seconds, stage=''):
+        """
+        HTTP リクエストのタイムアウト (接続, 読み込み)（seconds と残り時間の短い方）
+
+        取り消された場合・期限を過ぎた場合は check と同じ例外を送出する。
+        """
+        self.check(stage)
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        return (min(CONNECT_TIMEOUT, seconds), seconds)
+
+    def call(self, func, *args, **kwargs):
+        """
+        func を実行し、途中で取り消された場合は結果を待たずに JobCancelled を送出する
+
+        期限・取り消しがない場合はそのまま呼ぶ。それ以外は別のスレッドで実行して POLL_SECONDS ごとに
+        取り消しを確認する（実行中の HTTP リクエストは止められないため、結果を捨てる）。期限は func に
+        渡すタイムアウト（timeout）で守る。
+        """
+        if not self.bounded:
+            return func(*args, **kwargs)
+        outcome = {}
+        finished = threading.Event()
+        context = contextvars.copy_context()
+
+        def target():
+            try:
+                outcome['value'] = context.run(func, *args, **kwargs)
+            except BaseException as e:
+                outcome['error'] = e
+            finally:
+                finished.set()
+
+        threading.Thread(target=target, name='deadline-call', daemon=True).start()
+        while not finished.wait(POLL_SECONDS):
+            if self.cancelled:
+                raise JobCancelled("ジョブが取り消されました。")
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['value']
+
+
+# 期限のない処理（ジョブの外からの呼び出し）
+NO_DEADLINE = Deadline()
+
+
+def current_deadline():
+    """実行中のジョブの期限（ジョブの外では期限なし）"""
+    return _current_deadline.get() or NO_DEADLINE
+
+
+@contextmanager
+def deadline_scope(seconds=None, cancel_check=None):
+    """
+    ジョブの期限を設定するスコープ（外側のスコープがあれば、その残り時間と取り消しも引き継ぐ）
+
+    Args:
+        seconds (float): 期限までの秒数（None・0 の場合はこのスコープでは期限を設けない）
+        cancel_check (callable): 取り消されたかを返す関数
+    """
+    deadline = Deadline(seconds, cancel_check, parent=_current_deadline.get())
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
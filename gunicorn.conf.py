@@ -0,0 +1,29 @@
+import os
+import multiprocessing
+
+# gunicorn の設定（gunicorn -c gunicorn.conf.py wsgi:app）
+# 値はすべて環境変数で上書きできる。
+
+bind = os.getenv('BLOG_TOOL_BIND', '127.0.0.1:8080')
+
+# ワーカープロセス数。画面の状態は StateStore（SQLite）で共有するため複数にしてよい。
+# 処理の大半はAPIの応答待ちなので、CPUコア数程度で十分。
+workers = int(os.getenv('WEB_CONCURRENCY', str(min(4, multiprocessing.cpu_count()))))
+
+# 記事生成はリクエストとは別のスレッドで動くため、スレッド付きワーカー（gthread）を使う。
+# LLMを使う処理はジョブとして202を返すので、スレッドは複数の編集者の画面表示・進捗確認と、
+# 長い記事・履歴をストリーミングで返している間も他の画面を返すためのもの。
+worker_class = 'gthread'
+threads = int(os.getenv('BLOG_TOOL_THREADS', '8'))
+
+# 大きな記事・履歴のストリーミングが遅い回線で長引くことがあるため、既定の30秒より長くする
+timeout = int(os.getenv('BLOG_TOOL_TIMEOUT', '180'))
+# 停止・再起動時に処理中のリクエストを待つ時間
+graceful_timeout = int(os.getenv('BLOG_TOOL_GRACEFUL_TIMEOUT', '120'))
+keepalive = 5
+
+# ワーカーが終了するとバックグラウンドの記事生成も止まるため、max_requests による定期的な再起動は設定しない。
+# 途中で止まった生成の状態は、次の /generate で（ワーカーのプロセスが存在しないことを確認して）解除される。
+
+accesslog = os.getenv('BLOG_TOOL_ACCESS_LOG') or None
+errorlog = '-'
@@ -0,0 +1,128 @@
+import re
+
+# 見出しの開始・終了タグ（[^<>]* で次のタグの手前までしか走査しないため、文書全体で線形時間）
+HEADING_TAG_PATTERN = re.compile(r'<(/?)h([1-6])\b([^<>]*)>', re.IGNORECASE)
+# 見出しの中身が「第X位: 作品名」だけのもの
+RANK_TEXT_PATTERN = re.compile(r'\s*第(\d+)位[：:]\s*([^<]+?)\s*')
+# Markdown/プレーンテキストの「第X位: 作品名」（1行ごとに判定）
+RANK_LINE_PATTERN = re.compile(r'第(\d+)位[：:]\s*(.+?)(?:\n|$)')
+ID_ATTR_PATTERN = re.compile(r'\sid="([^"]+)"', re.IGNORECASE)
+
+
+class Heading:
+    """HTML中の見出し1つ分の位置と内容"""
+
+    __slots__ = ('level', 'start', 'end', 'open_tag', 'inner', 'rank', 'title')
+
+    def __init__(self, level, start, end, open_tag, inner):
+        self.level = level
+        # start: 開始タグの先頭、end: 終了タグの直後
+        self.start = start
+        self.end = end
+        self.open_tag = open_tag
+        self.inner = inner
+        m = RANK_TEXT_PATTERN.fullmatch(inner)
+        self.rank = m.group(1) if m else None
+        self.title = m.group(2).strip() if m else None
+
+    @property
+    def is_plain(self):
+        """中身にタグを含まないか"""
+        return '<' not in self.inner
+
+    @property
+    def element_id(self):
+        m = ID_ATTR_PATTERN.search(self.open_tag)
+        return m.group(1) if m else None
+
+
+class HeadingIndex:
+    """
+    HTMLの見出し（h1〜h6）の位置を1回の走査で集めた索引
+
+    見出しの挿入・置換・削除は apply_edits() でまとめて適用するため、
+    順位の数に関係なく文書サイズに対して線形時間で処理できる。
+    """
+
+    def __init__(self, html):
+        self.html = html
+        self.headings = []
+        opened = None
+        for m in HEADING_TAG_PATTERN.finditer(html):
+            closing, level = m.group(1), int(m.group(2))
+            if not closing:
+                # 閉じられていない見出しは無視し、新しい開始タグから数え直す
+                opened = (level, m)
+            elif opened and opened[0] == level:
+                open_match = opened[1]
+                self.headings.append(Heading(level, open_match.start(), m.end(), open_match.group(0),
+                                             html[open_match.end():m.start()]))
+                opened = None
+            else:
+                opened = None
+
+    def __iter__(self):
+        return iter(self.headings)
+
+    def __len__(self):
+        return len(self.headings)
+
+    def of_level(self, *levels):
+        return [h for h in self.headings if h.level in levels]
+
+    def ranked(self, level=3):
+        """「第X位: 作品名」の見出し（文書順）"""
+        return [h for h in self.headings if h.level == level and h.rank is not None]
+
+    def next_section_starts(self, levels=(2, 3)):
+        """
+        各見出しについて、それより後にある levels の見出しの開始位置を返す（無ければ None）
+
+        末尾から1回たどるだけで全見出し分を求める。
+        """
+        result = [None] * len(self.headings)
+        following = None
+        for i in range(len(self.headings) - 1, -1, -1):
+            result[i] = following
+            if self.headings[i].level in levels:
+                following = self.headings[i].start
+        return result
+
+
+def rank_lines(text):
+    """
+    Markdown/プレーンテキストから「第X位: 作品名」の行を集める
+
+    Returns:
+        list: [(順位, 作品名, 挿入位置), ...]
+              挿入位置は作品名の直後の空白（改行を含む）を読み飛ばした位置
+    """
+    found = []
+    length = len(text)
+    position = 0
+    for line in text.split('\n'):
+        m = RANK_LINE_PATTERN.search(line)
+        if m:
+            title = re.sub(r'<[^>]+>', '', m.group(2).strip())
+            insert_at = position + len(line)
+            while insert_at < length and text[insert_at].isspace():
+                insert_at += 1
+            found.append((m.group(1), title, insert_at))
+        position += len(line) + 1
+    return found
+
+
+def apply_edits(text, edits):
+    """
+    (開始, 終了, 置換文字列) の編集をまとめて適用する
+
+    開始位置が同じ編集は与えた順に並ぶ。範囲が重なる編集は与えないこと。
+    """
+    parts = []
+    cursor = 0
+    for start, end, replacement in sorted(edits, key=lambda e: (e[0], e[1])):
+        parts.append(text[cursor:start])
+        parts.append(replacement)
+        cursor = max(cursor, end)
+    parts.append(text[cursor:])
+    return ''.join(parts)
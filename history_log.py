@@ -0,0 +1,761 @@
+import os
+import re
+import sys
+import zlib
+import atexit
+import json
+import time
+import base64
+import shutil
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+from collections import Counter
+from contextlib import contextmanager
+from blob_store import BlobStore
+
+# 履歴の種類と、以前のバージョンが保存していた個別ファイルのパターン
+LEGACY_PREFIXES = {
+    'article': 'article_history_',
+    'prompt': 'prompt_history_',
+    'evaluation': 'evaluation_history_',
+}
+
+KEY_PREFIX = 'history-'
+PREVIEW_LENGTH = 200
+
+# zlib が参照できる範囲（ウィンドウ）の大きさ。事前辞書もこれより前の部分は使われない
+DICTIONARY_SIZE = 32 * 1024
+# 辞書に入れる断片の最短の長さ（短い断片は圧縮の効果が小さい）
+DICTIONARY_MIN_FRAGMENT = 8
+
+# 種類ごとに本文ストア（BlobStore）に分けて保存する項目と、分ける最小サイズ（文字数）
+BLOB_FIELDS = {
+    'article': (('result', 'content'),),
+    'prompt': (('content',), ('generated_content',)),
+    'evaluation': (('original_content',), ('improved_content',)),
+}
+BLOB_MIN_LENGTH = 256
+
+
+def history_key(entry_id):
+    """画面のURLで使う履歴のキー（history-<ID>）"""
+    return f"{KEY_PREFIX}{entry_id}"
+
+
+def parse_history_key(key):
+    """履歴のキーからIDを取り出す（履歴のキーでなければ None）"""
+    if not key.startswith(KEY_PREFIX) or not key[len(KEY_PREFIX):].isdigit():
+        return None
+    return int(key[len(KEY_PREFIX):])
+
+
+def legacy_kind(filename):
+    """個別ファイルの履歴であればその種類、そうでなければ None"""
+    if not filename.endswith('.json'):
+        return None
+    for kind, prefix in LEGACY_PREFIXES.items():
+        if filename.startswith(prefix):
+            return kind
+    return None
+
+
+def _preview(text):
+    text = text or ''
+    return text[:PREVIEW_LENGTH] + '...' if len(text) > PREVIEW_LENGTH else text
+
+
+def summarize(kind, data):
+    """一覧表示・絞り込みに使う項目（テーマ、テンプレート名、プレビュー、投稿URL、作成元）"""
+    summary = {'theme': '', 'template_name': data.get('template_name', ''), 'post_url': '',
+               'source': data.get('source', '')}
+    if kind == 'article':
+        result = data.get('result') or {}
+        summary.update(theme=data.get('theme', ''), template_name='', post_url=result.get('post_url') or '',
+                       preview=(f"タイトル: {result.get('title', '')}\nステータス: {result.get('status', '')}\n"
+                                f"投稿ID: {result.get('post_id', '')}\nURL: {result.get('post_url', '')}"))
+    elif kind == 'prompt':
+        summary['preview'] = _preview(data.get('generated_content') or data.get('content', ''))
+    else:
+        summary['preview'] = _preview(data.get('improved_content', ''))
+    return summary
+
+
+def compress_data(data, zdict=None):
+    """履歴の内容を JSON にして zlib（raw deflate）で圧縮（zdict: 事前辞書）"""
+    raw = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    if zdict:
+        compressor = zlib.compressobj(level=9, wbits=-15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level=9, wbits=-15)
+    return compressor.compress(raw) + compressor.flush()
+
+
+def decompress_data(body, zdict=None):
+    """compress_data で圧縮した内容を戻す"""
+    decompressor = zlib.decompressobj(wbits=-15, zdict=zdict) if zdict else zlib.decompressobj(wbits=-15)
+    return json.loads(decompressor.decompress(body) + decompressor.flush())
+
+
+def _fragments(text):
+    # JSON にした本文では改行が \n になるため、改行と \n の両方で区切る
+    return (f.strip() for f in re.split(r'\\n|\n', text))
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """
+    サンプル（履歴の内容の JSON、テンプレート本文など）から zlib の事前辞書を作る
+
+    複数のサンプルに現れる断片（行）を集め、出現数の多いものほど辞書の末尾に置く
+    （zlib は辞書の末尾ほど短い距離で参照できる）。
+
+    Returns:
+        bytes: 事前辞書（共通の断片がない場合は空）
+    """
+    counts = Counter()
+    for sample in samples:
+        counts.update({f for f in _fragments(sample) if len(f.encode('utf-8')) >= DICTIONARY_MIN_FRAGMENT})
+    common = sorted((f for f, n in counts.items() if n >= 2), key=lambda f: (counts[f], len(f)), reverse=True)
+    selected = []
+    total = 0
+    for fragment in common:
+        encoded = fragment.encode('utf-8') + b'\\n'
+        if total + len(encoded) > size:
+            continue
+        selected.append(encoded)
+        total += len(encoded)
+    return b''.join(reversed(selected))
+
+
+class HistoryLog:
+    """
+    生成履歴の追記専用ログ
+
+    履歴は1件1行の JSON としてセグメントファイル（segment_000001.jsonl ...）に追記し、
+    一定サイズを超えたら次のセグメントに切り替える。削除も「削除済み」の行を追記して表す。
+    各行の位置と一覧表示用の項目は索引（SQLite）に持ち、一覧の表示では本文を読まない。
+
+    IDは索引の AUTOINCREMENT で採番するため、複数のワーカープロセスから追記しても単調増加になる。
+    追記は書き込みのたびに flush し（他のプロセスからすぐ読める）、fsync は sync_every 件ごと
+    または sync_interval 秒ごとにまとめて行う。
+
+    内容は zlib で圧縮し（codec='zlib'）、Base64 にして行に入れる。事前辞書（train_dictionary）が
+    あれば使い、行には辞書の番号を記録する。辞書を作り直しても古い行は元の辞書で読める。
+
+    記事本文やプロンプトなど大きな項目（BLOB_FIELDS）は本文ストア（blobs/）に内容のハッシュで保存し、
+    行にはハッシュだけを入れる。同じプロンプトを何度評価しても本文は1つ分しか保存されない。
+    """
+
+    def __init__(self, directory=None, segment_bytes=None, sync_every=None, sync_interval=None, codec=None):
+        """
+        Args:
+            directory (str): 保存先（None の場合は BLOG_TOOL_HISTORY_DIR、未設定ならカレントの history）
+            codec (str): 'zlib'（圧縮）または 'none'（JSON のまま）
+            segment_bytes (int): セグメントを切り替えるサイズ
+            sync_every (int): fsync をまとめる最大件数
+            sync_interval (float): 未同期の追記を fsync するまでの最大秒数
+        """
+        self.directory = directory or _default_directory()
+        self.segment_bytes = segment_bytes or int(os.getenv('BLOG_TOOL_HISTORY_SEGMENT_BYTES', str(8 * 1024 * 1024)))
+        self.sync_every = sync_every or int(os.getenv('BLOG_TOOL_HISTORY_SYNC_EVERY', '16'))
+        self.sync_interval = sync_interval if sync_interval is not None else float(
+            os.getenv('BLOG_TOOL_HISTORY_SYNC_INTERVAL', '1.0'))
+        self.codec = codec or os.getenv('BLOG_TOOL_HISTORY_CODEC', 'zlib')
+        self.index_path = os.path.join(self.directory, 'index.sqlite3')
+        self._dictionaries = {}
+        self.blobs = BlobStore(os.path.join(self.directory, 'blobs'))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._segment = None
+        self._handle = None
+        self._handle_pid = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._timer = None
+
+    # --- 索引 ---
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, created_at TEXT NOT NULL, '
+                         'segment INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL, '
+                         'theme TEXT, template_name TEXT, preview TEXT, post_url TEXT, source TEXT, source_file TEXT UNIQUE, '
+                         'deleted INTEGER NOT NULL DEFAULT 0)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_kind ON entries (kind, created_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS marks (entry_id INTEGER NOT NULL, marker TEXT NOT NULL, '
+                         'value TEXT, marked_at TEXT NOT NULL, PRIMARY KEY (entry_id, marker))')
+            # 作成元（source）の列は後から追加したため、古い索引には追加する
+            if 'source' not in {row[1] for row in conn.execute('PRAGMA table_info(entries)')}:
+                try:
+                    conn.execute('ALTER TABLE entries ADD COLUMN source TEXT')
+                except sqlite3.OperationalError:
+                    # 他のプロセスが先に追加した
+                    pass
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        # 索引の書き込みロックで、セグメントへの追記もプロセス間で直列化する
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _meta(self, conn, key, default=None):
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, conn, key, value):
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    # --- セグメント ---
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"segment_{segment:06d}.jsonl")
+
+    def _segments(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(name[8:14]) for name in os.listdir(self.directory)
+                      if name.startswith('segment_') and name.endswith('.jsonl') and name[8:14].isdigit())
+
+    def _append_line(self, conn, line):
+        """現在のセグメントに1行追記し、(セグメント番号, 位置) を返す（索引のトランザクション内で呼ぶ）"""
+        segment = int(self._meta(conn, 'current_segment', '1'))
+        path = self.segment_path(segment)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size and size + len(line) > self.segment_bytes:
+            segment += 1
+            self._set_meta(conn, 'current_segment', segment)
+            size = 0
+        with self._lock:
+            if self._handle is not None and self._handle_pid != os.getpid():
+                # fork 前に開いたファイルは親プロセスのものなので使わない
+                self._handle = None
+                self._unsynced = 0
+                self._timer = None
+            if self._segment != segment or self._handle is None:
+                # 他のプロセスがセグメントを切り替えた場合も、ここで開き直す
+                self._close_handle()
+                self._handle = open(self.segment_path(segment), 'ab')
+                self._handle_pid = os.getpid()
+                self._segment = segment
+            self._handle.write(line)
+            self._handle.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.sync_interval, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+        return segment, size
+
+    def _sync_locked(self):
+        if self._handle is not None and self._unsynced:
+            os.fsync(self._handle.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _close_handle(self):
+        if self._handle is not None:
+            self._sync_locked()
+            self._handle.close()
+            self._handle = None
+            self._segment = None
+
+    def sync(self):
+        """未同期の追記を fsync"""
+        with self._lock:
+            self._sync_locked()
+
+    def close(self):
+        with self._lock:
+            self._close_handle()
+
+    # --- 圧縮 ---
+
+    def dictionary_path(self, dictionary_id):
+        return os.path.join(self.directory, f"dictionary_{dictionary_id:06d}.zdict")
+
+    def _dictionary(self, dictionary_id):
+        if not dictionary_id:
+            return None
+        if dictionary_id not in self._dictionaries:
+            with open(self.dictionary_path(dictionary_id), 'rb') as f:
+                self._dictionaries[dictionary_id] = f.read()
+        return self._dictionaries[dictionary_id]
+
+    def _externalize(self, kind, data):
+        """大きな項目を本文ストアに保存し、{'$blob': ハッシュ, 'size': バイト数} に置き換えた内容を返す（data は変更しない）"""
+        data = dict(data)
+        for path in BLOB_FIELDS.get(kind, ()):
+            parent = data
+            for key in path[:-1]:
+                if not isinstance(parent.get(key), dict):
+                    break
+                parent[key] = dict(parent[key])
+                parent = parent[key]
+            else:
+                value = parent.get(path[-1])
+                if isinstance(value, str) and len(value) >= BLOB_MIN_LENGTH:
+                    # size: 本文を読まずにページ数を出せるよう、大きさ（バイト）も持つ
+                    parent[path[-1]] = {'$blob': self.blobs.put(value), 'size': len(value.encode('utf-8'))}
+        return data
+
+    def _blob_digests(self, kind, data):
+        """内容が参照している本文のハッシュ"""
+        digests = []
+        for path in BLOB_FIELDS.get(kind, ()):
+            value = data
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            if isinstance(value, dict) and '$blob' in value:
+                digests.append(value['$blob'])
+        return digests
+
+    def _resolve(self, kind, data):
+        """{'$blob': ハッシュ} を本文に戻す"""
+        for path in BLOB_FIELDS.get(kind, ()):
+            parent = data
+            for key in path[:-1]:
+                parent = parent.get(key) if isinstance(parent, dict) else None
+            if isinstance(parent, dict) and isinstance(parent.get(path[-1]), dict) and '$blob' in parent[path[-1]]:
+                parent[path[-1]] = self.blobs.get(parent[path[-1]]['$blob'])
+        return data
+
+    def _encode_record(self, conn, record, data):
+        """record（内容以外の項目）に内容を加えて1行にする"""
+        data = self._externalize(record['kind'], data)
+        if self.codec != 'zlib':
+            return _encode(dict(record, data=data))
+        dictionary_id = int(self._meta(conn, 'dictionary', '0'))
+        body = compress_data(data, self._dictionary(dictionary_id))
+        return _encode(dict(record, codec='zlib', dict=dictionary_id, body=base64.b64encode(body).decode('ascii')))
+
+    def _decode_record(self, record):
+        """行の内容を戻す（圧縮していない行もそのまま読める）"""
+        if record.get('codec') == 'zlib':
+            return decompress_data(base64.b64decode(record['body']), self._dictionary(record.get('dict')))
+        return record['data']
+
+    def train_dictionary(self, extra_samples=()):
+        """
+        保存済みの履歴とテンプレートなどから事前辞書を作り、以降の追記で使う
+
+        既存の行は compact で新しい辞書に書き直される。
+
+        Returns:
+            int|None: 辞書の番号（共通の断片がなく作れなかった場合は None）
+        """
+        # 行に入るのは本文ストアに分けた後の内容なので、同じ形にしてから学習する
+        samples = [json.dumps(self._externalize(row['kind'], self._decode_record(self._read_record(row))),
+                              ensure_ascii=False)
+                   for row in self._connect().execute('SELECT * FROM entries WHERE deleted = 0')]
+        samples.extend(extra_samples)
+        zdict = train_dictionary(samples)
+        if not zdict:
+            return None
+        with self._transaction() as conn:
+            dictionary_id = int(self._meta(conn, 'dictionary', '0')) + 1
+            with open(self.dictionary_path(dictionary_id), 'wb') as f:
+                f.write(zdict)
+                f.flush()
+                os.fsync(f.fileno())
+            self._set_meta(conn, 'dictionary', dictionary_id)
+        return dictionary_id
+
+    # --- 追記・読み込み ---
+
+    def append(self, kind, data, created_at=None, source_file=None):
+        """
+        履歴を1件追記
+
+        Args:
+            kind (str): 'article' / 'prompt' / 'evaluation'
+            data (dict): 履歴の内容
+            created_at (str): 作成日時（ISO形式、None の場合は data['created_at'] または現在時刻）
+            source_file (str): 取り込み元の個別ファイル名（取り込み時のみ）
+
+        Returns:
+            int: 履歴のID
+        """
+        created_at = created_at or data.get('created_at') or datetime.now().isoformat()
+        summary = summarize(kind, data)
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO entries (kind, created_at, segment, offset, length, theme, template_name, preview, '
+                'post_url, source, source_file) VALUES (?, ?, 0, 0, 0, ?, ?, ?, ?, ?, ?)',
+                (kind, created_at, summary['theme'], summary['template_name'], summary['preview'],
+                 summary['post_url'], summary['source'], source_file))
+            entry_id = cursor.lastrowid
+            line = self._encode_record(conn, {'op': 'add', 'id': entry_id, 'kind': kind, 'created_at': created_at,
+                                              'source_file': source_file}, data)
+            segment, offset = self._append_line(conn, line)
+            conn.execute('UPDATE entries SET segment = ?, offset = ?, length = ? WHERE id = ?',
+                         (segment, offset, len(line), entry_id))
+        return entry_id
+
+    def delete(self, entry_id):
+        """履歴を削除済みにする（本文は compact で取り除く）"""
+        with self._transaction() as conn:
+            row = conn.execute('SELECT deleted FROM entries WHERE id = ?', (entry_id,)).fetchone()
+            if not row or row['deleted']:
+                return False
+            self._append_line(conn, _encode({'op': 'delete', 'id': entry_id,
+                                             'deleted_at': datetime.now().isoformat()}))
+            conn.execute('UPDATE entries SET deleted = 1 WHERE id = ?', (entry_id,))
+        return True
+
+    def entries(self, kind=None):
+        """
+        削除されていない履歴の一覧（索引のみ、新しい順）
+
+        Returns:
+            list: [sqlite3.Row(id, kind, created_at, length, theme, template_name, preview, post_url, source_file), ...]
+        """
+        sql = ('SELECT id, kind, created_at, length, theme, template_name, preview, post_url, source_file '
+               'FROM entries WHERE deleted = 0')
+        params = ()
+        if kind:
+            sql += ' AND kind = ?'
+            params = (kind,)
+        return self._connect().execute(sql + ' ORDER BY created_at DESC, id DESC', params).fetchall()
+
+    def unmarked(self, marker, kind=None):
+        """
+        marker の処理を前回 advance した位置より後の履歴（索引のみ、古い順）
+
+        IDは保存順に増えるため、処理済みの位置より後の履歴だけを読めば新しい履歴をすべて処理できる。
+
+        Returns:
+            list: [sqlite3.Row(id, kind, created_at, template_name, source), ...]
+        """
+        conn = self._connect()
+        since = int(self._meta(conn, f'marker:{marker}', '0'))
+        sql = 'SELECT id, kind, created_at, template_name, source FROM entries WHERE id > ? AND deleted = 0'
+        params = (since,)
+        if kind:
+            sql += ' AND kind = ?'
+            params += (kind,)
+        return conn.execute(sql + ' ORDER BY id', params).fetchall()
+
+    def mark(self, marker, entry_id, value=''):
+        """履歴に marker の印（value: 処理結果）を付ける"""
+        self._connect().execute('INSERT OR REPLACE INTO marks (entry_id, marker, value, marked_at) VALUES (?, ?, ?, ?)',
+                                (entry_id, marker, value, datetime.now().isoformat()))
+
+    def advance(self, marker, entry_id):
+        """marker の処理済みの位置を entry_id まで進める（戻すことはない）"""
+        with self._transaction() as conn:
+            if entry_id > int(self._meta(conn, f'marker:{marker}', '0')):
+                self._set_meta(conn, f'marker:{marker}', entry_id)
+
+    def marks(self, entry_id):
+        """履歴に付いている印 {marker: value}"""
+        return dict(self._connect().execute('SELECT marker, value FROM marks WHERE entry_id = ?',
+                                            (entry_id,)).fetchall())
+
+    def entry(self, entry_id):
+        """削除されていない履歴の索引（なければ None）"""
+        return self._connect().execute('SELECT * FROM entries WHERE id = ? AND deleted = 0', (entry_id,)).fetchone()
+
+    def get(self, entry_id, resolve=True):
+        """
+        履歴の内容を読み込む
+
+        Args:
+            entry_id (int): 履歴の番号
+            resolve (bool): False の場合は大きな項目を本文ストアへの参照（{'$blob': ...}）のまま返す
+
+        Returns:
+            dict|None: 履歴の内容（data）。削除済み・存在しない場合は None
+        """
+        for attempt in range(2):
+            row = self.entry(entry_id)
+            if row is None:
+                return None
+            try:
+                data = self._decode_record(self._read_record(row))
+                return self._resolve(row['kind'], data) if resolve else data
+            except FileNotFoundError:
+                # compact でセグメントが置き換えられた直後は、索引を読み直す
+                if attempt:
+                    raise
+        return None
+
+    def _read_record(self, row):
+        with open(self.segment_path(row['segment']), 'rb') as f:
+            f.seek(row['offset'])
+            return json.loads(f.read(row['length']))
+
+    def records(self, kind=None):
+        """削除されていない履歴を (索引, 内容) の組で順に返す（古い順）"""
+        for row in reversed(self.entries(kind)):
+            try:
+                yield row, self.get(row['id'])
+            except Exception as e:
+                print(f"履歴 {history_key(row['id'])} の読み込みエラー: {e}")
+
+    def stats(self):
+        conn = self._connect()
+        counts = {row['kind']: row['n'] for row in conn.execute(
+            'SELECT kind, COUNT(*) AS n FROM entries WHERE deleted = 0 GROUP BY kind')}
+        deleted = conn.execute('SELECT COUNT(*) FROM entries WHERE deleted = 1').fetchone()[0]
+        segments = self._segments()
+        return {
+            'directory': self.directory,
+            'entries': counts,
+            'deleted': deleted,
+            'segments': len(segments),
+            'bytes': sum(os.path.getsize(self.segment_path(s)) for s in segments),
+            'dictionary': int(self._meta(conn, 'dictionary', '0')),
+            'blobs': len(self.blobs.digests()),
+            'blob_bytes': self.blobs.size()
+        }
+
+    # --- 保守 ---
+
+    def compact(self):
+        """
+        削除済みの履歴と削除の行を取り除いて、セグメントを書き直す
+
+        新しいセグメントは既存より大きい番号で書き、索引を切り替えてから古いセグメントを消す。
+        内容は現在の圧縮方式・辞書で書き直し、どの履歴・テンプレートからも参照されない本文も削除する。
+        IDは変わらない。
+
+        Returns:
+            dict: {'kept': 残した件数, 'removed': 取り除いた件数, 'before': 前のバイト数, 'after': 後のバイト数,
+                   'blobs_removed': 削除した本文の件数}
+        """
+        self.close()
+        with self._transaction() as conn:
+            old_segments = self._segments()
+            before = sum(os.path.getsize(self.segment_path(s)) for s in old_segments)
+            rows = conn.execute('SELECT * FROM entries WHERE deleted = 0 ORDER BY id').fetchall()
+            removed = conn.execute('SELECT COUNT(*) FROM entries WHERE deleted = 1').fetchone()[0]
+            segment = (old_segments[-1] if old_segments else 0) + 1
+            first_segment = segment
+            handle = open(self.segment_path(segment), 'wb')
+            size = 0
+            positions = []
+            referenced = set()
+            try:
+                for row in rows:
+                    record = self._read_record(row)
+                    data = self._externalize(row['kind'], self._decode_record(record))
+                    referenced.update(self._blob_digests(row['kind'], data))
+                    for key in ('data', 'codec', 'dict', 'body'):
+                        record.pop(key, None)
+                    line = self._encode_record(conn, record, data)
+                    if size and size + len(line) > self.segment_bytes:
+                        os.fsync(handle.fileno())
+                        handle.close()
+                        segment += 1
+                        handle = open(self.segment_path(segment), 'wb')
+                        size = 0
+                    handle.write(line)
+                    positions.append((segment, size, len(line), row['id']))
+                    size += len(line)
+                handle.flush()
+                os.fsync(handle.fileno())
+            finally:
+                handle.close()
+            conn.executemany('UPDATE entries SET segment = ?, offset = ?, length = ? WHERE id = ?', positions)
+            conn.execute('DELETE FROM entries WHERE deleted = 1')
+            conn.execute('DELETE FROM marks WHERE entry_id NOT IN (SELECT id FROM entries)')
+            self._set_meta(conn, 'current_segment', segment)
+            # 追記は索引のロック中に本文を保存するため、ロック中であれば参照の集計と削除の間に割り込まれない
+            blobs_removed = self.blobs.remove_unreferenced(referenced)
+        for old in old_segments:
+            if old < first_segment:
+                os.remove(self.segment_path(old))
+        return {'kept': len(rows), 'removed': removed, 'before': before,
+                'after': sum(os.path.getsize(self.segment_path(s)) for s in self._segments()),
+                'blobs_removed': blobs_removed}
+
+    def import_legacy_files(self, directory='.', keep=False, dry_run=False):
+        """
+        以前のバージョンの個別ファイル（*_history_*.json）をログに取り込む
+
+        取り込んだファイルは履歴ディレクトリの imported/ に移動する（keep=True の場合はそのまま）。
+        取り込み済みのファイル名は索引に記録するため、何度実行しても二重には取り込まない。
+
+        Returns:
+            dict: {'imported': 件数, 'skipped': 件数, 'failed': 件数}
+        """
+        counts = {'imported': 0, 'skipped': 0, 'failed': 0}
+        files = []
+        for filename in sorted(os.listdir(directory)):
+            kind = legacy_kind(filename)
+            if not kind:
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except Exception as e:
+                print(f"履歴ファイル {filename} の読み込みエラー: {e}")
+                counts['failed'] += 1
+                continue
+            files.append((data.get('created_at') or '', filename, path, kind, data))
+
+        imported_dir = os.path.join(self.directory, 'imported')
+        conn = self._connect()
+        if not dry_run and self.codec == 'zlib' and not self._meta(conn, 'dictionary'):
+            # 辞書がまだなければ、取り込むファイルとテンプレートから作ってから取り込む
+            self.train_dictionary([json.dumps(self._externalize(kind, data), ensure_ascii=False)
+                                   for _, _, _, kind, data in files]
+                                  + template_samples(directory))
+        # 作成日時の順に取り込み、IDの順序と作成日時の順序をそろえる
+        for created_at, filename, path, kind, data in sorted(files):
+            if conn.execute('SELECT 1 FROM entries WHERE source_file = ?', (filename,)).fetchone():
+                counts['skipped'] += 1
+                continue
+            if dry_run:
+                print(f"取り込み予定: {filename}（{kind}）")
+                counts['imported'] += 1
+                continue
+            if not created_at:
+                created_at = datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+            self.append(kind, data, created_at=created_at, source_file=filename)
+            counts['imported'] += 1
+            if not keep:
+                os.makedirs(imported_dir, exist_ok=True)
+                shutil.move(path, os.path.join(imported_dir, filename))
+        if not dry_run:
+            self.sync()
+        return counts
+
+
+def template_samples(directory='.'):
+    """辞書の学習に使うプロンプトテンプレートの本文（履歴の中と同じく JSON の文字列にしたもの）"""
+    samples = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('_prompt.txt') or (filename.startswith('prompt_') and filename.endswith('.txt')):
+            try:
+                with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+                    samples.append(json.dumps(f.read(), ensure_ascii=False))
+            except Exception as e:
+                print(f"テンプレートファイル {filename} の読み込みエラー: {e}")
+    return samples
+
+
+def _encode(record):
+    return (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def _default_directory():
+    return os.path.abspath(os.getenv('BLOG_TOOL_HISTORY_DIR') or 'history')
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def get_history_log():
+    """
+    プロセス共通の履歴ログを返す
+
+    保存先は呼び出し時の BLOG_TOOL_HISTORY_DIR（未設定ならカレントディレクトリ）で決まるため、
+    保存先ごとに1つずつ作る。
+    """
+    directory = _default_directory()
+    with _logs_lock:
+        if directory not in _logs:
+            _logs[directory] = HistoryLog(directory)
+            # 終了時に未同期の追記を fsync
+            atexit.register(_logs[directory].close)
+        return _logs[directory]
+
+
+def iter_history_data(kind, directory='.'):
+    """
+    指定した種類の履歴の内容を古い順に返す（ログに加えて、未取り込みの個別ファイルも読む）
+
+    Yields:
+        (str, dict): (履歴のキーまたはファイル名, 内容)
+    """
+    log = get_history_log()
+    if os.path.exists(log.index_path):
+        for row, data in log.records(kind):
+            if data is not None:
+                yield history_key(row['id']), data
+    prefix = LEGACY_PREFIXES[kind]
+    for filename in sorted(os.listdir(directory)):
+        if filename.startswith(prefix) and filename.endswith('.json'):
+            try:
+                with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+                    yield filename, json.load(f)
+            except Exception as e:
+                print(f"履歴ファイル {filename} の読み込みエラー: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成履歴ログの管理')
+    parser.add_argument('--dir', help='履歴の保存先（既定: BLOG_TOOL_HISTORY_DIR またはカレントの history）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help='以前の個別ファイル（*_history_*.json）を取り込む')
+    import_parser.add_argument('--source', default='.', help='個別ファイルのあるディレクトリ')
+    import_parser.add_argument('--keep', action='store_true', help='取り込んだファイルを移動しない')
+    import_parser.add_argument('--dry-run', action='store_true', help='取り込む予定のファイルを表示するだけ')
+
+    subparsers.add_parser('compact', help='削除済みの履歴を取り除いてセグメントを書き直す')
+    subparsers.add_parser('train', help='保存済みの履歴とテンプレートから圧縮用の辞書を作り直し、全件を書き直す')
+    subparsers.add_parser('stats', help='件数とサイズを表示')
+
+    args = parser.parse_args()
+    log = HistoryLog(args.dir)
+
+    try:
+        if args.command == 'import':
+            counts = log.import_legacy_files(args.source, keep=args.keep, dry_run=args.dry_run)
+            print(f"取り込み: {counts['imported']}件 / 取り込み済み: {counts['skipped']}件 / 失敗: {counts['failed']}件")
+        elif args.command in ('compact', 'train'):
+            if args.command == 'train':
+                dictionary_id = log.train_dictionary(template_samples())
+                if dictionary_id is None:
+                    print("辞書に使える共通の断片が見つかりませんでした。")
+                    return
+                print(f"辞書 {os.path.basename(log.dictionary_path(dictionary_id))} を作成しました。")
+            result = log.compact()
+            print(f"残した履歴: {result['kept']}件 / 取り除いた履歴: {result['removed']}件 / "
+                  f"削除した本文: {result['blobs_removed']}件")
+            print(f"サイズ: {result['before'] / 1024:.1f} KB → {result['after'] / 1024:.1f} KB")
+        else:
+            stats = log.stats()
+            print(f"保存先: {stats['directory']}")
+            for kind, count in sorted(stats['entries'].items()):
+                print(f"  {kind}: {count}件")
+            print(f"削除済み（compact 前）: {stats['deleted']}件")
+            print(f"圧縮: {log.codec}（辞書: {stats['dictionary'] or 'なし'}）")
+            print(f"セグメント: {stats['segments']}個 / {stats['bytes'] / 1024:.1f} KB")
+            print(f"本文: {stats['blobs']}件 / {stats['blob_bytes'] / 1024:.1f} KB")
+    except Exception as e:
+        print(f"履歴ログの処理エラー: {e}")
+        sys.exit(1)
+    finally:
+        log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import os
+import json
+import tempfile
+import threading
+from contextlib import contextmanager
+from title_normalizer import TitleIndex
+from metrics import IMAGE_CACHE_LOOKUPS
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def _file_lock(path):
+    """path（ロック用のファイル）の排他ロック（他のプロセスの保存が終わるまで待つ）"""
+    with open(path, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ImageCache:
+    """
+    作品名をキーとした画像キャッシュ（image_cache.json に永続化）
+
+    生の見出し文字列での完全一致に加え、正規化キー・別名・n-gramによる
+    あいまい一致でも既存エントリを引き当てる。保存形式は従来と同じ
+    { 作品名: { 'url': ..., 'source': ... } } のため、既存ファイルをそのまま読める。
+
+    Webアプリの各ワーカー・事前取得・worker_daemon・CLI が同じファイルを使うため、保存時はロックを取って
+    ファイルを読み直し、このプロセスで登録した分だけを重ねて書く（他のプロセスが追加した分を消さない）。
+    """
+
+    def __init__(self, path=None, fuzzy_threshold=0.8):
+        self.path = path or os.path.join(os.getcwd(), 'image_cache.json')
+        self.fuzzy_threshold = fuzzy_threshold
+        self.stats = {'exact': 0, 'normalized': 0, 'fuzzy': 0, 'miss': 0}
+        # 事前取得（並列）時の同時更新に備えたロック
+        self._lock = threading.RLock()
+        # ファイルの読み込みと索引の構築は初回の参照まで遅らせる（画像を使わない実行では読まない）
+        self._entries = None
+        self._index = None
+        # 前回の保存以降にこのプロセスで登録したエントリ
+        self._dirty = {}
+
+    @property
+    def entries(self):
+        self._ensure_loaded()
+        return self._entries
+
+    @property
+    def index(self):
+        self._ensure_loaded()
+        return self._index
+
+    def _ensure_loaded(self):
+        if self._entries is not None:
+            return
+        with self._lock:
+            if self._entries is None:
+                self._load()
+
+    def _read_file(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"画像キャッシュ読み込みエラー: {e}")
+        return {}
+
+    def _load(self):
+        entries = self._read_file()
+        index = TitleIndex(threshold=self.fuzzy_threshold)
+        for title in entries:
+            index.add(title)
+        self._index = index
+        self._entries = entries
+
+    def __contains__(self, title):
+        return self.find(title)[0] is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, title):
+        """
+        キャッシュを検索
+
+        Returns:
+            tuple: (キャッシュキー or None, 一致種別 'exact' / 'normalized' / 'fuzzy' / None)
+        """
+        with self._lock:
+            if title in self.entries:
+                return title, 'exact'
+            return self.index.lookup(title)
+
+    def get(self, title):
+        """
+        キャッシュから画像情報を取得
+
+        Returns:
+            dict|None: { 'url': 画像URL, 'source': 参照元URL or None }
+        """
+        key, kind = self.find(title)
+        if key is None:
+            self.stats['miss'] += 1
+            IMAGE_CACHE_LOOKUPS.inc(result='miss')
+            return None
+        self.stats[kind] += 1
+        IMAGE_CACHE_LOOKUPS.inc(result=kind)
+        if kind != 'exact':
+            print(f"キャッシュ照合（{kind}）: {title} -> {key}")
+        cached = self.entries[key]
+        if isinstance(cached, dict):
+            return cached
+        return {'url': cached, 'source': None}
+
+    def set(self, title, value, save=True):
+        """画像情報を登録（save=True の場合はファイルにも保存）"""
+        with self._lock:
+            self.entries[title] = value
+            self.index.add(title)
+            self._dirty[title] = value
+            if save:
+                self.save()
+
+    def hit_rate(self):
+        """ヒット率（0.0〜1.0）を返す"""
+        total = sum(self.stats.values())
+        if not total:
+            return 0.0
+        return (total - self.stats['miss']) / total
+
+    def save(self):
+        """
+        このプロセスで登録したエントリをファイルに保存する
+
+        他のプロセスと同時に保存しないようロックを取り、ファイルを読み直して登録分を重ねてから置き換える。
+        他のプロセスが追加したエントリはこのキャッシュにも取り込む。
+        """
+        with self._lock:
+            tmp_path = None
+            try:
+                with _file_lock(self.path + '.lock'):
+                    entries = self._read_file()
+                    entries.update(self._dirty)
+                    # 書き込み途中のファイルを他プロセスが読まないよう一時ファイル経由で置き換える
+                    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        json.dump(entries, f, ensure_ascii=False, indent=2)
+                    os.replace(tmp_path, self.path)
+                    tmp_path = None
+                self._dirty = {}
+                for title, value in entries.items():
+                    if title not in self.entries:
+                        self.entries[title] = value
+                        self.index.add(title)
+            except Exception as e:
+                print(f"画像キャッシュ保存エラー: {e}")
+            finally:
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
@@ -0,0 +1,160 @@
+import re
+import sys
+import glob
+import argparse
+from title_normalizer import normalize_title
+from history_log import iter_history_data
+
+RANK_HEADING_PATTERN = re.compile(r'第(\d+)位[：:]\s*([^<\n\\]+)')
+# 同時実行数の上限（各スレッドが Perplexity と公式サイトにリクエストを送るため）
+MAX_WORKERS = 8
+
+
+def _history_texts(patterns):
+    """記事の生成履歴（履歴ログと未取り込みの個別ファイル）と記事ファイルの本文を (名前, 本文) で返す"""
+    for key, data in iter_history_data('article'):
+        yield key, (data.get('result') or {}).get('content', '') or ''
+    for filename in sorted(f for pattern in patterns for f in glob.glob(pattern)):
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                yield filename, f.read()
+        except Exception as e:
+            print(f"履歴ファイル {filename} の読み込みエラー: {e}")
+
+
+def collect_ranked_titles(patterns=('blog_article_*.txt',)):
+    """
+    記事の生成履歴と記事ファイルから「第X位: 作品名」の見出しを収集
+
+    Args:
+        patterns (tuple): 生成履歴に加えて読み込む記事ファイルのパターン
+
+    Returns:
+        list: [(履歴のキーまたはファイル名, 順位, 作品名), ...]（生成履歴の古い順、続いてファイル名順）
+    """
+    titles = []
+    for filename, text in _history_texts(patterns):
+        seen = set()
+        for m in RANK_HEADING_PATTERN.finditer(text):
+            title = re.sub(r'<[^>]+>', '', m.group(2)).strip()
+            # 目次と本文で同じ見出しが繰り返されるため、記事内では1回のみ数える
+            if not title or title in seen:
+                continue
+            seen.add(title)
+            titles.append((filename, m.group(1), title))
+    return titles
+
+
+def unique_titles(titles):
+    """正規化キーで重複を除いた作品名リストを返す（出現順を保持）"""
+    seen = set()
+    result = []
+    for title in titles:
+        title = title.strip()
+        if not title:
+            continue
+        key = normalize_title(title) or title
+        if key in seen:
+            continue
+        seen.add(key)
+        result.append(title)
+    return result
+
+
+def prefetch_images(tool, titles, workers=4, progress=None, batch_size=5):
+    """
+    作品名リストの画像を並列に検索してキャッシュを温める
+
+    Args:
+        tool (IntegratedBlogTool): 画像検索に使用するツール
+        titles (list): 作品名のリスト
+        workers (int): 同時実行数（1〜MAX_WORKERS に収める）
+        progress (callable): 1件完了ごとに progress(完了数, 総数, 作品名, 成否) を呼び出す
+        batch_size (int): 1回のLLM問い合わせにまとめる作品数
+
+    Returns:
+        dict: { 'total', 'cached', 'fetched', 'failed', 'coverage', 'missing' }
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed  # 起動時間短縮のため使用時に読み込む
+
+    titles = unique_titles(titles)
+    report = {'total': len(titles), 'cached': 0, 'fetched': 0, 'failed': 0, 'coverage': 0.0, 'missing': []}
+
+    pending = []
+    for title in titles:
+        if title in tool.image_cache:
+            report['cached'] += 1
+        else:
+            pending.append(title)
+
+    done = report['cached']
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, MAX_WORKERS))) as executor:
+            batches = [pending[i:i + batch_size] for i in range(0, len(pending), max(1, batch_size))]
+            futures = {executor.submit(tool.search_anime_images, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    print(f"画像の事前取得エラー: {', '.join(batch)}: {e}")
+                    results = {}
+                for title in batch:
+                    ok = bool(results.get(title))
+                    if ok:
+                        report['fetched'] += 1
+                    else:
+                        report['failed'] += 1
+                        report['missing'].append(title)
+                    done += 1
+                    if progress:
+                        progress(done, report['total'], title, ok)
+
+    if report['total']:
+        report['coverage'] = (report['cached'] + report['fetched']) / report['total']
+    return report
+
+
+def main():
+    """画像キャッシュの事前取得（ウォームアップ）"""
+    parser = argparse.ArgumentParser(description='アニメ画像キャッシュの事前取得')
+    parser.add_argument('titles', nargs='*', help='作品名（省略時は履歴ファイルを走査）')
+    parser.add_argument('--scan', action='store_true', help='article_history_*.json / blog_article_*.txt の見出しも対象にする')
+    parser.add_argument('--file', help='作品名を1行ずつ記載したファイル')
+    parser.add_argument('--workers', type=int, default=4, help='同時実行数（デフォルト: 4）')
+    args = parser.parse_args()
+
+    titles = list(args.titles)
+    if args.file:
+        with open(args.file, 'r', encoding='utf-8') as f:
+            titles.extend(line.strip() for line in f if line.strip())
+    if args.scan or not titles:
+        titles.extend(title for _, _, title in collect_ranked_titles())
+
+    if not titles:
+        print("事前取得する作品名がありません。")
+        return
+
+    from integrated_blog_tool import IntegratedBlogTool
+    try:
+        tool = IntegratedBlogTool()
+    except ValueError as e:
+        print(f"設定エラー: {e}")
+        sys.exit(1)
+
+    def show_progress(done, total, title, ok):
+        mark = '✓' if ok else '✗'
+        print(f"[{done}/{total}] {mark} {title}")
+
+    report = prefetch_images(tool, titles, workers=args.workers, progress=show_progress)
+    print("=" * 50)
+    print(f"対象: {report['total']}件  キャッシュ済み: {report['cached']}件  新規取得: {report['fetched']}件  失敗: {report['failed']}件")
+    print(f"カバレッジ: {report['coverage']:.1%}")
+    for title in report['missing']:
+        print(f"  未取得: {title}")
+    print("検索戦略ごとの結果:")
+    print(tool.image_resolver.format_stats())
+
+
+if __name__ == "__main__":
+    main()
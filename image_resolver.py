@@ -0,0 +1,433 @@
+import os
+import re
+import json
+import time
+import threading
+from title_normalizer import normalize_title
+from tracing import span
+from deadlines import current_deadline, post_reserve_seconds
+
+# ブロックリスト（日本で一般的でない/不適切ソースを除外）
+BLOCKED_IMAGE_DOMAINS = [
+    'crunchyroll', 'pinterest', 'facebook', 'twitter', 'x.com', 'instagram',
+    'myanimelist', 'anilist', 'kitsu', 'fandom.com', 'tumblr', 'deviantart'
+]
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.gif']
+
+# 画像検索（構造化モード）の応答スキーマ
+IMAGE_LOOKUP_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "official_site": {"type": ["string", "null"]},
+                    "key_visual_urls": {"type": "array", "items": {"type": "string"}}
+                },
+                "required": ["title", "official_site", "key_visual_urls"]
+            }
+        }
+    },
+    "required": ["results"]
+}
+
+# 戦略の既定の実行順（IMAGE_RESOLVER_STRATEGIES 環境変数で上書き可能）
+DEFAULT_STRATEGY_ORDER = ['search', 'structured', 'citations', 'chat']
+
+
+def is_blocked_url(url):
+    lower = url.lower()
+    return any(b in lower for b in BLOCKED_IMAGE_DOMAINS)
+
+
+def is_image_url(url):
+    lower = url.lower().split('?', 1)[0]
+    return any(lower.endswith(ext) or f'{ext}/' in lower for ext in IMAGE_EXTENSIONS)
+
+
+def site_score(u: str) -> int:
+    """公式サイトらしさのスコア"""
+    s = 0
+    lu = u.lower()
+    if is_blocked_url(lu):
+        s -= 100
+    if 'official' in lu:
+        s += 20
+    if lu.endswith('.jp') or '.jp/' in lu:
+        s += 10
+    if any(k in lu for k in ['anime', '/tv', '/news']):
+        s += 4
+    # SNS/動画サイトは避ける
+    if any(k in lu for k in ['youtube', 'tiktok', 'instagram', 'x.com', 'twitter']):
+        s -= 20
+    return s
+
+
+def _is_http_url(value):
+    return isinstance(value, str) and re.match(r'^https?://[^\s<>"]+$', value.strip()) is not None
+
+
+def parse_image_lookup_json(text, anime_titles):
+    """
+    構造化モードの応答を解析し、スキーマに沿っているか検証する
+
+    Args:
+        text (str): LLMの応答本文
+        anime_titles (list): 問い合わせた作品名（応答の title と照合する）
+
+    Returns:
+        dict|None: { アニメタイトル: { 'official_site': str|None, 'key_visual_urls': [str] } }
+                   （JSONとして解釈できない・スキーマに合わない場合は None）
+    """
+    if not text:
+        return None
+
+    # コードフェンスや前後の文章が付いていても最外側のオブジェクトを取り出す
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+
+    if not isinstance(data, dict) or not isinstance(data.get('results'), list):
+        return None
+
+    normalized = {normalize_title(t): t for t in anime_titles}
+    # 期表記だけの作品名など、照合に使えるキーがないものは順序で対応付ける
+    normalized.pop('', None)
+    parsed = {}
+    for position, item in enumerate(data['results']):
+        if not isinstance(item, dict) or not isinstance(item.get('title'), str):
+            continue
+        official_site = item.get('official_site')
+        key_visuals = item.get('key_visual_urls') or []
+        if official_site is not None and not isinstance(official_site, str):
+            continue
+        if not isinstance(key_visuals, list):
+            continue
+
+        # 作品名は表記ゆれを許容して照合し、それでも合わなければ順序で対応付ける
+        title = item['title'].strip()
+        if title not in anime_titles:
+            title = normalized.get(normalize_title(title))
+        if title is None and position < len(anime_titles) and len(data['results']) == len(anime_titles):
+            title = anime_titles[position]
+        if title is None or title in parsed:
+            continue
+
+        parsed[title] = {
+            'official_site': official_site.strip() if _is_http_url(official_site) else None,
+            'key_visual_urls': [u.strip() for u in key_visuals if _is_http_url(u)][:3]
+        }
+
+    return parsed if parsed else None
+
+
+def _candidates(image_urls=None, site_urls=None):
+    return {'image_urls': list(image_urls or []), 'site_urls': list(site_urls or [])}
+
+
+def _urls_from_response(response):
+    """チャット応答の citations / search_results から参照URLを取り出す"""
+    urls = []
+    for url in response.get('citations') or []:
+        if isinstance(url, str):
+            urls.append(url)
+    for item in response.get('search_results') or []:
+        if isinstance(item, dict) and isinstance(item.get('url'), str):
+            urls.append(item['url'])
+    return [u for u in dict.fromkeys(urls) if _is_http_url(u)]
+
+
+class ImageLookupStrategy:
+    """画像候補（画像URL・公式サイトURL）を見つける戦略の基底クラス"""
+
+    name = ''
+    # 1回の呼び出しでまとめて扱える作品数
+    batch_size = 1
+
+    def __init__(self, client):
+        self.client = client
+
+    def discover(self, anime_titles):
+        """
+        作品ごとの候補URLを返す
+
+        Returns:
+            dict: { アニメタイトル: { 'image_urls': [...], 'site_urls': [...] } }
+                  （候補を得られなかった作品は含めない）
+        """
+        raise NotImplementedError
+
+
+class SearchStrategy(ImageLookupStrategy):
+    """Perplexity Search API の検索結果を公式サイト候補にする（LLM生成なし）"""
+
+    name = 'search'
+    batch_size = 5
+
+    def discover(self, anime_titles):
+        queries = [f"{title} アニメ 公式サイト" for title in anime_titles]
+        response = self.client.search(queries if len(queries) > 1 else queries[0], max_results=5,
+                                      call_site='image_lookup')
+        if not response:
+            return {}
+
+        results = response.get('results') or []
+        # 複数クエリの場合はクエリごとの結果リストが返る
+        if len(queries) == 1 or (results and not isinstance(results[0], list)):
+            grouped = [results] if len(queries) == 1 else []
+        else:
+            grouped = results
+
+        found = {}
+        for title, items in zip(anime_titles, grouped):
+            urls = [item.get('url') for item in items if isinstance(item, dict)]
+            urls = [u for u in urls if _is_http_url(u)]
+            if urls:
+                found[title] = _candidates([u for u in urls if is_image_url(u)], urls)
+        return found
+
+
+class StructuredStrategy(ImageLookupStrategy):
+    """公式サイト・キービジュアル候補をJSON形式でまとめて問い合わせる"""
+
+    name = 'structured'
+    batch_size = 10
+
+    def discover(self, anime_titles):
+        listing = '\n'.join(f"{i}. {title}" for i, title in enumerate(anime_titles, 1))
+        messages = [
+            {
+                "role": "system",
+                "content": "あなたはアニメ作品の公式情報を調べるアシスタントです。指定されたJSON形式のみで回答し、説明文やコードフェンスは出力しないでください。"
+            },
+            {
+                "role": "user",
+                "content": (
+                    "次のアニメ作品それぞれについて、日本の公式サイトのURLと、キービジュアル画像の直接URL候補（最大3件）を調べてください。\n"
+                    "不明な項目は null または空配列にしてください。titleには入力の作品名をそのまま入れてください。\n"
+                    '形式: {"results": [{"title": "作品名", "official_site": "https://...", "key_visual_urls": ["https://..."]}]}\n'
+                    f"作品:\n{listing}"
+                )
+            }
+        ]
+
+        # 1作品あたりのURL数は少ないため、自由記述より大幅に少ないトークン数で足りる
+        max_tokens = min(2048, 80 + 160 * len(anime_titles))
+        response = self.client.chat_completion(
+            messages,
+            model="sonar",
+            max_tokens=max_tokens,
+            temperature=0.1,
+            response_format={"type": "json_schema", "json_schema": {"schema": IMAGE_LOOKUP_SCHEMA}},
+            call_site="image_lookup"
+        )
+        if not response or 'choices' not in response:
+            return {}
+
+        content = response['choices'][0]['message']['content']
+        parsed = parse_image_lookup_json(content, anime_titles)
+        if parsed is None:
+            print("画像検索結果のJSON解析に失敗しました。次の検索方法にフォールバックします。")
+            return {}
+
+        # 1作品のみの問い合わせでは引用元も公式サイト候補として使える
+        cited = _urls_from_response(response) if len(anime_titles) == 1 else []
+        found = {}
+        for title, item in parsed.items():
+            sites = ([item['official_site']] if item['official_site'] else []) + cited
+            if item['key_visual_urls'] or sites:
+                found[title] = _candidates(item['key_visual_urls'], sites)
+        return found
+
+
+class CitationsStrategy(ImageLookupStrategy):
+    """短いチャット呼び出しの citations / search_results を公式サイト候補にする"""
+
+    name = 'citations'
+
+    def discover(self, anime_titles):
+        title = anime_titles[0]
+        messages = [
+            {"role": "user", "content": f"アニメ「{title}」の公式サイトはどこですか？URLのみ答えてください。"}
+        ]
+        # 本文はほぼ使わないため出力トークンは最小限にする
+        response = self.client.chat_completion(messages, model="sonar", max_tokens=64, temperature=0.1,
+                                               call_site="image_lookup")
+        if not response:
+            return {}
+
+        urls = _urls_from_response(response)
+        if 'choices' in response:
+            content = response['choices'][0]['message']['content'] or ''
+            urls += [u for u in re.findall(r'https?://[^\s<>"\)\]]+', content) if u not in urls]
+        if not urls:
+            return {}
+        return {title: _candidates([u for u in urls if is_image_url(u)], urls)}
+
+
+class ChatStrategy(ImageLookupStrategy):
+    """自由記述の回答からURLを抽出する（従来の検索）"""
+
+    name = 'chat'
+
+    def discover(self, anime_titles):
+        title = anime_titles[0]
+        query = f"{title} 公式サイト 画像 アニメ"
+        messages = [
+            {
+                "role": "user",
+                "content": f"以下のアニメの公式サイトや公式画像のURLを教えてください。可能であれば、高品質な画像の直接リンクも含めてください：{query}"
+            }
+        ]
+
+        response = self.client.chat_completion(messages, model="sonar", max_tokens=1000, call_site="image_lookup")
+        if not response or 'choices' not in response:
+            return {}
+
+        content = response['choices'][0]['message']['content']
+
+        # URLを抽出
+        urls = re.findall(r'https?://[^\s<>"]+', content)
+        if not urls:
+            return {}
+        return {title: _candidates([u for u in urls if is_image_url(u)], urls)}
+
+
+STRATEGY_CLASSES = {
+    cls.name: cls for cls in (SearchStrategy, StructuredStrategy, CitationsStrategy, ChatStrategy)
+}
+
+
+class ImageResolver:
+    """
+    複数の検索戦略を順に試して作品の公式画像を解決する
+
+    各戦略は候補URLを返すだけで、実際の画像の検証（HEADリクエスト・公式サイトの解析）は
+    verify(作品名, 画像URL候補, サイトURL候補) に任せる。ある戦略で画像が見つからなかった
+    作品だけが次の戦略に回される。戦略ごとの所要時間と成功数は stats() で参照できる。
+    ジョブの残り時間が投稿に必要な分（deadlines.post_reserve_seconds）を下回ったら、残りの作品は画像なしにする。
+    """
+
+    def __init__(self, client, verify, strategies=None):
+        """
+        Args:
+            client (PerplexityClient): APIクライアント
+            verify (callable): verify(作品名, 画像URL候補, サイトURL候補) -> dict|None
+            strategies (list): 戦略名の実行順（省略時は IMAGE_RESOLVER_STRATEGIES または既定順）
+        """
+        if strategies is None:
+            env_order = os.getenv('IMAGE_RESOLVER_STRATEGIES', '')
+            strategies = [s.strip() for s in env_order.split(',') if s.strip()] or DEFAULT_STRATEGY_ORDER
+        unknown = [s for s in strategies if s not in STRATEGY_CLASSES]
+        if unknown:
+            raise ValueError(f"不明な画像検索戦略です: {', '.join(unknown)}（利用可能: {', '.join(STRATEGY_CLASSES)}）")
+
+        self.client = client
+        self.verify = verify
+        self.strategies = [STRATEGY_CLASSES[name](client) for name in strategies]
+        self._lock = threading.Lock()
+        self._stats = {
+            s.name: {'calls': 0, 'titles': 0, 'candidates': 0, 'resolved': 0, 'errors': 0,
+                     'discover_seconds': 0.0, 'verify_seconds': 0.0}
+            for s in self.strategies
+        }
+
+    def resolve(self, anime_titles):
+        """
+        作品名リストの画像を解決する
+
+        Returns:
+            dict: { アニメタイトル: { 'url': 画像URL, 'source': 参照元URL or None } or None }
+        """
+        results = {title: None for title in anime_titles}
+        remaining = list(dict.fromkeys(anime_titles))
+
+        for strategy in self.strategies:
+            if not remaining:
+                break
+            size = max(1, strategy.batch_size)
+            for i in range(0, len(remaining), size):
+                if not current_deadline().allows(post_reserve_seconds()):
+                    print(f"残り時間が少ないため、画像検索（{strategy.name}）を打ち切ります。")
+                    return results
+                batch = remaining[i:i + size]
+                started = time.perf_counter()
+                try:
+                    with span('image.discover', strategy=strategy.name, titles=len(batch)) as s:
+                        found = strategy.discover(batch) or {}
+                        s.set_attribute('found', len(found))
+                    error = False
+                except Exception as e:
+                    print(f"画像検索（{strategy.name}）でエラーが発生: {e}")
+                    found = {}
+                    error = True
+                discovered = time.perf_counter()
+
+                resolved = 0
+                for title, candidates in found.items():
+                    if title not in results:
+                        continue
+                    try:
+                        with span('image.verify', strategy=strategy.name, title=title,
+                                  image_candidates=len(candidates['image_urls']),
+                                  site_candidates=len(candidates['site_urls'])) as s:
+                            result_obj = self.verify(title, candidates['image_urls'], candidates['site_urls'])
+                            s.set_attribute('resolved', bool(result_obj))
+                    except Exception as e:
+                        print(f"画像の検証エラー: {title}: {e}")
+                        result_obj = None
+                    if result_obj:
+                        result_obj.setdefault('strategy', strategy.name)
+                        results[title] = result_obj
+                        resolved += 1
+
+                self._record(strategy.name, len(batch), len(found), resolved, error,
+                             discovered - started, time.perf_counter() - discovered)
+            remaining = [t for t in remaining if results[t] is None]
+
+        return results
+
+    def _record(self, name, titles, candidates, resolved, error, discover_seconds, verify_seconds):
+        with self._lock:
+            stats = self._stats[name]
+            stats['calls'] += 1
+            stats['titles'] += titles
+            stats['candidates'] += candidates
+            stats['resolved'] += resolved
+            stats['errors'] += 1 if error else 0
+            stats['discover_seconds'] += discover_seconds
+            stats['verify_seconds'] += verify_seconds
+
+    def stats(self):
+        """戦略ごとの呼び出し回数・成功率・平均所要時間を返す"""
+        with self._lock:
+            report = {}
+            for name, s in self._stats.items():
+                calls = s['calls'] or 1
+                titles = s['titles'] or 1
+                report[name] = dict(
+                    s,
+                    success_rate=s['resolved'] / titles if s['titles'] else 0.0,
+                    avg_discover_ms=s['discover_seconds'] / calls * 1000 if s['calls'] else 0.0,
+                    avg_verify_ms=s['verify_seconds'] / calls * 1000 if s['calls'] else 0.0
+                )
+            return report
+
+    def format_stats(self):
+        """stats() を表示用の文字列に整形"""
+        lines = []
+        for name, s in self.stats().items():
+            lines.append(
+                f"{name:<10} 呼び出し {s['calls']:>3}回  作品 {s['titles']:>3}件  解決 {s['resolved']:>3}件 "
+                f"({s['success_rate']:.0%})  探索 {s['avg_discover_ms']:.0f}ms/回  検証 {s['avg_verify_ms']:.0f}ms/回"
+            )
+        return '\n'.join(lines)
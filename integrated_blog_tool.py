@@ -1,21 +1,25 @@
 import os
-import requests
 import base64
 import sys
 import re
-import json
 from datetime import datetime
-from dotenv import load_dotenv
-from perplexity_client import PerplexityClient, create_blog_article
+from perplexity_client import PerplexityClient, create_blog_article, create_http_session, load_environment
+from image_cache import ImageCache
+from image_resolver import ImageResolver, is_blocked_url, site_score
+from usage_ledger import get_ledger, job_scope
+from tracing import span, start_trace, traced
+from heading_index import HeadingIndex, apply_edits, rank_lines
+from deadlines import DeadlineExceeded, JobCancelled, current_deadline, post_reserve_seconds, wp_timeout
+from metrics import ACTIVE_GENERATIONS, SITE_FETCH_BYTES, SITE_FETCH_LATENCY, WP_POST_LATENCY, WP_POSTS
 from urllib.parse import urljoin, urlparse
 import time
 
-# .envファイルから環境変数を読み込み
-load_dotenv()
-
 class IntegratedBlogTool:
     def __init__(self):
         """統合ブログツールを初期化"""
+        # .envファイルから環境変数を読み込み
+        load_environment()
+        
         # Perplexity API設定
         self.perplexity_api_key = os.getenv('PERPLEXITY_API_KEY')
         if not self.perplexity_api_key:
@@ -28,16 +32,24 @@ class IntegratedBlogTool:
         
         # Perplexityクライアントを初期化
         self.perplexity_client = PerplexityClient()
+        # 記事生成のメッセージ形式（perplexity_client.PROMPT_FORMATS、None の場合は BLOG_TOOL_PROMPT_FORMAT）
+        self.prompt_format = None
         
-        # 画像キャッシュ（永続化）
-        self.image_cache = {}
+        # 画像キャッシュ（永続化・作品名の正規化/あいまい一致に対応）
         self._image_cache_path = os.path.join(os.getcwd(), 'image_cache.json')
-        try:
-            if os.path.exists(self._image_cache_path):
-                with open(self._image_cache_path, 'r', encoding='utf-8') as f:
-                    self.image_cache = json.load(f)
-        except Exception as e:
-            print(f"画像キャッシュ読み込みエラー: {e}")
+        self.image_cache = ImageCache(self._image_cache_path)
+        
+        # 画像検索の戦略（順序は IMAGE_RESOLVER_STRATEGIES で変更可能）
+        self.image_resolver = ImageResolver(self.perplexity_client, self._resolve_image_from_urls)
+        
+        # 公式サイト・WordPress への HTTP セッション（初回使用時に作成）
+        self._session = None
+    
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = create_http_session()
+        return self._session
     
     def search_anime_image(self, anime_title):
         """
@@ -50,106 +62,97 @@ class IntegratedBlogTool:
             dict|None: { 'url': 画像URL, 'source': 参照元URL or None }
         """
         try:
-            # キャッシュから画像を取得
-            if anime_title in self.image_cache:
-                print(f"キャッシュから画像を取得: {anime_title}")
-                cached = self.image_cache[anime_title]
-                if isinstance(cached, dict):
-                    return cached
-                return {'url': cached, 'source': None}
-
-            # シンプルな単一クエリで高速化
-            search_queries = [
-                f"{anime_title} 公式サイト 画像 アニメ"
-            ]
-            
-            for query in search_queries:
-                try:
-                    messages = [
-                        {
-                            "role": "user", 
-                            "content": f"以下のアニメの公式サイトや公式画像のURLを教えてください。可能であれば、高品質な画像の直接リンクも含めてください：{query}"
-                        }
-                    ]
-                    
-                    response = self.perplexity_client.chat_completion(messages, model="sonar", max_tokens=1000)
-                    
-                    if response and 'choices' in response:
-                        content = response['choices'][0]['message']['content']
-                        
-                    # URLを抽出
-                    urls = re.findall(r'https?://[^\s<>"]+', content)
-
-                    # ブロックリスト（日本で一般的でない/不適切ソースを除外）
-                    blocked_domains = [
-                        'crunchyroll', 'pinterest', 'facebook', 'twitter', 'x.com', 'instagram',
-                        'myanimelist', 'anilist', 'kitsu', 'fandom.com', 'tumblr', 'deviantart'
-                    ]
-                        
-                    # 画像URLを探す（直接リンク優先。ブロックドメインは除外）
-                    for url in urls:
-                        lower = url.lower()
-                        if any(b in lower for b in blocked_domains):
-                            continue
-                        if any(ext in lower for ext in ['.jpg', '.jpeg', '.png', '.webp', '.gif']):
-                            if self._is_valid_image_url(url):
-                                result_obj = {'url': url, 'source': None}
-                                self.image_cache[anime_title] = result_obj
-                                self._save_image_cache()
-                                print(f"画像URLを発見: {url}")
-                                return result_obj
-                        
-                    # 公式サイトのURLをスコアリングして探索
-                    def site_score(u: str) -> int:
-                        s = 0
-                        lu = u.lower()
-                        if any(b in lu for b in blocked_domains):
-                            s -= 100
-                        if 'official' in lu:
-                            s += 20
-                        if lu.endswith('.jp') or '.jp/' in lu:
-                            s += 10
-                        if any(k in lu for k in ['anime', '/tv', '/news']):
-                            s += 4
-                        # SNS/動画サイトは避ける
-                        if any(k in lu for k in ['youtube', 'tiktok', 'instagram', 'x.com', 'twitter']):
-                            s -= 20
-                        return s
-
-                    candidate_sites = sorted(urls, key=site_score, reverse=True)
-                    for url in candidate_sites:
-                        if any(b in url.lower() for b in blocked_domains):
-                            continue
-                        image_url = self._extract_image_from_official_site(url, anime_title)
-                        if image_url:
-                            result_obj = {'url': image_url, 'source': url}
-                            self.image_cache[anime_title] = result_obj
-                            self._save_image_cache()
-                            print(f"公式サイトから画像を取得: {image_url}")
-                            return result_obj
-                    
-                    # 待機短縮
-                    time.sleep(0.05)
-                    
-                except Exception as e:
-                    print(f"検索クエリ '{query}' でエラーが発生: {e}")
-                    continue
-            
-            print(f"画像が見つかりませんでした: {anime_title}")
-            return None
-            
+            return self.search_anime_images([anime_title]).get(anime_title)
         except Exception as e:
             print(f"画像検索エラー: {e}")
             return None
     
+    def search_anime_images(self, anime_titles):
+        """
+        複数のアニメの公式画像をまとめて検索・取得
+        
+        キャッシュにない作品は ImageResolver の戦略（Search API → JSON形式の一括問い合わせ →
+        citations → 従来の自由記述）を順に試して解決する。
+        
+        Args:
+            anime_titles (list): アニメタイトルのリスト
+        
+        Returns:
+            dict: { アニメタイトル: { 'url': 画像URL, 'source': 参照元URL or None } or None }
+        """
+        results = {}
+        pending = []
+        for title in anime_titles:
+            if title in results or title in pending:
+                continue
+            # キャッシュから画像を取得（表記ゆれも同一作品として照合）
+            cached = self.image_cache.get(title)
+            if cached:
+                print(f"キャッシュから画像を取得: {title}")
+                results[title] = cached
+            else:
+                pending.append(title)
+        
+        if pending and not current_deadline().allows(post_reserve_seconds()):
+            # ジョブの残り時間が投稿に必要な分しかない場合は、画像なしで投稿する
+            print(f"残り時間が少ないため、{len(pending)}作品の画像検索を省略します。")
+            results.update((title, None) for title in pending)
+            pending = []
+        
+        if pending:
+            with span('image.lookup', titles=len(pending), cached=len(results)):
+                resolved = self.image_resolver.resolve(pending)
+            for title in pending:
+                result_obj = resolved.get(title)
+                if result_obj:
+                    self.image_cache.set(title, result_obj)
+                else:
+                    print(f"画像が見つかりませんでした: {title}")
+                results[title] = result_obj
+        
+        return results
+    
+    def _resolve_image_from_urls(self, anime_title, image_urls, site_urls):
+        """
+        画像URL候補と公式サイト候補から実際に使える画像を選ぶ
+        
+        Returns:
+            dict|None: { 'url': 画像URL, 'source': 参照元URL or None }
+        """
+        # 画像URLを探す（直接リンク優先。ブロックドメインは除外）
+        for url in image_urls:
+            if is_blocked_url(url):
+                continue
+            if self._is_valid_image_url(url):
+                print(f"画像URLを発見: {url}")
+                return {'url': url, 'source': None}
+        
+        # 公式サイトのURLをスコアリングして探索（残り時間が少なくなったら打ち切る）
+        candidate_sites = sorted(dict.fromkeys(site_urls), key=site_score, reverse=True)
+        for url in candidate_sites:
+            if is_blocked_url(url):
+                continue
+            if not current_deadline().allows(post_reserve_seconds()):
+                break
+            image_url = self._extract_image_from_official_site(url, anime_title)
+            if image_url:
+                print(f"公式サイトから画像を取得: {image_url}")
+                return {'url': image_url, 'source': url}
+        
+        return None
+    
     def _is_valid_image_url(self, url):
         """画像URLの妥当性をチェック"""
         try:
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
-            response = requests.head(url, headers=headers, timeout=5)
-            content_type = response.headers.get('content-type', '').lower()
+            with span('http.head', url=url) as s:
+                deadline = current_deadline()
+                response = deadline.call(self.session.head, url, headers=headers,
+                                         timeout=deadline.timeout(5, '画像URL検証'))
+                content_type = response.headers.get('content-type', '').lower()
+                s.set_attributes(http_status=response.status_code, content_type=content_type)
             return 'image' in content_type and response.status_code == 200
         except Exception as e:
             print(f"画像URL検証エラー: {e}")
@@ -162,14 +165,27 @@ class IntegratedBlogTool:
         2) key visual っぽいファイル名を優先 (keyvisual/kv/main/visual)
         3) それ以外の <img> だが、イベント/ロゴ/バナー/サムネは除外
         """
+        import requests  # 起動時間短縮のため使用時に読み込む
         try:
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
-            response = requests.get(site_url, headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            html = response.text
+            with span('http.site_fetch', url=site_url) as s:
+                deadline = current_deadline()
+                timeout = deadline.timeout(10, '公式サイト取得')
+                started = time.perf_counter()
+                try:
+                    response = deadline.call(self.session.get, site_url, headers=headers, timeout=timeout)
+                except requests.exceptions.RequestException:
+                    SITE_FETCH_LATENCY.observe(time.perf_counter() - started, status='error')
+                    raise
+                SITE_FETCH_LATENCY.observe(time.perf_counter() - started, status=str(response.status_code))
+                SITE_FETCH_BYTES.observe(len(response.content))
+                s.set_attribute('http_status', response.status_code)
+                response.raise_for_status()
+                
+                html = response.text
+                s.set_attribute('bytes', len(response.content))
 
             candidates = []
 
@@ -239,6 +255,7 @@ class IntegratedBlogTool:
             print(f"公式サイトからの画像抽出エラー: {e}")
             return None
     
+    @traced('html.add_images')
     def add_images_to_anime_ranking(self, content):
         """
         アニメランキング記事に画像を追加
@@ -249,132 +266,53 @@ class IntegratedBlogTool:
         Returns:
             str: 画像が追加された記事コンテンツ
         """
-        updated_content = content
         found_images = 0
 
         # HTMLかどうかを判定
         is_html = bool(re.search(r'<\s*h3\b', content, flags=re.IGNORECASE))
 
         if is_html:
-            # <h3>第X位: 作品名</h3> を検出して直後に挿入
-            heading_pattern = re.compile(r'(<h3[^>]*>\s*第(\d+)位[：:]\s*([^<]+?)\s*</h3>)', re.IGNORECASE)
-
-            def replace_heading(match):
-                nonlocal found_images
-                full_heading = match.group(1)
-                rank = match.group(2)
-                title = match.group(3).strip()
-
-                print(f"第{rank}位「{title}」の画像を検索中（HTML）...")
-                result = self.search_anime_image(title)
-                if not result:
-                    print(f"✗ 第{rank}位「{title}」の画像が見つかりませんでした")
-                    return full_heading
-
-                image_url = result['url']
-                source_url = result.get('source')
-                caption = f"{title} 公式画像"
-                if source_url:
-                    caption += f'｜出典: <a href="{source_url}" target="_blank" rel="nofollow noopener">公式サイト</a>'
-
-                img_html = (
-                    f'\n<div class="anime-image">\n'
-                    f'<img src="{image_url}" alt="{title} 公式画像" loading="lazy">\n'
-                    f'<p class="anime-image-caption">{caption}</p>\n'
-                    f'</div>\n'
-                )
-                found_images += 1
-                print(f"✓ 第{rank}位「{title}」の画像を追加しました")
-                time.sleep(0.5)
-                return full_heading + img_html
-
-            updated_content = heading_pattern.sub(replace_heading, updated_content)
+            # <h3>第X位: 作品名</h3> を1回の走査で集め、直後に挿入
+            ranked = [(h.rank, h.title, h.end) for h in HeadingIndex(content).ranked(3)]
+            print(f"アニメランキング記事を検出しました。{len(ranked)}作品の画像を検索します（HTML）...")
         else:
-            # プレーンテキスト/Markdownの見出しから抽出
-            anime_titles = []
-            for line in content.split('\n'):
-                match = re.search(r'第(\d+)位[：:]\s*(.+?)(?:\n|$)', line)
-                if match:
-                    rank = match.group(1)
-                    title = match.group(2).strip()
-                    title = re.sub(r'<[^>]+>', '', title)
-                    anime_titles.append((rank, title))
-
-            print(f"アニメランキング記事を検出しました。{len(anime_titles)}作品の画像を検索します...")
-
-            for i, (rank, title) in enumerate(anime_titles, 1):
-                print(f"第{rank}位「{title}」の画像を検索中... ({i}/{len(anime_titles)})")
-                result = self.search_anime_image(title)
-                if result:
-                    image_url = result['url']
-                    source_url = result.get('source')
-                    caption = f"{title} 公式画像"
-                    if source_url:
-                        caption += f'｜出典: <a href="{source_url}" target="_blank" rel="nofollow noopener">公式サイト</a>'
-                    img_html = (
-                        f'\n<div class="anime-image">\n'
-                        f'<img src="{image_url}" alt="{title} 公式画像" loading="lazy">\n'
-                        f'<p class="anime-image-caption">{caption}</p>\n'
-                        f'</div>\n'
-                    )
-                    # 見出しブロックの直後に挿入（Markdown用の簡易処理）
-                    pattern = rf'(第{rank}位[：:]\s*{re.escape(title)}\s*)'
-                    updated_content = re.sub(pattern, rf'\1{img_html}', updated_content, count=1)
-                    print(f"✓ 第{rank}位「{title}」の画像を追加しました")
-                    found_images += 1
-                    time.sleep(0.5)
-                else:
-                    print(f"✗ 第{rank}位「{title}」の画像が見つかりませんでした")
+            # プレーンテキスト/Markdownの見出しから抽出（見出しブロックの直後に挿入）
+            ranked = rank_lines(content)
+            print(f"アニメランキング記事を検出しました。{len(ranked)}作品の画像を検索します...")
+
+        # 先に全作品名を集めてまとめて検索（LLM呼び出しの往復を削減）
+        results = self.search_anime_images([title for _, title, _ in ranked])
+
+        edits = []
+        for rank, title, position in ranked:
+            result = results.get(title)
+            if not result:
+                print(f"✗ 第{rank}位「{title}」の画像が見つかりませんでした")
+                continue
+            edits.append((position, position, self._anime_image_html(title, result)))
+            found_images += 1
+            print(f"✓ 第{rank}位「{title}」の画像を追加しました")
+        updated_content = apply_edits(content, edits)
 
         print(f"画像添付が完了しました。合計 {found_images} 件の画像を追加しました。")
         return updated_content
 
-    def generate_article_content(self, theme, prompt_template_file="prompt_template.txt", max_tokens=4096):
-        """記事本文のみ生成（投稿はしない）"""
+    def generate_article_content(self, theme, prompt_template_file="prompt_template.txt", max_tokens=4096, variables=None):
+        """記事本文のみ生成（投稿はしない。variables: テーマ以外のテンプレート変数）"""
+        with start_trace('article.generate_content', theme=theme, template=prompt_template_file, max_tokens=max_tokens), \
+                ACTIVE_GENERATIONS.track_inprogress():
+            return self._generate_article_content(theme, prompt_template_file, max_tokens, variables)
+
+    def _generate_article_content(self, theme, prompt_template_file, max_tokens, variables=None):
         print(f"プレビュー用に記事本文を生成中... テーマ: {theme}")
-        raw_article = create_blog_article(theme, self.perplexity_client, prompt_template_file, max_tokens)
+        raw_article = create_blog_article(theme, self.perplexity_client, prompt_template_file, max_tokens, variables,
+                                          self.prompt_format)
+        current_deadline().check('記事生成')
         if not raw_article or not str(raw_article).strip():
             return None
-        article_text = str(raw_article).strip()
-        if '```' in article_text:
-            start_idx = article_text.find('```')
-            end_idx = article_text.rfind('```')
-            if end_idx > start_idx:
-                inner = article_text[start_idx + 3:end_idx].strip()
-                first_nl = inner.find('\n')
-                if first_nl != -1:
-                    first_line = inner[:first_nl].strip().lower()
-                    if first_line in ('html', 'markdown', 'md'):
-                        inner = inner[first_nl + 1:].strip()
-                article_text = inner
-        title = ""
-        md_title_match = re.search(r'^#\s+(.+)$', article_text, re.MULTILINE)
-        if md_title_match:
-            title = md_title_match.group(1).strip()
-        else:
-            h1_match = re.search(r'<h1[^>]*>(.*?)</h1>', article_text, flags=re.IGNORECASE | re.DOTALL)
-            if h1_match:
-                title = re.sub(r'<[^>]+>', '', h1_match.group(1)).strip()
-        if not title:
-            title = f"{theme}について"
-        is_html = bool(re.search(r'<(h1|h2|h3|h4|p|ul|ol|div|section|article)\b', article_text, flags=re.IGNORECASE))
-        if is_html:
-            body_html = re.sub(r'^\s*<h1[^>]*>.*?</h1>\s*', '', article_text, flags=re.IGNORECASE | re.DOTALL)
-            html_content = body_html.strip()
-        else:
-            lines = article_text.split('\n')
-            content_lines = []
-            in_content = False
-            for ln in lines:
-                if re.match(r'^\s*##\s+', ln) or re.match(r'^\s*###\s+', ln) or ln.startswith('- ') or re.match(r'^\s*\d+\. ', ln):
-                    in_content = True
-                    content_lines.append(ln)
-                elif in_content:
-                    content_lines.append(ln)
-            content_md = '\n'.join([l for l in content_lines if l.strip()])
-            if not content_md.strip():
-                content_md = article_text
-            html_content = self._convert_to_html(content_md)
+        article_text = self._strip_code_fence(str(raw_article).strip())
+        title = self._extract_title(article_text, theme)
+        html_content = self._extract_body_html(article_text)
         # ランキング画像挿入と目次
         if ('ランキング' in theme) or ('ランキング' in prompt_template_file) or re.search(r'第\d+位', html_content):
             html_content = self.add_images_to_anime_ranking(html_content)
@@ -382,7 +320,8 @@ class IntegratedBlogTool:
         html_content = self._postprocess_html(html_content)
         return {'title': title, 'html': html_content}
 
-    def generate_and_post_article(self, theme, status="draft", prompt_template_file="prompt_template.txt", max_tokens=4096):
+    def generate_and_post_article(self, theme, status="draft", prompt_template_file="prompt_template.txt", max_tokens=4096,
+                                  variables=None):
         """
         記事を生成してWordPressに投稿
         
@@ -391,84 +330,44 @@ class IntegratedBlogTool:
             status (str): 投稿ステータス ("draft" または "publish")
             prompt_template_file (str): プロンプトテンプレートファイルのパス
             max_tokens (int): 最大トークン数（デフォルト: 4096）
+            variables (dict): テーマ以外のテンプレート変数（ranking_count・audience など）
         
         Returns:
             dict: 投稿結果
+        
+        ジョブの期限（deadlines.deadline_scope）があれば各処理はその残り時間内で行い、残りが投稿に必要な分
+        （BLOG_TOOL_POST_RESERVE）を下回った場合は画像検索を省略して投稿する。取り消された場合は投稿しない。
         """
+        with start_trace('article.generate_and_post', theme=theme, template=prompt_template_file,
+                         status=status, max_tokens=max_tokens), \
+                ACTIVE_GENERATIONS.track_inprogress():
+            return self._generate_and_post_article(theme, status, prompt_template_file, max_tokens, variables)
+    
+    def _generate_and_post_article(self, theme, status, prompt_template_file, max_tokens, variables=None):
         print(f"テーマ '{theme}' で記事を生成中...")
         print(f"使用テンプレート: {prompt_template_file}")
         print(f"最大トークン数: {max_tokens}")
         
         try:
             # 記事を生成
-            raw_article = create_blog_article(theme, self.perplexity_client, prompt_template_file, max_tokens)
+            raw_article = create_blog_article(theme, self.perplexity_client, prompt_template_file, max_tokens, variables,
+                                              self.prompt_format)
+            # 取り消された・期限を過ぎた場合は投稿しない（失敗時の文言を記事として投稿しないようにする）
+            deadline = current_deadline()
+            deadline.check('記事生成')
             
             if not raw_article or not str(raw_article).strip():
                 print("記事の生成に失敗しました。コンテンツが空です。")
                 return None
             
-            article_text = str(raw_article).strip()
-            
             # コードフェンス（```）で囲まれている場合は中身を抽出
-            if '```' in article_text:
-                start_idx = article_text.find('```')
-                end_idx = article_text.rfind('```')
-                if end_idx > start_idx:
-                    inner = article_text[start_idx + 3:end_idx].strip()
-                    # 先頭に言語指定がある場合は除去
-                    first_nl = inner.find('\n')
-                    if first_nl != -1:
-                        first_line = inner[:first_nl].strip().lower()
-                        if first_line in ('html', 'markdown', 'md'):
-                            inner = inner[first_nl + 1:].strip()
-                    article_text = inner
+            article_text = self._strip_code_fence(str(raw_article).strip())
             
-            # タイトル抽出
-            title = ""
-            md_title_match = re.search(r'^#\s+(.+)$', article_text, re.MULTILINE)
-            if md_title_match:
-                title = md_title_match.group(1).strip()
-            else:
-                h1_match = re.search(r'<h1[^>]*>(.*?)</h1>', article_text, flags=re.IGNORECASE | re.DOTALL)
-                if h1_match:
-                    # タグを除去
-                    title = re.sub(r'<[^>]+>', '', h1_match.group(1)).strip()
-            if not title:
-                # 最初の非空行から推測
-                for ln in article_text.splitlines():
-                    clean_ln = ln.strip()
-                    if not clean_ln or clean_ln.startswith('```'):
-                        continue
-                    # タグを除去
-                    guess = re.sub(r'<[^>]+>', '', clean_ln).strip()
-                    if guess:
-                        title = guess
-                        break
-            if not title:
-                title = f"{theme}について"
+            # タイトル抽出（見出しが無ければ最初の非空行から推測）
+            title = self._extract_title(article_text, theme, guess_from_first_line=True)
             
             # 本文抽出とHTML判定
-            is_html = bool(re.search(r'<(h1|h2|h3|h4|p|ul|ol|div|section|article)\b', article_text, flags=re.IGNORECASE))
-            if is_html:
-                # 先頭のH1があれば除去
-                body_html = re.sub(r'^\s*<h1[^>]*>.*?</h1>\s*', '', article_text, flags=re.IGNORECASE | re.DOTALL)
-                html_content = body_html.strip()
-            else:
-                # Markdownから本文を抽出
-                lines = article_text.split('\n')
-                content_lines = []
-                in_content = False
-                for ln in lines:
-                    if re.match(r'^\s*##\s+', ln) or re.match(r'^\s*###\s+', ln) or ln.startswith('- ') or re.match(r'^\s*\d+\. ', ln):
-                        in_content = True
-                        content_lines.append(ln)
-                    elif in_content:
-                        content_lines.append(ln)
-                content_md = '\n'.join([l for l in content_lines if l.strip()])
-                if not content_md.strip():
-                    # フォールバックとして全文を使用
-                    content_md = article_text
-                html_content = self._convert_to_html(content_md)
+            html_content = self._extract_body_html(article_text)
             
             # アニメランキング記事の場合、画像を追加（HTMLに対して実施）
             if ('ランキング' in theme) or ('ランキング' in prompt_template_file) or re.search(r'第\d+位', html_content):
@@ -482,6 +381,7 @@ class IntegratedBlogTool:
             html_content = self._postprocess_html(html_content)
 
             print(f"生成されたタイトル: {title}")
+            deadline.check('WordPress投稿')
             print("WordPressに投稿中...")
             
             # WordPressに投稿
@@ -500,10 +400,80 @@ class IntegratedBlogTool:
                 print("WordPressへの投稿に失敗しました。")
                 return None
                 
+        except (DeadlineExceeded, JobCancelled) as e:
+            print(f"記事の生成を中止しました: {e}")
+            return None
         except Exception as e:
             print(f"エラーが発生しました: {e}")
             return None
     
+    def _strip_code_fence(self, article_text):
+        """コードフェンス（```）で囲まれている場合は中身を抽出（先頭の言語指定も除去）"""
+        if '```' not in article_text:
+            return article_text
+        start_idx = article_text.find('```')
+        end_idx = article_text.rfind('```')
+        if end_idx <= start_idx:
+            return article_text
+        inner = article_text[start_idx + 3:end_idx].strip()
+        first_nl = inner.find('\n')
+        if first_nl != -1:
+            first_line = inner[:first_nl].strip().lower()
+            if first_line in ('html', 'markdown', 'md'):
+                inner = inner[first_nl + 1:].strip()
+        return inner
+    
+    def _extract_title(self, article_text, theme, guess_from_first_line=False):
+        """Markdownの # 見出し または <h1> からタイトルを抽出"""
+        title = ""
+        md_title_match = re.search(r'^#\s+(.+)$', article_text, re.MULTILINE)
+        if md_title_match:
+            title = md_title_match.group(1).strip()
+        else:
+            h1_match = re.search(r'<h1[^>]*>(.*?)</h1>', article_text, flags=re.IGNORECASE | re.DOTALL)
+            if h1_match:
+                # タグを除去
+                title = re.sub(r'<[^>]+>', '', h1_match.group(1)).strip()
+        if not title and guess_from_first_line:
+            # 最初の非空行から推測
+            for ln in article_text.splitlines():
+                clean_ln = ln.strip()
+                if not clean_ln or clean_ln.startswith('```'):
+                    continue
+                # タグを除去
+                guess = re.sub(r'<[^>]+>', '', clean_ln).strip()
+                if guess:
+                    title = guess
+                    break
+        if not title:
+            title = f"{theme}について"
+        return title
+    
+    def _extract_body_html(self, article_text):
+        """本文をHTMLとして取り出す（HTMLなら先頭の<h1>を除去、MarkdownならHTMLに変換）"""
+        is_html = bool(re.search(r'<(h1|h2|h3|h4|p|ul|ol|div|section|article)\b', article_text, flags=re.IGNORECASE))
+        if is_html:
+            # 先頭のH1があれば除去
+            body_html = re.sub(r'^\s*<h1[^>]*>.*?</h1>\s*', '', article_text, flags=re.IGNORECASE | re.DOTALL)
+            return body_html.strip()
+        
+        # Markdownから本文を抽出
+        lines = article_text.split('\n')
+        content_lines = []
+        in_content = False
+        for ln in lines:
+            if re.match(r'^\s*##\s+', ln) or re.match(r'^\s*###\s+', ln) or ln.startswith('- ') or re.match(r'^\s*\d+\. ', ln):
+                in_content = True
+                content_lines.append(ln)
+            elif in_content:
+                content_lines.append(ln)
+        content_md = '\n'.join([l for l in content_lines if l.strip()])
+        if not content_md.strip():
+            # フォールバックとして全文を使用
+            content_md = article_text
+        return self._convert_to_html(content_md)
+    
+    @traced('html.convert')
     def _convert_to_html(self, markdown_content):
         """Markdown形式のコンテンツをHTMLに変換"""
         html = ""
@@ -539,12 +509,16 @@ class IntegratedBlogTool:
         }
         
         try:
-            response = requests.post(
-                self.wp_url,
-                json=payload,
-                auth=(self.wp_username, self.wp_password),
-                headers=headers
-            )
+            with span('wordpress.post', status=status, bytes=len(content)) as s, WP_POST_LATENCY.time():
+                response = self.session.post(
+                    self.wp_url,
+                    json=payload,
+                    auth=(self.wp_username, self.wp_password),
+                    headers=headers,
+                    timeout=current_deadline().timeout(wp_timeout(), 'WordPress投稿')
+                )
+                s.set_attribute('http_status', response.status_code)
+            WP_POSTS.inc(status=str(response.status_code))
             
             if response.status_code == 201:
                 return response.json()
@@ -554,9 +528,11 @@ class IntegratedBlogTool:
                 return None
                 
         except Exception as e:
+            WP_POSTS.inc(status='error')
             print(f"投稿エラー: {e}")
             return None
 
+    @traced('html.toc')
     def _inject_rank_title_toc(self, html_content: str) -> str:
         """<h3>第X位: 作品名</h3> をもとに、順位＋作品名のみの目次を生成して挿入。
         - 各<h3>に安定したidを付与し、<h2>目次</h2>配下の<ul>でリンクを作成。
@@ -564,81 +540,74 @@ class IntegratedBlogTool:
         - 挿入位置は <h2>ランキング紹介</h2> の直後。なければ最初の<h2>の直後。
         """
         try:
-            content = html_content
-
-            # 既存の目次ブロックを削除（<h2>.*目次.*</h2> ～ 次の<h2|h3>まで）
-            content = re.sub(r'<h2[^>]*>[^<]*目次[^<]*</h2>[\s\S]*?(?=(<h2|<h3))', '', content, flags=re.IGNORECASE)
+            index = HeadingIndex(html_content)
+            section_starts = index.next_section_starts((2, 3))
 
-            # <h3>見出しを列挙し、idを付与
+            # <h3>見出しのidに使う文字列
             def slugify(text: str) -> str:
                 text = re.sub(r'\s+', '-', text)
                 text = re.sub(r'[^\w\-一-龯ぁ-んァ-ヶー]', '', text)
                 return text.lower()
 
+            edits = []
             headings = []  # (rank_num, title_text, id)
-
-            def add_id_to_h3(match):
-                full = match.group(0)
-                before = match.group(1)  # <h3 ...>
-                all_text = match.group(2)  # 第X位: 作品名
-                rank_num = match.group(3)
-                title = match.group(4).strip()
-
-                # id生成
-                base_id = f"rank-{rank_num}-{slugify(title)}"
-                # 既存idが無ければ付与
-                if re.search(r'\sid=\"[^\"]+\"', before, flags=re.IGNORECASE):
-                    h3_open = before
-                    # 既存idを取得
-                    id_match = re.search(r'\sid=\"([^\"]+)\"', before, flags=re.IGNORECASE)
-                    element_id = id_match.group(1) if id_match else base_id
-                else:
-                    # 閉じる'>'直前に id を挿入
-                    h3_open = re.sub(r'>\s*$', f' id="{base_id}">', before)
-                    element_id = base_id
-
-                headings.append((rank_num, title, element_id))
-                return f"{h3_open}{all_text}</h3>"
-
-            h3_pattern = re.compile(r'(<h3[^>]*>)(第(\d+)位[：:]\s*([^<]+))</h3>', re.IGNORECASE)
-            content = h3_pattern.sub(add_id_to_h3, content)
+            toc_anchor = None
+            first_h2 = None
+            for i, heading in enumerate(index):
+                if heading.level == 2 and heading.is_plain and '目次' in heading.inner:
+                    # 既存の目次ブロックを削除（<h2>目次</h2> ～ 次の<h2|h3>まで）
+                    if section_starts[i] is not None:
+                        edits.append((heading.start, section_starts[i], ''))
+                        continue
+                if heading.level == 2:
+                    if first_h2 is None:
+                        first_h2 = heading
+                    if toc_anchor is None and heading.is_plain and re.search(r'ランキング[^<]*紹介', heading.inner):
+                        toc_anchor = heading
+                elif heading.level == 3 and heading.rank is not None:
+                    # 既存idが無ければ付与
+                    element_id = heading.element_id
+                    if element_id is None:
+                        element_id = f"rank-{heading.rank}-{slugify(heading.title)}"
+                        h3_open = heading.open_tag[:-1] + f' id="{element_id}">'
+                        edits.append((heading.start, heading.start + len(heading.open_tag), h3_open))
+                    headings.append((heading.rank, heading.title, element_id))
 
             if not headings:
-                return content
+                return apply_edits(html_content, edits)
 
             # TOCを作成
             toc_items = ''.join([f'<li><a href="#{hid}">第{num}位: {title}</a></li>' for num, title, hid in headings])
             toc_html = f'<h2>目次</h2>\n<nav class="toc" aria-label="目次">\n<ul>\n{toc_items}\n</ul>\n</nav>\n'
 
-            # ランキング紹介の直後に挿入。なければ最初の<h2>の直後
-            inserted = False
-            def insert_after(pattern):
-                nonlocal content, inserted
-                m = re.search(pattern, content, flags=re.IGNORECASE)
-                if m:
-                    idx = m.end()
-                    content = content[:idx] + '\n' + toc_html + content[idx:]
-                    inserted = True
-
-            insert_after(r'<h2[^>]*>[^<]*ランキング[^<]*紹介[^<]*</h2>')
-            if not inserted:
-                insert_after(r'<h2[^>]*>.*?</h2>')
-            if not inserted:
-                # どこにも<h2>が無い場合は先頭に
-                content = toc_html + content
+            # ランキング紹介の直後に挿入。なければ最初の<h2>の直後。どこにも<h2>が無い場合は先頭に
+            anchor = toc_anchor or first_h2
+            if anchor is not None:
+                edits.append((anchor.end, anchor.end, '\n' + toc_html))
+            else:
+                edits.append((0, 0, toc_html))
 
-            return content
+            return apply_edits(html_content, edits)
         except Exception as e:
             print(f"目次挿入エラー: {e}")
             return html_content
 
+    def _anime_image_html(self, title, result):
+        """作品画像のブロック（出典があればキャプションにリンクを付ける）"""
+        caption = f"{title} 公式画像"
+        if result.get('source'):
+            caption += f'｜出典: <a href="{result["source"]}" target="_blank" rel="nofollow noopener">公式サイト</a>'
+        return (
+            f'\n<div class="anime-image">\n'
+            f'<img src="{result["url"]}" alt="{title} 公式画像" loading="lazy">\n'
+            f'<p class="anime-image-caption">{caption}</p>\n'
+            f'</div>\n'
+        )
+
     def _save_image_cache(self):
-        try:
-            with open(self._image_cache_path, 'w', encoding='utf-8') as f:
-                json.dump(self.image_cache, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"画像キャッシュ保存エラー: {e}")
+        self.image_cache.save()
 
+    @traced('html.postprocess')
     def _postprocess_html(self, html_content: str) -> str:
         """HTML投稿前の最終整形。
         - 外部リンクに rel と noopener 付与
@@ -670,7 +639,7 @@ class IntegratedBlogTool:
         try:
             test_response = self.perplexity_client.chat_completion([
                 {"role": "user", "content": "こんにちは"}
-            ])
+            ], call_site="connection_test")
             if test_response:
                 print("✓ Perplexity API接続成功")
             else:
@@ -681,7 +650,7 @@ class IntegratedBlogTool:
         # WordPress接続テスト
         print("2. WordPress接続テスト...")
         try:
-            response = requests.get(self.wp_url.replace("/posts", ""))
+            response = self.session.get(self.wp_url.replace("/posts", ""), timeout=wp_timeout())
             if response.status_code == 200:
                 print("✓ WordPress REST API接続成功")
             else:
@@ -695,40 +664,46 @@ def main():
     print("=" * 50)
     
     try:
-        # コマンドライン引数をチェック
-        if len(sys.argv) < 2:
-            print("使用方法: python integrated_blog_tool.py <テーマ> [プロンプトテンプレートファイル] [投稿ステータス] [最大トークン数]")
+        # コマンドライン引数をチェック（--test-connections 指定時のみ接続テストを行う）
+        run_connection_test = '--test-connections' in sys.argv[1:]
+        args = [a for a in sys.argv[1:] if a != '--test-connections']
+        if len(args) < 1:
+            print("使用方法: python integrated_blog_tool.py <テーマ> [プロンプトテンプレートファイル] [投稿ステータス] [最大トークン数] [--test-connections]")
             print("例: python integrated_blog_tool.py '健康な食事の作り方'")
             print("例: python integrated_blog_tool.py '効率的な時間管理術' custom_prompt.txt")
             print("例: python integrated_blog_tool.py 'AI技術の最新動向' prompt_template.txt publish")
             print("例: python integrated_blog_tool.py '最新技術トレンド' prompt_template.txt draft 8192")
+            print("例: python integrated_blog_tool.py '健康な食事の作り方' --test-connections")
             return
         
         # テーマを取得
-        theme = sys.argv[1]
+        theme = args[0]
         
         # プロンプトテンプレートファイルを取得（オプション）
-        prompt_template_file = sys.argv[2] if len(sys.argv) > 2 else "prompt_template.txt"
+        prompt_template_file = args[1] if len(args) > 1 else "prompt_template.txt"
         
         # 投稿ステータスを取得（オプション）
-        status = sys.argv[3] if len(sys.argv) > 3 else "draft"
+        status = args[2] if len(args) > 2 else "draft"
         
         # 最大トークン数を取得（オプション）
-        max_tokens = int(sys.argv[4]) if len(sys.argv) > 4 else 4096
+        max_tokens = int(args[3]) if len(args) > 3 else 4096
         
         # ツールを初期化
         tool = IntegratedBlogTool()
         
-        # 接続テスト
-        tool.test_connections()
-        print()
+        # 接続テスト（APIを2回呼び出すため、指定時のみ実行）
+        if run_connection_test:
+            tool.test_connections()
+            print()
         
         if not theme.strip():
             print("テーマが入力されていません。")
             return
         
-        # 記事を生成して投稿
-        result = tool.generate_and_post_article(theme, status, prompt_template_file, max_tokens)
+        # 記事を生成して投稿（トークン使用量はジョブ単位で集計）
+        job_id = f"cli-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        with job_scope(job_id, template=prompt_template_file):
+            result = tool.generate_and_post_article(theme, status, prompt_template_file, max_tokens)
         
         if result:
             print("\n" + "=" * 50)
@@ -737,6 +712,7 @@ def main():
             print(f"投稿ID: {result['post_id']}")
             print(f"投稿URL: {result['post_url']}")
             print(f"ステータス: {result['status']}")
+            print(f"使用トークン: {get_ledger().job_total(job_id)}")
         else:
             print("投稿に失敗しました。")
             
@@ -0,0 +1,240 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from usage_ledger import get_ledger, job_scope
+from tracing import start_trace
+from deadlines import JobCancelled, deadline_scope, job_deadline_seconds
+
+# 完了済みのジョブを保持する件数（超えた分は古い順に破棄）
+MAX_FINISHED_JOBS = 200
+
+JOB_STATUSES = ('queued', 'running', 'succeeded', 'failed', 'cancelled')
+
+
+class JobQueueFull(Exception):
+    """待ちジョブ数が上限に達している"""
+
+
+class Job:
+    """1件のジョブの状態"""
+
+    def __init__(self, kind, params):
+        self.job_id = f"{kind}-{time.strftime('%Y%m%d_%H%M%S')}-{os.urandom(3).hex()}"
+        self.kind = kind
+        self.params = dict(params or {})
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.progress = None
+        self.tokens_used = 0
+        self.trace_id = None
+        self.cancel_requested = False
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def done(self):
+        return self.status in ('succeeded', 'failed', 'cancelled')
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'params': self.params,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'progress': self.progress,
+            'tokens_used': self.tokens_used,
+            'trace_id': self.trace_id,
+            'cancel_requested': self.cancel_requested,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'queued_seconds': round((self.started_at or time.time()) - self.created_at, 3),
+            'run_seconds': round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else None,
+        }
+
+
+class JobManager:
+    """
+    種類ごとの処理関数を登録し、ジョブを同時実行数の上限付きで実行する
+
+    処理関数は handler(params, job) の形で呼ばれ、戻り値（JSON化可能な値）がジョブの結果になる。
+    None を返した場合と例外を送出した場合は失敗として扱う。各ジョブは job_scope と
+    start_trace の中で実行されるため、トークン使用量とトレースはジョブ単位で記録される。
+    また deadline_scope の中で実行され、期限（params の deadline_seconds、なければ deadline_seconds）を
+    過ぎた処理や cancel() で取り消されたジョブは途中で止まる（取り消された場合の状態は cancelled）。
+    """
+
+    def __init__(self, max_workers=2, max_pending=20, listener=None, deadline_seconds=None, cancel_check=None):
+        """
+        Args:
+            max_workers (int): 同時に実行するジョブ数
+            max_pending (int): 実行待ちにできるジョブ数（超えると submit が JobQueueFull を送出）
+            listener (callable): ジョブの状態が変わるたびに listener(job) を呼ぶ（他のプロセスから参照できるよう保存する場合など）
+            deadline_seconds (float): ジョブの期限の既定値（None の場合は BLOG_TOOL_JOB_DEADLINE、0 は期限なし）
+            cancel_check (callable): cancel_check(job) が真ならジョブを取り消す（他のプロセスからの取り消しなど）
+        """
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max_pending
+        self.deadline_seconds = job_deadline_seconds() if deadline_seconds is None else deadline_seconds
+        self._listener = listener
+        self._cancel_check = cancel_check
+        self._handlers = {}
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+        self._finished = threading.Condition(self._lock)
+
+    def register(self, kind, handler, template_param=None, deadline_seconds=None):
+        """
+        ジョブの種類を登録
+
+        Args:
+            kind (str): ジョブの種類
+            handler (callable): handler(params, job) -> 結果
+            template_param (str): 使用量台帳にテンプレートとして記録する params のキー
+            deadline_seconds (float): この種類のジョブの期限（None の場合は JobManager の既定値、0 は期限なし）
+        """
+        self._handlers[kind] = (handler, template_param, deadline_seconds)
+
+    @property
+    def kinds(self):
+        return list(self._handlers)
+
+    def submit(self, kind, params=None):
+        """ジョブを登録して実行待ちにする"""
+        if kind not in self._handlers:
+            raise ValueError(f"不明なジョブの種類です: {kind}（利用可能: {', '.join(self._handlers)}）")
+        job = Job(kind, params)
+        with self._lock:
+            pending = sum(1 for j in self._jobs.values() if j.status == 'queued')
+            if self.max_pending is not None and pending >= self.max_pending:
+                raise JobQueueFull(f"実行待ちのジョブが上限（{self.max_pending}件）に達しています。")
+            self._jobs[job.job_id] = job
+            self._prune()
+        self._notify(job)
+        self._executor.submit(self._run, job)
+        return job
+
+    def _notify(self, job):
+        if not self._listener:
+            return
+        try:
+            self._listener(job)
+        except Exception as e:
+            print(f"ジョブ状態の通知エラー（{job.job_id}）: {e}")
+
+    def cancel(self, job_id):
+        """
+        ジョブを取り消す（実行待ちならすぐに cancelled、実行中なら次の処理の区切りで止まる）
+
+        Returns:
+            Job|None: 対象のジョブ（見つからない場合は None）
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or job.done:
+                return job
+            job.cancel_requested = True
+            if job.status != 'queued':
+                return job
+            job.status = 'cancelled'
+            job.error = 'ジョブが取り消されました。'
+            job.finished_at = time.time()
+            self._finished.notify_all()
+        self._notify(job)
+        return job
+
+    def _cancelled(self, job):
+        if job.cancel_requested:
+            return True
+        if self._cancel_check and self._cancel_check(job):
+            job.cancel_requested = True
+        return job.cancel_requested
+
+    def _run(self, job):
+        handler, template_param, kind_deadline = self._handlers[job.kind]
+        template = job.params.get(template_param) if template_param else None
+        with self._lock:
+            if job.status == 'cancelled':
+                return
+        if self._cancelled(job):
+            self.cancel(job.job_id)
+            return
+        with self._lock:
+            job.status = 'running'
+            job.started_at = time.time()
+        self._notify(job)
+        deadline_seconds = job.params.get('deadline_seconds')
+        if deadline_seconds is None:
+            deadline_seconds = self.deadline_seconds if kind_deadline is None else kind_deadline
+        deadline_seconds = float(deadline_seconds or 0)
+        try:
+            with job_scope(job.job_id, template=template), \
+                    start_trace(f"job.{job.kind}", job_id=job.job_id) as trace, \
+                    deadline_scope(deadline_seconds, cancel_check=lambda: self._cancelled(job)) as deadline:
+                job.trace_id = trace.trace_id
+                result = handler(job.params, job)
+            if result is None and deadline.cancelled:
+                # 処理関数が取り消しで途中で止まって None を返した場合
+                raise JobCancelled('ジョブが取り消されました。')
+            if result is None:
+                raise RuntimeError('処理結果が空です。')
+            job.result = result
+            status = 'succeeded'
+        except JobCancelled as e:
+            print(f"ジョブを取り消しました（{job.job_id}）")
+            job.error = str(e)
+            status = 'cancelled'
+        except Exception as e:
+            print(f"ジョブ実行エラー（{job.job_id}）: {e}")
+            job.error = str(e)
+            status = 'failed'
+        job.tokens_used = get_ledger().job_total(job.job_id)
+        with self._lock:
+            job.status = status
+            job.finished_at = time.time()
+            self._finished.notify_all()
+        self._notify(job)
+
+    def _prune(self):
+        finished = [job_id for job_id, j in self._jobs.items() if j.done]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id, timeout=None):
+        """ジョブの完了を待つ（タイムアウトした場合もその時点のジョブを返す）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            job = self._jobs.get(job_id)
+            while job and not job.done:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._finished.wait(remaining)
+            return job
+
+    def jobs(self, limit=None):
+        """ジョブの一覧（新しい順）"""
+        with self._lock:
+            jobs = list(reversed(self._jobs.values()))
+        return jobs[:limit] if limit else jobs
+
+    def stats(self):
+        with self._lock:
+            counts = {status: 0 for status in JOB_STATUSES}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return {'max_workers': self.max_workers, 'max_pending': self.max_pending, 'jobs': counts}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
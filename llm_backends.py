@@ -0,0 +1,209 @@
+import os
+import re
+from collections import namedtuple
+
+# モデルごとの料金（米ドル / 100万トークン、(入力, 出力)）。リクエスト単位の料金・検索料金は含まない概算
+MODEL_PRICES = {
+    'sonar': (1.0, 1.0),
+    'sonar-pro': (3.0, 15.0),
+    'sonar-reasoning': (1.0, 5.0),
+    'sonar-reasoning-pro': (2.0, 8.0),
+    'sonar-deep-research': (2.0, 8.0),
+}
+
+# 推論モデルが本文の前に出力する思考過程
+_THINK_BLOCK = re.compile(r'^\s*<think>.*?</think>\s*', re.DOTALL)
+
+
+class LLMBackend:
+    """
+    チャット補完の呼び出し先（OpenAI 互換の /chat/completions）
+
+    HTTP の送信・使用量の記録・メトリクスは PerplexityClient.chat_completion が共通で行い、呼び出し先ごとの
+    違い（URL・認証・モデル名・リクエストとレスポンスの差異・料金）だけをここで扱う。
+    """
+
+    name = None
+
+    def __init__(self, base_url, api_key=None, models=None):
+        """
+        Args:
+            base_url (str): API のベースURL（/chat/completions の手前まで）
+            api_key (str): Bearer トークン（不要な場合は None）
+            models (dict): {略称: モデル名}
+        """
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.models = dict(models or {})
+
+    @property
+    def chat_url(self):
+        return f"{self.base_url}/chat/completions"
+
+    @property
+    def headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def resolve_model(self, model):
+        return self.models.get(model, model)
+
+    def prepare(self, payload):
+        """送信前にリクエストを呼び出し先の形式に合わせる"""
+        return payload
+
+    def normalize(self, result):
+        """レスポンスを記事生成などで使う形式に揃える"""
+        return result
+
+    def cost(self, model, usage):
+        """usage ブロックからの料金の概算（米ドル、料金表にないモデルは 0）"""
+        prices = MODEL_PRICES.get(model)
+        if not prices or not usage:
+            return 0.0
+        return (int(usage.get('prompt_tokens') or 0) * prices[0]
+                + int(usage.get('completion_tokens') or 0) * prices[1]) / 1_000_000
+
+
+class PerplexityBackend(LLMBackend):
+    """Perplexity API（PERPLEXITY_BASE_URL でスタンドインにも向けられる）"""
+
+    name = 'perplexity'
+
+    def __init__(self, api_key, base_url=None):
+        super().__init__(base_url or os.getenv('PERPLEXITY_BASE_URL', "https://api.perplexity.ai"), api_key, {
+            "sonar": "sonar",
+            "sonar-reasoning": "sonar-reasoning",
+            "sonar-deep-research": "sonar-deep-research"
+        })
+
+    def normalize(self, result):
+        # 推論モデル（sonar-reasoning など）は本文の前に <think> ブロックを出力するため取り除く
+        for choice in result.get('choices') or []:
+            message = choice.get('message') or {}
+            if isinstance(message.get('content'), str) and message['content'].lstrip().startswith('<think>'):
+                message['content'] = _THINK_BLOCK.sub('', message['content'], count=1)
+        return result
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    OpenAI 互換の API（ローカルの llama.cpp / vLLM / Ollama など）
+
+    BLOG_TOOL_LOCAL_LLM_URL（例: http://127.0.0.1:11434/v1）、BLOG_TOOL_LOCAL_LLM_API_KEY（任意）、
+    BLOG_TOOL_LOCAL_LLM_MODEL（ルートでモデルを指定しない場合のモデル）で設定する。
+    """
+
+    name = 'local'
+
+    def __init__(self, base_url=None, api_key=None, default_model=None):
+        base_url = base_url or os.getenv('BLOG_TOOL_LOCAL_LLM_URL')
+        if not base_url:
+            raise ValueError("BLOG_TOOL_LOCAL_LLM_URLが設定されていません（LLMのルートで local を使う場合は必須）。")
+        super().__init__(base_url, api_key or os.getenv('BLOG_TOOL_LOCAL_LLM_API_KEY'))
+        self.default_model = default_model or os.getenv('BLOG_TOOL_LOCAL_LLM_MODEL')
+
+    def resolve_model(self, model):
+        # Perplexity のモデル名（呼び出し元の既定値）はローカルでは使えないため、既定のモデルにする
+        if self.default_model and (not model or model.startswith('sonar')):
+            return self.default_model
+        return super().resolve_model(model)
+
+    def prepare(self, payload):
+        response_format = payload.get('response_format')
+        if response_format and response_format.get('type') == 'json_schema':
+            # OpenAI 互換の API は json_schema に name が必要
+            schema = dict(response_format.get('json_schema') or {})
+            schema.setdefault('name', 'response')
+            payload = dict(payload, response_format=dict(response_format, json_schema=schema))
+        return payload
+
+
+BACKENDS = {
+    'perplexity': PerplexityBackend,
+    'local': OpenAICompatibleBackend,
+}
+
+# 呼び出し元ごとの呼び出し先（model / temperature が None の場合は呼び出し元の指定を使う）
+Route = namedtuple('Route', ['backend', 'model', 'temperature'])
+
+
+def parse_routes(spec):
+    """
+    ルートの指定を解析する
+
+    「呼び出し元=呼び出し先[:モデル][@温度]」をカンマ区切りで並べる（呼び出し元 * はその他すべて）。
+    例: image_lookup=local:qwen2.5:7b@0.1,preview=perplexity:sonar,article=perplexity:sonar-reasoning
+
+    Returns:
+        dict: {呼び出し元: Route}
+    """
+    routes = {}
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        call_site, sep, target = item.partition('=')
+        if not sep or not call_site.strip() or not target.strip():
+            raise ValueError(f"LLMのルートの形式が正しくありません: {item}（呼び出し元=呼び出し先[:モデル][@温度]）")
+        target, _, temperature = target.partition('@')
+        backend, _, model = target.strip().partition(':')
+        if backend not in BACKENDS:
+            raise ValueError(f"LLMの呼び出し先が正しくありません: {backend}（{' / '.join(BACKENDS)}）")
+        try:
+            temperature = float(temperature) if temperature else None
+        except ValueError:
+            raise ValueError(f"LLMのルートの温度が正しくありません: {item}")
+        routes[call_site.strip()] = Route(backend, model or None, temperature)
+    return routes
+
+
+class Router:
+    """
+    呼び出し元（usage_ledger.CALL_SITES）ごとに呼び出し先・モデル・温度を決める
+
+    ルートがない呼び出し元は既定の呼び出し先（Perplexity）に、呼び出し元が指定したモデル・温度で送る。
+    ヘッジ（llm_hedging）の追加リクエストは hedge_routes（BLOG_TOOL_LLM_HEDGE_ROUTES）の呼び出し先に送り、
+    ない場合は通常のルートと同じにする。呼び出し先はルートで使うものだけを作る（設定の不足は作成時に ValueError）。
+    """
+
+    def __init__(self, default_backend, spec=None, hedge_spec=None):
+        """
+        Args:
+            default_backend (LLMBackend): ルートがない場合の呼び出し先
+            spec (str): ルートの指定（None の場合は BLOG_TOOL_LLM_ROUTES）
+            hedge_spec (str): ヘッジのルートの指定（None の場合は BLOG_TOOL_LLM_HEDGE_ROUTES）
+        """
+        self.routes = parse_routes(os.getenv('BLOG_TOOL_LLM_ROUTES', '') if spec is None else spec)
+        self.hedge_routes = parse_routes(os.getenv('BLOG_TOOL_LLM_HEDGE_ROUTES', '') if hedge_spec is None else hedge_spec)
+        self.backends = {default_backend.name: default_backend}
+        self.default_backend = default_backend
+        for route in list(self.routes.values()) + list(self.hedge_routes.values()):
+            if route.backend not in self.backends:
+                self.backends[route.backend] = BACKENDS[route.backend]()
+
+    def route(self, call_site, model, temperature, hedge=False):
+        """
+        Args:
+            hedge (bool): ヘッジの追加リクエストのルートを使うか
+
+        Returns:
+            tuple: (LLMBackend, モデル名, 温度)
+        """
+        route = None
+        if hedge:
+            route = self.hedge_routes.get(call_site) or self.hedge_routes.get('*')
+        route = route or self.routes.get(call_site) or self.routes.get('*')
+        if route is None:
+            return self.default_backend, self.default_backend.resolve_model(model), temperature
+        backend = self.backends[route.backend]
+        return (backend, backend.resolve_model(route.model or model),
+                temperature if route.temperature is None else route.temperature)
+
+    def describe(self, hedge=False):
+        """ルートの一覧 {呼び出し元: '呼び出し先:モデル@温度'}（表示用）"""
+        return {call_site: f"{route.backend}:{route.model or '（呼び出し元の指定）'}"
+                           + (f"@{route.temperature}" if route.temperature is not None else '')
+                for call_site, route in (self.hedge_routes if hedge else self.routes).items()}
@@ -0,0 +1,197 @@
+import os
+import time
+import queue
+import threading
+import contextvars
+from collections import deque
+from metrics import LLM_HEDGES, percentile
+from deadlines import CONNECT_TIMEOUT, current_deadline, llm_timeout
+
+# 呼び出し元ごとに保持する直近の所要時間の数
+WINDOW_SIZE = 200
+
+
+class Hedger:
+    """
+    チャット補完の追加リクエスト（ヘッジ）を判断する
+
+    呼び出し元ごとに直近の所要時間を保持し、呼び出しがその percentile パーセンタイルを超えても終わらない
+    場合に、同じ（または BLOG_TOOL_LLM_HEDGE_ROUTES の）呼び出し先へ同じリクエストをもう1度送る。先に
+    成功した方を使い、もう一方の結果は捨てる。最初の呼び出しが失敗した場合も、ヘッジの呼び出し先が
+    異なれば（フェイルオーバー）すぐに送る。
+
+    追加リクエストは直近の呼び出し（WINDOW_SIZE 件）のうち max_ratio の割合までに抑える（料金の上限）。
+    所要時間・回数はプロセスごとに持つ（gunicorn のワーカーごとに別）。
+    """
+
+    def __init__(self, call_sites=None, percentile=None, min_samples=None, max_ratio=None):
+        """
+        Args:
+            call_sites (str): ヘッジする呼び出し元（カンマ区切り、* はすべて。None の場合は BLOG_TOOL_LLM_HEDGE）
+            percentile (float): 追加リクエストを送るまでの待ち時間に使うパーセンタイル
+            min_samples (int): 待ち時間を決めるのに必要な所要時間の数（それまではヘッジしない）
+            max_ratio (float): 追加リクエストの割合の上限
+        """
+        if call_sites is None:
+            call_sites = os.getenv('BLOG_TOOL_LLM_HEDGE', '')
+        self.call_sites = {site.strip() for site in call_sites.split(',') if site.strip()}
+        self.percentile = float(percentile or os.getenv('BLOG_TOOL_LLM_HEDGE_PERCENTILE', '95'))
+        self.min_samples = int(min_samples or os.getenv('BLOG_TOOL_LLM_HEDGE_MIN_SAMPLES', '20'))
+        self.max_ratio = float(max_ratio if max_ratio is not None else os.getenv('BLOG_TOOL_LLM_HEDGE_MAX_RATIO', '0.1'))
+        if not 0 < self.percentile < 100:
+            raise ValueError(f"BLOG_TOOL_LLM_HEDGE_PERCENTILE は 0 より大きく 100 より小さい値にしてください: {self.percentile}")
+        self._lock = threading.Lock()
+        self._latencies = {}
+        # 直近の呼び出しごとに、追加リクエストを送ったかどうか
+        self._hedged = {}
+        self._outcomes = {}
+
+    def enabled(self, call_site):
+        return call_site in self.call_sites or '*' in self.call_sites
+
+    def observe(self, call_site, seconds):
+        """成功した呼び出しの所要時間を記録する（ヘッジでない方の呼び出しのみ）"""
+        if not self.enabled(call_site):
+            return
+        with self._lock:
+            self._latencies.setdefault(call_site, deque(maxlen=WINDOW_SIZE)).append(seconds)
+
+    def plan(self, call_site):
+        """
+        呼び出しを1回数え、追加リクエストを送るまでの待ち時間を返す
+
+        Returns:
+            float|None: 待ち時間（秒）。ヘッジしない場合（対象外・所要時間が足りない）は None
+        """
+        if not self.enabled(call_site):
+            return None
+        with self._lock:
+            self._hedged.setdefault(call_site, deque(maxlen=WINDOW_SIZE)).append(False)
+            latencies = self._latencies.get(call_site)
+            if not latencies or len(latencies) < self.min_samples:
+                return None
+            return percentile(latencies, self.percentile)
+
+    def acquire(self, call_site):
+        """追加リクエストを送ってよいか（割合の上限内なら今回の呼び出しを送ったものとして数える）"""
+        with self._lock:
+            hedged = self._hedged.setdefault(call_site, deque(maxlen=WINDOW_SIZE))
+            if not hedged or (sum(hedged) + 1) / len(hedged) > self.max_ratio:
+                return False
+            hedged[-1] = True
+            return True
+
+    def _outcome(self, call_site, outcome):
+        LLM_HEDGES.inc(call_site=call_site, outcome=outcome)
+        with self._lock:
+            counts = self._outcomes.setdefault(call_site, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    def run(self, call_site, attempts, delay, failover=False):
+        """
+        最初の呼び出しを送り、delay 秒たっても終わらなければ（failover の場合は失敗したときも）追加
+        リクエストを送って、先に成功した方の結果を返す
+
+        呼び出しはそれぞれ別のスレッドで実行する（ジョブのスコープとトレースは引き継ぐ）。結果を使わない
+        方の呼び出しには cancelled を渡す（送信前なら送らず、送信中ならレスポンスを捨てる）。呼び出しが
+        例外を送出した場合は失敗（None）として扱う。結果を待つのはジョブの残り時間（期限がない場合は
+        LLM 呼び出しのタイムアウト）までで、過ぎた場合は None を返す。
+
+        Args:
+            call_site (str): 呼び出し元
+            attempts (dict): {'primary': 関数, 'hedge': 関数}（関数は cancelled（threading.Event）を受け取り、
+                             成功した場合は結果、失敗した場合は None を返す）
+            delay (float): 追加リクエストを送るまでの待ち時間（秒）
+            failover (bool): 最初の呼び出しが失敗した場合も追加リクエストを送るか
+
+        Returns:
+            結果（どちらも失敗した場合は None）
+        """
+        results = queue.Queue()
+        cancelled = threading.Event()
+
+        def start(name):
+            context = contextvars.copy_context()
+
+            def target():
+                result = None
+                try:
+                    result = context.run(attempts[name], cancelled)
+                except Exception as e:
+                    print(f"LLM呼び出しエラー（{call_site}・{name}）: {e}")
+                finally:
+                    results.put((name, result))
+
+            threading.Thread(target=target, name=f"llm-{name}", daemon=True).start()
+
+        def send_hedge(outcome):
+            if self.acquire(call_site):
+                self._outcome(call_site, outcome)
+                start('hedge')
+                return True
+            self._outcome(call_site, 'capped')
+            return False
+
+        remaining = current_deadline().remaining()
+        ends_at = time.monotonic() + ((llm_timeout() + CONNECT_TIMEOUT) if remaining is None else remaining)
+        start('primary')
+        pending, hedged = 1, False
+        while pending:
+            try:
+                name, result = results.get(timeout=max(0.0, ends_at - time.monotonic()) if hedged else delay)
+            except queue.Empty:
+                if hedged:
+                    print(f"LLM呼び出しの結果を待ちきれませんでした（{call_site}）")
+                    cancelled.set()
+                    return None
+                hedged = True
+                pending += send_hedge('fired')
+                continue
+            pending -= 1
+            if result is not None:
+                cancelled.set()
+                if pending or name == 'hedge':
+                    self._outcome(call_site, 'won' if name == 'hedge' else 'lost')
+                return result
+            if name == 'primary' and not hedged and failover:
+                hedged = True
+                pending += send_hedge('failover')
+        return None
+
+    def snapshot(self):
+        """
+        呼び出し元ごとの状態（画面表示用）
+
+        Returns:
+            dict: {呼び出し元: {'samples', 'p50', 'p95', 'threshold', 'calls', 'hedges', 'outcomes'}}
+        """
+        with self._lock:
+            sites = sorted(set(self._latencies) | set(self._hedged))
+            snapshot = {}
+            for call_site in sites:
+                latencies = list(self._latencies.get(call_site, ()))
+                hedged = self._hedged.get(call_site, ())
+                ready = len(latencies) >= self.min_samples
+                snapshot[call_site] = {
+                    'samples': len(latencies),
+                    'p50': percentile(latencies, 50) if latencies else None,
+                    'p95': percentile(latencies, 95) if latencies else None,
+                    'threshold': percentile(latencies, self.percentile) if ready else None,
+                    'calls': len(hedged),
+                    'hedges': sum(hedged),
+                    'outcomes': dict(self._outcomes.get(call_site, {})),
+                }
+            return snapshot
+
+
+_default_hedger = None
+_default_lock = threading.Lock()
+
+
+def get_hedger():
+    """プロセス共通の Hedger を返す"""
+    global _default_hedger
+    with _default_lock:
+        if _default_hedger is None:
+            _default_hedger = Hedger()
+        return _default_hedger
@@ -0,0 +1,285 @@
+import math
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# レイテンシ用のデフォルトバケット（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# バイト数用のバケット
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def percentile(values, p):
+    """p パーセンタイル（最近傍法: 小さい順で ceil(p/100 × 件数) 番目。空の場合は 0.0）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class _ShardedMetric:
+    """
+    スレッドごとのシャードに値を持つメトリクスの基底クラス
+
+    更新は自スレッドのシャード（dict）にのみ書き込むためロック不要。
+    ロックを取るのは新しいスレッドが初めて更新するときと、収集時だけ。
+    終了したスレッドのシャードは次のシャード登録時に共有分へ合算する。
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = {}
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+            with self._lock:
+                alive = []
+                for thread, other in self._shards:
+                    if thread.is_alive():
+                        alive.append((thread, other))
+                    else:
+                        self._merge(self._retired, other)
+                alive.append((threading.current_thread(), shard))
+                self._shards = alive
+        return shard
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ラベル {self.labelnames} が必要です（指定: {tuple(labels)}）")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _merge(self, target, shard):
+        raise NotImplementedError
+
+    def collect(self):
+        """全シャードを合算した {ラベル値のタプル: 値} を返す"""
+        merged = {}
+        with self._lock:
+            self._merge(merged, self._retired)
+            for _, shard in self._shards:
+                # dict() のコピーは GIL 下で一括実行されるため、更新中のシャードでも安全
+                self._merge(merged, dict(shard))
+        return merged
+
+
+class Counter(_ShardedMetric):
+    """単調増加するカウンタ"""
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def _merge(self, target, shard):
+        for key, value in shard.items():
+            target[key] = target.get(key, 0) + value
+
+    def samples(self):
+        for key, value in sorted(self.collect().items()):
+            yield self.name + '_total', key, value
+
+
+class Histogram(_ShardedMetric):
+    """バケットごとの件数と合計値を持つヒストグラム"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        values = shard.get(key)
+        if values is None:
+            # [各バケットの件数..., +Inf の件数, 合計]
+            values = [0] * (len(self.buckets) + 1) + [0.0]
+            shard[key] = values
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """with ブロックの所要時間（秒）を記録"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _merge(self, target, shard):
+        for key, values in shard.items():
+            current = target.get(key)
+            if current is None:
+                target[key] = list(values)
+            else:
+                for i, v in enumerate(values):
+                    current[i] += v
+
+    def samples(self):
+        for key, values in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                yield self.name + '_bucket', key + (('le', _format_bound(bound)),), cumulative
+            yield self.name + '_sum', key, values[-1]
+            yield self.name + '_count', key, cumulative
+
+
+class Gauge:
+    """増減する現在値（更新頻度が低い値向け）"""
+
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ラベル {self.labelnames} が必要です（指定: {tuple(labels)}）")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        """with ブロック実行中だけ値を1増やす"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values = {(): 0}
+        for key, value in sorted(values.items()):
+            yield self.name, key, value
+
+
+class Registry:
+    """メトリクスの登録とPrometheusテキスト形式への出力"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"メトリクス {metric.name} はすでに登録されています")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def render(self):
+        """Prometheus テキスト形式（version 0.0.4）で出力"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for sample_name, key, value in metric.samples():
+                lines.append(f"{sample_name}{_format_labels(metric.labelnames, key)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labelnames, key):
+    pairs = list(zip(labelnames, key))
+    # ヒストグラムの le ラベルは (名前, 値) のタプルとして末尾に付く
+    pairs += [extra for extra in key[len(labelnames):]]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def _format_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(float(bound))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def _escape_help(text):
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _escape_label(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+REGISTRY = Registry()
+
+LLM_REQUESTS = REGISTRY.counter(
+    'blog_tool_llm_requests', 'Perplexity API呼び出し回数', ('endpoint', 'call_site', 'status'))
+LLM_LATENCY = REGISTRY.histogram(
+    'blog_tool_llm_request_seconds', 'Perplexity API呼び出しの所要時間（秒）', ('endpoint', 'call_site'))
+LLM_TOKENS = REGISTRY.counter(
+    'blog_tool_llm_tokens', 'Perplexity APIの使用トークン数', ('call_site', 'kind'))
+LLM_ROUTE_LATENCY = REGISTRY.histogram(
+    'blog_tool_llm_route_seconds', 'チャット補完の呼び出し先・モデルごとの所要時間（秒、成功のみ）',
+    ('call_site', 'backend', 'model'))
+LLM_COST = REGISTRY.counter(
+    'blog_tool_llm_cost_usd', 'チャット補完の料金の概算（米ドル）', ('call_site', 'backend', 'model'))
+LLM_HEDGES = REGISTRY.counter(
+    'blog_tool_llm_hedges', 'チャット補完の追加リクエスト（outcome: fired/failover/won/lost/capped）',
+    ('call_site', 'outcome'))
+IMAGE_CACHE_LOOKUPS = REGISTRY.counter(
+    'blog_tool_image_cache_lookups', '画像キャッシュの参照回数（result: exact/normalized/fuzzy/miss）', ('result',))
+SITE_FETCH_LATENCY = REGISTRY.histogram(
+    'blog_tool_site_fetch_seconds', '公式サイト取得の所要時間（秒）', ('status',))
+SITE_FETCH_BYTES = REGISTRY.histogram(
+    'blog_tool_site_fetch_bytes', '公式サイト取得のレスポンスサイズ（バイト）', buckets=BYTES_BUCKETS)
+WP_POSTS = REGISTRY.counter(
+    'blog_tool_wordpress_posts', 'WordPress投稿回数', ('status',))
+WP_POST_LATENCY = REGISTRY.histogram(
+    'blog_tool_wordpress_post_seconds', 'WordPress投稿の所要時間（秒）')
+PAGE_RENDER_LATENCY = REGISTRY.histogram(
+    'blog_tool_page_render_seconds', '画面の描画時間（秒）', ('page',))
+ACTIVE_GENERATIONS = REGISTRY.gauge(
+    'blog_tool_active_generations', '実行中の記事生成数')
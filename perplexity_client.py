@@ -1,107 +1,266 @@
 import os
-import requests
 import sys
-from dotenv import load_dotenv
+import time
+from usage_ledger import get_ledger
+from tracing import span, traced
+from metrics import LLM_COST, LLM_LATENCY, LLM_REQUESTS, LLM_ROUTE_LATENCY, LLM_TOKENS
+from llm_backends import PerplexityBackend, Router
+from llm_hedging import get_hedger
+from deadlines import DeadlineExceeded, JobCancelled, current_deadline, llm_timeout
+from prompt_compiler import TemplateError, load_template
 
-# .envファイルから環境変数を読み込み
-load_dotenv()
+_environment_loaded = False
+
+
+def load_environment():
+    """
+    .envファイルから環境変数を読み込み（初回のみ）
+
+    起動時間短縮のため、import 時ではなくクライアント/ツールの初期化時に呼び出す。
+    """
+    global _environment_loaded
+    if _environment_loaded:
+        return
+    from dotenv import load_dotenv
+    load_dotenv()
+    _environment_loaded = True
+
+def create_http_session(pool_size=10):
+    """
+    接続を再利用する HTTP セッションを作成（Keep-Alive・ホストごとに pool_size 本まで保持）
+
+    ワーカーデーモンなど同じプロセスで何度も呼び出す場合に、TLS ハンドシェイクを省ける。
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 class PerplexityClient:
     def __init__(self):
         """Perplexity APIクライアントを初期化"""
+        load_environment()
         self.api_key = os.getenv('PERPLEXITY_API_KEY')
         if not self.api_key:
             raise ValueError("PERPLEXITY_API_KEYが設定されていません。.envファイルを確認してください。")
         
-        self.base_url = "https://api.perplexity.ai"
+        # PERPLEXITY_BASE_URL でローカルのスタンドイン（benchmark.py offline）などに向けられる
+        self.base_url = os.getenv('PERPLEXITY_BASE_URL', "https://api.perplexity.ai").rstrip('/')
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
         
+        # チャット補完の呼び出し先（呼び出し元ごとのルートは BLOG_TOOL_LLM_ROUTES、llm_backends.Router）
+        self.backend = PerplexityBackend(self.api_key, self.base_url)
+        self.router = Router(self.backend)
+        
         # 公式ドキュメントに基づく利用可能なモデル
-        self.available_models = {
-            "sonar": "sonar",
-            "sonar-reasoning": "sonar-reasoning",
-            "sonar-deep-research": "sonar-deep-research"
-        }
+        self.available_models = self.backend.models
+        self._session = None
     
-    def chat_completion(self, messages, model="sonar", max_tokens=4096):
+    @property
+    def session(self):
+        """API 呼び出しに使う HTTP セッション（初回使用時に作成）"""
+        if self._session is None:
+            self._session = create_http_session()
+        return self._session
+    
+    def chat_completion(self, messages, model="sonar", max_tokens=4096, temperature=0.7, response_format=None,
+                        call_site="other", template=None):
         """
-        Perplexity APIを使用してチャット補完を実行
+        チャット補完を実行（呼び出し先・モデル・温度は call_site のルートで決まる）
+        
+        BLOG_TOOL_LLM_HEDGE の呼び出し元では、所要時間が長い場合に追加リクエストを送る（llm_hedging.Hedger）。
         
         Args:
             messages (list): メッセージのリスト
-            model (str): 使用するモデル名（キーまたはフルネーム）
+            model (str): 使用するモデル名（キーまたはフルネーム、ルートでモデルを指定した場合はそちらを使う）
             max_tokens (int): 最大トークン数（デフォルト: 4096）
+            temperature (float): サンプリング温度（デフォルト: 0.7、ルートで温度を指定した場合はそちらを使う）
+            response_format (dict): 構造化出力の指定（例: {"type": "json_schema", ...}）
+            call_site (str): 呼び出し元（使用量台帳の集計キー。usage_ledger.CALL_SITES 参照）
+            template (str): 使用したテンプレートファイル（使用量台帳の集計キー）
         
         Returns:
-            dict: APIレスポンス
+            dict: APIレスポンス（トークン上限に達している場合・失敗した場合は None）
         """
-        url = f"{self.base_url}/chat/completions"
-        
-        # モデル名を解決
-        actual_model = self.available_models.get(model, model)
+        # トークン上限を確認
+        ledger = get_ledger()
+        over_budget = ledger.check_budget()
+        if over_budget:
+            print(f"トークン上限エラー: {over_budget}")
+            LLM_REQUESTS.inc(endpoint='chat', call_site=call_site, status='budget_exceeded')
+            return None
         
         payload = {
-            "model": actual_model,
             "messages": messages,
             "max_tokens": max_tokens,
-            "temperature": 0.7,
             "stream": False
         }
+        if response_format:
+            payload["response_format"] = response_format
         
-        try:
-            response = requests.post(url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.HTTPError as e:
-            print(f"HTTPエラー: {e}")
-            if response.status_code == 400:
-                print("リクエストの形式が正しくありません。APIキーとリクエスト内容を確認してください。")
-                print(f"レスポンス内容: {response.text}")
-            elif response.status_code == 401:
-                print("認証エラー: APIキーが無効です。")
-            elif response.status_code == 429:
-                print("レート制限エラー: リクエスト数が上限に達しました。")
+        # 呼び出し先とモデル名を解決
+        route = self.router.route(call_site, model, temperature)
+        hedger = get_hedger()
+        delay = hedger.plan(call_site)
+        if delay is None:
+            return self._send(route, payload, call_site, template, ledger)
+        
+        # 所要時間が直近の分布の上位を超えたら、追加リクエスト（ヘッジ）を送って先に成功した方を使う
+        hedge_route = self.router.route(call_site, model, temperature, hedge=True)
+        return hedger.run(call_site, {
+            'primary': lambda cancelled: self._send(route, payload, call_site, template, ledger, cancelled),
+            'hedge': lambda cancelled: self._send(hedge_route, payload, call_site, template, ledger, cancelled,
+                                                  hedge=True)
+        }, delay, failover=(hedge_route[0].name, hedge_route[1]) != (route[0].name, route[1]))
+    
+    def _send(self, route, payload, call_site, template, ledger, cancelled=None, hedge=False):
+        """
+        チャット補完のリクエストを1回送る（使用量台帳・メトリクスに記録する）
+        
+        Args:
+            route (tuple): (LLMBackend, モデル名, 温度)（Router.route）
+            payload (dict): モデル名・温度を除くリクエスト
+            cancelled (threading.Event): ヘッジで結果を使わなくなったことを示す（送信前なら送らず、
+                                         送信中ならレスポンスを台帳に 'cancelled' として記録して捨てる）
+            hedge (bool): ヘッジの追加リクエストか（所要時間を Hedger に記録しない）
+        
+        Returns:
+            dict: APIレスポンス（失敗した場合・結果を使わない場合は None）
+        """
+        import requests  # 起動時間短縮のため使用時に読み込む
+        
+        backend, actual_model, temperature = route
+        if cancelled is not None and cancelled.is_set():
             return None
-        except requests.exceptions.RequestException as e:
-            print(f"APIリクエストエラー: {e}")
+        if hedge and ledger.check_budget():
+            # 追加リクエストはトークン上限の範囲内でのみ送る
             return None
+        payload = backend.prepare(dict(payload, model=actual_model, temperature=temperature))
+        
+        with span('llm.chat_completion', call_site=call_site, backend=backend.name, model=actual_model,
+                  max_tokens=payload.get('max_tokens'), hedge=hedge) as s:
+            started = time.perf_counter()
+            deadline = current_deadline()
+            try:
+                # ジョブの残り時間をタイムアウトにし、取り消された場合は応答を待たない
+                timeout = deadline.timeout(llm_timeout(), 'LLM呼び出し')
+                response = deadline.call(self.session.post, backend.chat_url, headers=backend.headers, json=payload,
+                                         timeout=timeout)
+                s.set_attribute('http_status', response.status_code)
+                response.raise_for_status()
+                result = backend.normalize(response.json())
+                elapsed = time.perf_counter() - started
+                usage = result.get('usage') or {}
+                cost = backend.cost(actual_model, usage)
+                # ヘッジで使わなくなった結果も料金はかかるため、使用量は記録する
+                status = 'cancelled' if cancelled is not None and cancelled.is_set() else 'ok'
+                s.set_attributes(prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'),
+                                 status=status)
+                ledger.record(call_site, result.get('model', actual_model), usage,
+                              elapsed * 1000, template=template, status=status, backend=backend.name, cost=cost)
+                LLM_REQUESTS.inc(endpoint='chat', call_site=call_site, status=status)
+                LLM_LATENCY.observe(elapsed, endpoint='chat', call_site=call_site)
+                LLM_ROUTE_LATENCY.observe(elapsed, call_site=call_site, backend=backend.name, model=actual_model)
+                LLM_COST.inc(cost, call_site=call_site, backend=backend.name, model=actual_model)
+                LLM_TOKENS.inc(int(usage.get('prompt_tokens') or 0), call_site=call_site, kind='prompt')
+                LLM_TOKENS.inc(int(usage.get('completion_tokens') or 0), call_site=call_site, kind='completion')
+                if not hedge:
+                    get_hedger().observe(call_site, elapsed)
+                return result if status == 'ok' else None
+            except requests.exceptions.HTTPError as e:
+                s.status = 'error'
+                LLM_REQUESTS.inc(endpoint='chat', call_site=call_site, status=str(response.status_code))
+                LLM_LATENCY.observe(time.perf_counter() - started, endpoint='chat', call_site=call_site)
+                ledger.record(call_site, actual_model, None, (time.perf_counter() - started) * 1000,
+                              template=template, status='error', backend=backend.name)
+                print(f"HTTPエラー: {e}")
+                if response.status_code == 400:
+                    print("リクエストの形式が正しくありません。APIキーとリクエスト内容を確認してください。")
+                    print(f"レスポンス内容: {response.text}")
+                elif response.status_code == 401:
+                    print("認証エラー: APIキーが無効です。")
+                elif response.status_code == 429:
+                    print("レート制限エラー: リクエスト数が上限に達しました。")
+                return None
+            except requests.exceptions.RequestException as e:
+                s.status = 'error'
+                LLM_REQUESTS.inc(endpoint='chat', call_site=call_site, status='error')
+                LLM_LATENCY.observe(time.perf_counter() - started, endpoint='chat', call_site=call_site)
+                ledger.record(call_site, actual_model, None, (time.perf_counter() - started) * 1000,
+                              template=template, status='error', backend=backend.name)
+                print(f"APIリクエストエラー: {e}")
+                return None
+            except (DeadlineExceeded, JobCancelled) as e:
+                s.status = 'error'
+                status = 'cancelled' if isinstance(e, JobCancelled) else 'deadline_exceeded'
+                LLM_REQUESTS.inc(endpoint='chat', call_site=call_site, status=status)
+                ledger.record(call_site, actual_model, None, (time.perf_counter() - started) * 1000,
+                              template=template, status='cancelled' if status == 'cancelled' else 'error',
+                              backend=backend.name)
+                print(f"APIリクエストエラー: {e}")
+                return None
     
-    def search(self, query):
+    def search(self, query, max_results=None, call_site="other"):
         """
-        検索クエリを実行
+        検索クエリを実行（LLMによる文章生成を伴わない Search API）
         
         Args:
-            query (str): 検索クエリ
+            query (str|list): 検索クエリ（リストの場合は複数クエリを1回で実行）
+            max_results (int): クエリごとの最大件数
+            call_site (str): 呼び出し元（メトリクスの集計キー）
         
         Returns:
-            dict: 検索結果
+            dict: 検索結果（複数クエリの場合 results はクエリごとのリスト）
         """
+        import requests  # 起動時間短縮のため使用時に読み込む
         url = f"{self.base_url}/search"
         
         payload = {
             "query": query
         }
+        if max_results:
+            payload["max_results"] = max_results
         
-        try:
-            response = requests.post(url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.HTTPError as e:
-            print(f"検索HTTPエラー: {e}")
-            print(f"レスポンス内容: {response.text}")
-            return None
-        except requests.exceptions.RequestException as e:
-            print(f"検索エラー: {e}")
-            return None
+        with span('llm.search', queries=len(query) if isinstance(query, list) else 1) as s:
+            started = time.perf_counter()
+            try:
+                # 取り消された場合は応答を待たずに止める
+                deadline = current_deadline()
+                response = deadline.call(self.session.post, url, headers=self.headers, json=payload,
+                                         timeout=deadline.timeout(llm_timeout(), '検索'))
+                s.set_attribute('http_status', response.status_code)
+                LLM_LATENCY.observe(time.perf_counter() - started, endpoint='search', call_site=call_site)
+                response.raise_for_status()
+                LLM_REQUESTS.inc(endpoint='search', call_site=call_site, status='ok')
+                return response.json()
+            except requests.exceptions.HTTPError as e:
+                s.status = 'error'
+                LLM_REQUESTS.inc(endpoint='search', call_site=call_site, status=str(response.status_code))
+                print(f"検索HTTPエラー: {e}")
+                print(f"レスポンス内容: {response.text}")
+                return None
+            except (requests.exceptions.RequestException, DeadlineExceeded, JobCancelled) as e:
+                s.status = 'error'
+                LLM_REQUESTS.inc(endpoint='search', call_site=call_site, status='error')
+                print(f"検索エラー: {e}")
+                return None
     
     def list_models(self):
         """利用可能なモデル一覧を表示"""
         print("利用可能なモデル（公式ドキュメントに基づく）:")
         for key, value in self.available_models.items():
             print(f"  {key}: {value}")
+        routes = self.router.describe()
+        if routes:
+            print("呼び出し元ごとのルート（BLOG_TOOL_LLM_ROUTES）:")
+            for call_site, target in routes.items():
+                print(f"  {call_site}: {target}")
 
 def load_prompt_template(template_file):
     """
@@ -111,19 +270,60 @@ def load_prompt_template(template_file):
         template_file (str): テンプレートファイルのパス
     
     Returns:
-        str: 読み込まれたプロンプトテンプレート
+        CompiledTemplate: 解析済みのプロンプトテンプレート（ファイルが変わるまで使い回す）
     """
     try:
-        with open(template_file, 'r', encoding='utf-8') as f:
-            return f.read().strip()
+        return load_template(template_file)
     except FileNotFoundError:
         print(f"エラー: テンプレートファイル '{template_file}' が見つかりません。")
         sys.exit(1)
+    except TemplateError as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
     except Exception as e:
         print(f"エラー: テンプレートファイルの読み込みに失敗しました: {e}")
         sys.exit(1)
 
-def create_blog_article(theme, client, prompt_template_file="prompt_template.txt", max_tokens=4096):
+# 記事生成のメッセージ形式
+#   single: テンプレートに値を入れた全文を1つのユーザーメッセージで送る
+#   shared: テンプレートの固定部分をシステムメッセージ、テーマなどの値をユーザーメッセージに分ける
+PROMPT_FORMATS = ('single', 'shared')
+
+def default_prompt_format():
+    """BLOG_TOOL_PROMPT_FORMAT（未設定・不正な値の場合は single）"""
+    prompt_format = os.getenv('BLOG_TOOL_PROMPT_FORMAT', 'single')
+    if prompt_format not in PROMPT_FORMATS:
+        print(f"BLOG_TOOL_PROMPT_FORMAT の値が正しくありません: {prompt_format}（{' / '.join(PROMPT_FORMATS)}）")
+        return 'single'
+    return prompt_format
+
+def build_article_messages(template, theme, variables=None, prompt_format=None):
+    """
+    記事生成のメッセージを組み立てる
+    
+    Args:
+        template (CompiledTemplate): プロンプトテンプレート
+        theme (str): 記事のテーマ
+        variables (dict): テーマ以外のテンプレート変数
+        prompt_format (str): PROMPT_FORMATS のいずれか（None の場合は default_prompt_format()）
+    
+    Returns:
+        list: chat_completion に渡すメッセージ
+    """
+    values = dict(variables or {}, theme=theme)
+    if (prompt_format or default_prompt_format()) == 'shared':
+        system, user = template.split(**values)
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user}
+        ]
+    return [
+        {"role": "user", "content": template.render(**values)}
+    ]
+
+@traced('article.llm_generate')
+def create_blog_article(theme, client, prompt_template_file="prompt_template.txt", max_tokens=4096, variables=None,
+                        prompt_format=None):
     """
     ブログ記事を生成する
     
@@ -132,6 +332,8 @@ def create_blog_article(theme, client, prompt_template_file="prompt_template.txt
         client (PerplexityClient): Perplexity APIクライアント
         prompt_template_file (str): プロンプトテンプレートファイルのパス
         max_tokens (int): 最大トークン数（デフォルト: 4096）
+        variables (dict): テーマ以外のテンプレート変数（ranking_count・audience など、prompt_compiler.VARIABLES）
+        prompt_format (str): メッセージ形式（PROMPT_FORMATS、None の場合は BLOG_TOOL_PROMPT_FORMAT）
     
     Returns:
         str: 生成されたブログ記事
@@ -140,18 +342,15 @@ def create_blog_article(theme, client, prompt_template_file="prompt_template.txt
     # プロンプトテンプレートを読み込み
     prompt_template = load_prompt_template(prompt_template_file)
     
-    # テーマをテンプレートに挿入
-    prompt = prompt_template.format(theme=theme)
-    
-    messages = [
-        {"role": "user", "content": prompt}
-    ]
+    # テーマなどの変数をテンプレートに挿入
+    messages = build_article_messages(prompt_template, theme, variables, prompt_format)
     
     print(f"テーマ「{theme}」についてブログ記事を生成中...")
     print(f"使用テンプレート: {prompt_template_file}")
     print(f"最大トークン数: {max_tokens}")
     
-    response = client.chat_completion(messages, model="sonar", max_tokens=max_tokens)
+    response = client.chat_completion(messages, model="sonar", max_tokens=max_tokens,
+                                      call_site="article", template=prompt_template_file)
     
     if response:
         content = response.get('choices', [{}])[0].get('message', {}).get('content', '')
@@ -0,0 +1,159 @@
+import os
+import re
+import threading
+from datetime import datetime
+
+# テンプレートで使える変数と既定値（None は必須、関数は描画のたびに呼ぶ）
+VARIABLES = {
+    'theme': None,                          # 記事のテーマ
+    'ranking_count': '10',                  # ランキングの件数
+    'audience': '一般の読者',                 # 想定読者
+    'year': lambda: str(datetime.now().year),  # 記事の年（「【2025年最新】」など）
+}
+
+# 変数の表示名（split でシステムメッセージ・ユーザーメッセージに使う）
+LABELS = {
+    'theme': 'テーマ',
+    'ranking_count': 'ランキングの件数',
+    'audience': '想定読者',
+    'year': '記事の年',
+}
+
+# split のシステムメッセージの末尾に付ける説明
+SHARED_NOTE = '［］で示した項目の値は、ユーザーのメッセージで指定します。'
+
+# 使える変数の一覧（画面・エラーの表示用）
+PLACEHOLDERS = '・'.join('{' + var + '}' for var in VARIABLES)
+
+# {{ と }} は { と } の文字（str.format と同じ）。{変数名} 以外の {...} はそのまま残す
+_TOKEN = re.compile(r'\{\{|\}\}|\{([^{}\n]*)\}')
+_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+class TemplateError(ValueError):
+    """テンプレートの変数が正しくない（未定義の変数・描画時の値の不足）"""
+
+
+class CompiledTemplate:
+    """
+    解析済みのプロンプトテンプレート
+
+    文字列は (固定の文字列, 変数名) の並びとして1度だけ解析し、描画はそれを順につなぐだけにする
+    （テンプレートの長さに比例する時間で、描画ごとの解析はしない）。
+    """
+
+    def __init__(self, pairs, name='<template>'):
+        """
+        Args:
+            pairs (list): [(固定の文字列, 変数名 または None), ...]
+            name (str): エラー表示に使う名前（ファイル名など）
+        """
+        self.name = name
+        self._pairs = pairs
+        self.variables = tuple(dict.fromkeys(var for _, var in pairs if var))
+        # 最初の変数より前の固定部分（テーマによらず同じになる部分）
+        self.prefix = pairs[0][0] if pairs else ''
+        self.static_length = sum(len(text) for text, _ in pairs)
+        # 変数を［テーマ］などの見出しに置き換えたもの（値によらず同じ。split のシステムメッセージ）
+        self.shared_text = ''.join(text + (f"［{LABELS[var]}］" if var else '') for text, var in pairs)
+        if self.variables:
+            self.shared_text += f"\n\n{SHARED_NOTE}"
+
+    def _resolve(self, values):
+        """テンプレートが使う変数の値（文字列）。値がなく既定値もない場合は TemplateError"""
+        resolved = {}
+        for var in self.variables:
+            value = values.get(var)
+            if value is None or value == '':
+                default = VARIABLES[var]
+                if default is None:
+                    raise TemplateError(f"{self.name}: 変数 {{{var}}} の値がありません。")
+                value = default() if callable(default) else default
+            resolved[var] = str(value)
+        return resolved
+
+    def render(self, **values):
+        """
+        変数に値を入れた文字列を返す
+
+        テンプレートが使わない変数は無視する。使う変数の値がなく既定値もない場合は TemplateError。
+        """
+        resolved = self._resolve(values)
+        parts = []
+        for text, var in self._pairs:
+            parts.append(text)
+            if var:
+                parts.append(resolved[var])
+        return ''.join(parts)
+
+    def split(self, **values):
+        """
+        固定部分と値を分けた (システムメッセージ, ユーザーメッセージ) を返す
+
+        システムメッセージは shared_text で、同じテンプレートなら値によらず同じ文字列になる（バッチで
+        プロンプトの先頭部分を使い回せる形）。値はユーザーメッセージに「見出し: 値」の形で入れる。
+        """
+        resolved = self._resolve(values)
+        lines = [f"{LABELS[var]}: {resolved[var]}" for var in self.variables]
+        return self.shared_text, '\n'.join(['以下の値で作成してください。'] + lines)
+
+
+def compile_template(text, name='<template>'):
+    """
+    テンプレートを解析する（未定義の変数がある場合は行番号付きの TemplateError）
+
+    変数は VARIABLES の {変数名}。{{ と }} は { と } の文字になり、それ以外の波括弧（JSON の例など）は
+    そのまま残す。
+    """
+    pairs = []
+    literal = []
+    errors = []
+    position = 0
+    for match in _TOKEN.finditer(text):
+        literal.append(text[position:match.start()])
+        position = match.end()
+        token = match.group(0)
+        if token in ('{{', '}}'):
+            literal.append(token[0])
+            continue
+        var = match.group(1).strip()
+        if not _NAME.fullmatch(var):
+            literal.append(token)
+            continue
+        if var not in VARIABLES:
+            line = text.count('\n', 0, match.start()) + 1
+            errors.append(f"{line}行目の {token}")
+            literal.append(token)
+            continue
+        pairs.append((''.join(literal), var))
+        literal = []
+    literal.append(text[position:])
+    pairs.append((''.join(literal), None))
+    if errors:
+        raise TemplateError(f"{name}: 未定義の変数があります（{', '.join(errors)}）。"
+                            f"使える変数: {PLACEHOLDERS}")
+    return CompiledTemplate(pairs, name)
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def load_template(path):
+    """
+    テンプレートファイルを読み込んで解析する（前後の空白は除く）
+
+    解析結果はファイルの更新日時・サイズが変わるまで使い回す。
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    with open(path, 'r', encoding='utf-8') as f:
+        template = compile_template(f.read().strip(), os.path.basename(path))
+    with _cache_lock:
+        _cache[key] = (version, template)
+    return template
@@ -0,0 +1,272 @@
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from history_log import iter_history_data
+
+# 各エンドポイントの既定の応答遅延（秒）
+DEFAULT_LATENCY = {
+    'chat': 0.2,
+    'search': 0.05,
+    'site': 0.02,
+    'image': 0.005,
+    'wp': 0.05,
+}
+
+# 1x1 の JPEG（偽の公式サイトの画像として返す）
+_FAKE_JPEG = bytes.fromhex(
+    'ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f'
+    '141d1a1f1e1d1a1c1c20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100'
+    'ffc4001f0000010501010101010100000000000000000102030405060708090a0bffda0008010100003f00d2cf20ffd9'
+)
+
+
+def load_canned_articles():
+    """
+    記事の生成履歴（履歴ログと未取り込みの個別ファイル）の本文を、LLMの応答として返す定型文として読み込む
+
+    画像の挿入結果（<div class="anime-image">）は取り除き、画像検索が毎回走るようにする。
+    """
+    articles = []
+    for _, data in iter_history_data('article'):
+        content = (data.get('result') or {}).get('content') or ''
+        content = re.sub(r'<div class="anime-image">[\s\S]*?</div>\s*', '', content)
+        if re.search(r'第\d+位', content):
+            articles.append(content)
+    return articles
+
+
+def site_slug(title):
+    """作品名から偽の公式サイトのパスを決める（同じ作品名は常に同じサイト）"""
+    return hashlib.md5(title.strip().encode('utf-8')).hexdigest()[:10]
+
+
+class StandInServer:
+    """
+    Perplexity API・WordPress REST API・アニメ公式サイトを模したローカルHTTPサーバー
+
+    実際のAPIトークンを使わずに記事生成の一連の処理を計測するためのもの。
+    1つのポートでパスごとに役割を分ける。
+
+        /perplexity/chat/completions  チャット（記事本文・画像検索の各戦略）
+        /perplexity/search            Search API
+        /wp-json/wp/v2/posts          WordPress 投稿
+        /sites/<slug>/                og:image を持つ偽の公式サイト
+        /sites/<slug>/images/...      偽の画像
+
+    エンドポイントごとの受信件数は counts()、応答遅延は latency で変更できる。
+    """
+
+    def __init__(self, articles=None, latency=None, host='127.0.0.1', port=0):
+        self.articles = articles or ['<h2>ランキング紹介</h2>\n<h3>第1位: サンプル作品</h3>\n<p>本文</p>']
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._article_index = 0
+        self._post_id = 0
+        # 受け取ったシステムメッセージ（2回目以降は API 側で使い回したものとして cached_tokens を返す）
+        self._system_prompts = set()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def perplexity_base_url(self):
+        return f"{self.base_url}/perplexity"
+
+    @property
+    def wp_url(self):
+        return f"{self.base_url}/wp-json/wp/v2/posts"
+
+    def site_url(self, title):
+        return f"{self.base_url}/sites/{site_slug(title)}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def counts(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset_counts(self):
+        with self._lock:
+            self._counts.clear()
+
+    def _count(self, route):
+        with self._lock:
+            self._counts[route] += 1
+
+    def _next_article(self):
+        with self._lock:
+            article = self.articles[self._article_index % len(self.articles)]
+            self._article_index += 1
+            return article
+
+    def _next_post_id(self):
+        with self._lock:
+            self._post_id += 1
+            return self._post_id
+
+    # --- 応答の組み立て ---
+
+    def _chat_response(self, payload):
+        """チャットのリクエスト内容から、どの呼び出し元かを判断して応答を作る"""
+        messages = payload.get('messages') or []
+        prompt = '\n'.join(str(m.get('content', '')) for m in messages)
+        citations = []
+
+        if payload.get('response_format'):
+            # 構造化モードの画像検索: 「1. 作品名」の一覧に JSON で答える
+            self._count('chat:structured')
+            titles = re.findall(r'^\d+\.\s*(.+)$', prompt, flags=re.MULTILINE)
+            content = json.dumps({'results': [
+                {'title': t.strip(), 'official_site': self.site_url(t), 'key_visual_urls': []} for t in titles
+            ]}, ensure_ascii=False)
+        elif payload.get('max_tokens', 0) <= 64:
+            # citations 戦略: 引用元に公式サイトを返す
+            self._count('chat:citations')
+            m = re.search(r'「(.+?)」', prompt)
+            title = m.group(1) if m else ''
+            citations = [self.site_url(title)]
+            content = self.site_url(title)
+        elif '公式サイトや公式画像のURL' in prompt:
+            # 従来の自由記述による画像検索
+            self._count('chat:image')
+            m = re.search(r'：(.+?) 公式サイト 画像 アニメ', prompt)
+            title = m.group(1) if m else ''
+            content = f"公式サイト: {self.site_url(title)}"
+        else:
+            self._count('chat:article')
+            content = self._next_article()
+
+        prompt_tokens = len(prompt) // 2
+        completion_tokens = len(content) // 2
+        system = ''.join(str(m.get('content', '')) for m in messages if m.get('role') == 'system')
+        with self._lock:
+            cached_tokens = len(system) // 2 if system in self._system_prompts else 0
+            self._system_prompts.add(system)
+        return {
+            'id': f"standin-{time.time_ns()}",
+            'model': payload.get('model', 'sonar'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'citations': citations,
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens,
+                      'prompt_tokens_details': {'cached_tokens': cached_tokens}}
+        }
+
+    def _search_response(self, payload):
+        self._count('search')
+        queries = payload.get('query')
+
+        def results_for(query):
+            title = re.sub(r'\s*アニメ\s*公式サイト\s*$', '', str(query))
+            return [{'title': f"{title} 公式サイト", 'url': self.site_url(title), 'snippet': ''}]
+
+        if isinstance(queries, list):
+            return {'results': [results_for(q) for q in queries]}
+        return {'results': results_for(queries)}
+
+    def _site_html(self, slug):
+        image = f"{self.base_url}/sites/{slug}/images/keyvisual_1920.jpg"
+        return (
+            '<!DOCTYPE html><html><head><meta charset="utf-8">'
+            f'<meta property="og:image" content="{image}">'
+            '<title>TVアニメ公式サイト</title></head><body>'
+            f'<img src="/sites/{slug}/images/logo.png"><img src="/sites/{slug}/images/banner_event.jpg">'
+            + '<p>ニュース</p>' * 200 +
+            '</body></html>'
+        )
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, content_type='application/json', head_only=False):
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body, ensure_ascii=False)
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if not head_only:
+                    try:
+                        self.wfile.write(body)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # 呼び出し側が先に終了した（負荷試験の停止時など）
+                        pass
+
+            def _read_json(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    return json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    return {}
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                payload = self._read_json()
+                if path == '/perplexity/chat/completions':
+                    time.sleep(server.latency['chat'])
+                    self._send(200, server._chat_response(payload))
+                elif path == '/perplexity/search':
+                    time.sleep(server.latency['search'])
+                    self._send(200, server._search_response(payload))
+                elif path == '/wp-json/wp/v2/posts':
+                    server._count('wp:post')
+                    time.sleep(server.latency['wp'])
+                    post_id = server._next_post_id()
+                    self._send(201, {'id': post_id, 'link': f"{server.base_url}/?p={post_id}",
+                                     'status': payload.get('status', 'draft')})
+                else:
+                    self._send(404, {'error': 'not found'})
+
+            def do_GET(self, head_only=False):
+                path = urlparse(self.path).path
+                m = re.match(r'^/sites/([0-9a-f]+)/(images/.+)?$', path)
+                if m and m.group(2):
+                    server._count('site:image_head' if head_only else 'site:image')
+                    time.sleep(server.latency['image'])
+                    self._send(200, _FAKE_JPEG, 'image/jpeg', head_only)
+                elif m:
+                    server._count('site:page')
+                    time.sleep(server.latency['site'])
+                    self._send(200, server._site_html(m.group(1)), 'text/html; charset=utf-8', head_only)
+                elif path.startswith('/wp-json/wp/v2'):
+                    server._count('wp:get')
+                    self._send(200, {'name': 'stand-in'}, head_only=head_only)
+                else:
+                    self._send(404, {'error': 'not found'}, head_only=head_only)
+
+            def do_HEAD(self):
+                self.do_GET(head_only=True)
+
+        return Handler
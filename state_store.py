@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class StateStore:
+    """
+    複数のワーカープロセスで共有する画面の状態（SQLite）
+
+    状態は名前ごとに1つの JSON オブジェクトとして保存し、更新はトランザクション内で
+    項目単位にマージする。接続はスレッドごとに作り、fork 後の子プロセスでは作り直す。
+    """
+
+    def __init__(self, path=None, defaults=None):
+        """
+        Args:
+            path (str): データベースファイル（None の場合は BLOG_TOOL_STATE_DB、未設定ならカレントの app_state.sqlite3）
+            defaults (dict): {状態名: 初期値の dict}
+        """
+        self.path = path or os.getenv('BLOG_TOOL_STATE_DB') or os.path.join(os.getcwd(), 'app_state.sqlite3')
+        self.defaults = {name: dict(values) for name, values in (defaults or {}).items()}
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            # WAL: 読み込みが書き込みを待たない
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                         'name TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        # 読み込み〜書き込みの間に他のプロセスが割り込まないよう、最初から書き込みロックを取る
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _read(self, conn, name):
+        state = dict(self.defaults.get(name, {}))
+        row = conn.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        if row:
+            state.update(json.loads(row[0]))
+        return state
+
+    def _write(self, conn, name, state):
+        conn.execute('INSERT OR REPLACE INTO state (name, value, updated_at) VALUES (?, ?, ?)',
+                     (name, json.dumps(state, ensure_ascii=False), time.time()))
+
+    def get(self, name):
+        """状態を取得（未保存の項目は初期値）"""
+        return self._read(self._connect(), name)
+
+    def update(self, name, **fields):
+        """指定した項目だけを更新し、更新後の状態を返す"""
+        with self._transaction() as conn:
+            state = self._read(conn, name)
+            state.update(fields)
+            self._write(conn, name, state)
+        return state
+
+    def reset(self, name, **fields):
+        """状態を初期値に戻し、fields を反映する"""
+        state = dict(self.defaults.get(name, {}), **fields)
+        with self._transaction() as conn:
+            self._write(conn, name, state)
+        return state
+
+    def prune(self, prefix, max_age):
+        """名前が prefix で始まり、max_age 秒以上更新されていない状態を削除"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM state WHERE substr(name, 1, ?) = ? AND updated_at < ?",
+                         (len(prefix), prefix, time.time() - max_age))
+
+    def try_begin(self, name, flag, **fields):
+        """
+        flag の項目が立っていなければ立てて、状態を初期値 + fields に置き換える
+
+        flag を立てたプロセスが終了している場合（ワーカーの強制終了など）は、立っていないものとみなす。
+
+        Returns:
+            dict|None: 開始できた場合は新しい状態、すでに実行中の場合は None
+        """
+        with self._transaction() as conn:
+            current = self._read(conn, name)
+            if current.get(flag) and _owner_alive(current.get('owner')):
+                return None
+            state = dict(self.defaults.get(name, {}), **fields)
+            state[flag] = True
+            state['owner'] = _owner()
+            self._write(conn, name, state)
+        return state
+
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_alive(owner):
+    """状態を立てたプロセスがまだ動いているか（別ホストの場合は確認できないため動いているとみなす）"""
+    if not owner:
+        return True
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    if os.name == 'nt':
+        # Windows の os.kill(pid, 0) は CTRL_C_EVENT の送信になるため確認しない
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
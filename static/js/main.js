@@ -330,6 +330,47 @@ function exportTableToCSV(tableId, filename = 'export.csv') {
     }
 }
 
+// 時間のかかる処理（LLMの呼び出し）をジョブとして登録し、完了まで待って結果を返す
+// 戻り値は従来のAPIと同じ形（成功時は success: true、失敗時は error）
+function postJob(url, payload, interval = 1000) {
+    return fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(payload)
+    })
+    .then(response => response.json())
+    .then(data => data.job_id ? waitForJob(data.job_id, interval) : data);
+}
+
+// ジョブの状態を interval ミリ秒ごとに確認し、完了したら結果を返す
+function waitForJob(jobId, interval = 1000) {
+    return new Promise((resolve, reject) => {
+        const poll = () => {
+            fetch(`/jobs/${encodeURIComponent(jobId)}`)
+                .then(response => response.json())
+                .then(job => {
+                    if (job.status === 'succeeded') {
+                        resolve(job.result);
+                    } else if (job.status === 'failed' || job.status === 'cancelled' || !job.status) {
+                        resolve({ error: job.error || '処理に失敗しました。' });
+                    } else {
+                        setTimeout(poll, interval);
+                    }
+                })
+                .catch(reject);
+        };
+        poll();
+    });
+}
+
+// ジョブを取り消す（実行中の場合は処理の区切りで止まる。waitForJob には cancelled として返る）
+function cancelJob(jobId) {
+    return fetch(`/jobs/${encodeURIComponent(jobId)}/cancel`, { method: 'POST' })
+        .then(response => response.json());
+}
+
 // ページ読み込み完了時の処理
 window.addEventListener('load', function() {
     // テーブルのソート機能を初期化
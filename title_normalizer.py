@@ -0,0 +1,262 @@
+import re
+import unicodedata
+
+# 括弧・引用符のペア（NFKC後の文字で定義）
+BRACKET_PAIRS = {
+    '(': ')',
+    '[': ']',
+    '{': '}',
+    '「': '」',
+    '『': '』',
+    '【': '】',
+    '〔': '〕',
+    '〈': '〉',
+    '《': '》',
+    '〘': '〙',
+    '〖': '〗',
+}
+
+QUOTE_CHARS = '"\'`“”‘’«»„‟〝〞〟'
+
+# 作品名の装飾として使われる記号（前後の「-」「～」など）
+DECORATION_CHARS = '-‐‑‒–—―~〜～・:;'
+
+KANJI_NUMERALS = {
+    '一': 1, '二': 2, '三': 3, '四': 4, '五': 5,
+    '六': 6, '七': 7, '八': 8, '九': 9, '十': 10,
+}
+
+# 期・シーズン表記（NFKC・casefold後の文字列に対して適用）
+SEASON_PATTERNS = [
+    re.compile(r'第\s*([0-9一二三四五六七八九十]+)\s*(?:期|シーズン|クール|部)'),
+    re.compile(r'(?:season|シーズン)\s*([0-9]+)'),
+    re.compile(r'([0-9]+)(?:st|nd|rd|th)\s*season'),
+    re.compile(r'([0-9]+)期'),
+]
+
+SEASON_ONLY_PATTERN = re.compile(
+    r'^(?:第\s*[0-9一二三四五六七八九十]+\s*(?:期|シーズン|クール|部)|'
+    r'(?:season|シーズン)\s*[0-9]+|[0-9]+(?:st|nd|rd|th)\s*season|[0-9]+期)$'
+)
+
+
+def _to_int(value):
+    """算用数字・漢数字の期番号を整数に変換"""
+    if value.isdigit():
+        return int(value)
+    if value in KANJI_NUMERALS:
+        return KANJI_NUMERALS[value]
+    # 「十一」「二十」などの簡易変換
+    if '十' in value:
+        head, _, tail = value.partition('十')
+        tens = KANJI_NUMERALS.get(head, 1) if head else 1
+        ones = KANJI_NUMERALS.get(tail, 0) if tail else 0
+        return tens * 10 + ones
+    return None
+
+
+def _fold(text):
+    """NFKC正規化・小文字化・空白の畳み込み"""
+    text = unicodedata.normalize('NFKC', text or '')
+    text = text.casefold()
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip()
+
+
+def _split_brackets(text):
+    """括弧で囲まれた部分を取り出し、(本体, [括弧内の文字列...]) を返す"""
+    body = []
+    inner_parts = []
+    stack = []
+    current_inner = []
+    for ch in text:
+        if ch in BRACKET_PAIRS:
+            stack.append(BRACKET_PAIRS[ch])
+            if len(stack) == 1:
+                current_inner = []
+                body.append(' ')
+                continue
+        elif stack and ch == stack[-1]:
+            stack.pop()
+            if not stack:
+                inner_parts.append(''.join(current_inner))
+                body.append(' ')
+                continue
+        if stack:
+            current_inner.append(ch)
+        else:
+            body.append(ch)
+    if stack:
+        # 閉じられていない括弧は本体として扱う
+        body.append(''.join(current_inner))
+    return ''.join(body), inner_parts
+
+
+def _strip_decorations(text):
+    """引用符を除去し、前後の装飾記号と空白を取り除く"""
+    text = ''.join(' ' if ch in QUOTE_CHARS else ch for ch in text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip(' ' + DECORATION_CHARS)
+
+
+def extract_season(text):
+    """期・シーズン表記を取り出し、(表記を除いた文字列, 期番号 or None) を返す"""
+    for pattern in SEASON_PATTERNS:
+        m = pattern.search(text)
+        if m:
+            season = _to_int(m.group(1))
+            if season is None:
+                continue
+            stripped = (text[:m.start()] + ' ' + text[m.end():])
+            return _strip_decorations(re.sub(r'\s+', ' ', stripped)), season
+    return text, None
+
+
+def make_key(base, season=None):
+    """正規化済みの作品名と期番号からキャッシュキーを生成"""
+    if season and season > 1:
+        return f"{base} #s{season}"
+    return base
+
+
+def normalize_title(title):
+    """
+    作品名を正規化してキャッシュキーを生成
+
+    NFKC正規化・全角半角統一・小文字化・括弧/引用符の除去・空白の畳み込みを行い、
+    「第2期」「Season 2」などの期表記は末尾の「#s2」に統一する。
+    括弧内の別名（英題など）は除去される（別名は title_aliases で取得）。
+
+    Args:
+        title (str): 見出しから取得した作品名
+
+    Returns:
+        str: 正規化されたキー（作品名が空の場合は空文字列）
+    """
+    aliases = title_aliases(title)
+    return aliases[0] if aliases else ''
+
+
+def title_aliases(title):
+    """
+    作品名から照合用の別名キーを列挙
+
+    例: 「SPY×FAMILY（スパイファミリー）」→ ['spy×family', 'スパイファミリー']
+
+    Args:
+        title (str): 見出しから取得した作品名
+
+    Returns:
+        list: 正規化されたキーのリスト（先頭が代表キー。期表記だけの場合など、作品名が空なら空のリスト）
+    """
+    folded = _fold(title)
+    body, inner_parts = _split_brackets(folded)
+
+    body, season = extract_season(_strip_decorations(body))
+    alias_bases = []
+    for part in inner_parts:
+        part = _strip_decorations(part)
+        if not part:
+            continue
+        if SEASON_ONLY_PATTERN.match(part):
+            # 「（第2期）」のような括弧は期番号として扱う
+            _, part_season = extract_season(part)
+            season = season or part_season
+            continue
+        part, part_season = extract_season(part)
+        season = season or part_season
+        if part:
+            alias_bases.append(part)
+
+    if not body:
+        # 本体が空の場合（例: 「『鬼滅の刃』」）は括弧内を本体とする
+        body = alias_bases.pop(0) if alias_bases else ''
+    if not body:
+        # 「2期」のように期表記しかない場合は、照合に使える作品名がない
+        return []
+
+    keys = [make_key(body, season)]
+    for alias in alias_bases:
+        key = make_key(alias, season)
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def _ngrams(text, n=2):
+    """文字n-gramの集合を生成（空白は除外）"""
+    compact = text.replace(' ', '')
+    if len(compact) < n:
+        return {compact} if compact else set()
+    return {compact[i:i + n] for i in range(len(compact) - n + 1)}
+
+
+def _season_of(key):
+    m = re.search(r' #s(\d+)$', key)
+    return int(m.group(1)) if m else 1
+
+
+class TitleIndex:
+    """正規化キーの別名インデックス（n-gram類似度によるあいまい検索付き）"""
+
+    def __init__(self, threshold=0.8, ngram=2):
+        """
+        Args:
+            threshold (float): あいまい一致とみなすDice係数の下限
+            ngram (int): 類似度計算に用いる文字n-gramの長さ
+        """
+        self.threshold = threshold
+        self.ngram = ngram
+        self._alias_to_key = {}   # 正規化別名 -> 元のキャッシュキー
+        self._grams = {}          # 正規化別名 -> n-gram集合
+        self._inverted = {}       # n-gram -> 正規化別名の集合
+
+    def __len__(self):
+        return len(self._alias_to_key)
+
+    def add(self, title, cache_key=None):
+        """作品名（とその別名）をインデックスに登録"""
+        cache_key = cache_key if cache_key is not None else title
+        for alias in title_aliases(title):
+            if not alias or alias in self._alias_to_key:
+                continue
+            self._alias_to_key[alias] = cache_key
+            grams = _ngrams(alias, self.ngram)
+            self._grams[alias] = grams
+            for g in grams:
+                self._inverted.setdefault(g, set()).add(alias)
+
+    def lookup(self, title):
+        """
+        作品名に対応するキャッシュキーを検索
+
+        Returns:
+            tuple: (キャッシュキー or None, 一致種別 'normalized' / 'fuzzy' / None)
+        """
+        aliases = title_aliases(title)
+        for alias in aliases:
+            if alias in self._alias_to_key:
+                return self._alias_to_key[alias], 'normalized'
+
+        best_key = None
+        best_score = 0.0
+        for alias in aliases:
+            grams = _ngrams(alias, self.ngram)
+            if not grams:
+                continue
+            season = _season_of(alias)
+            # 共通n-gramを持つ候補のみを対象にする
+            counts = {}
+            for g in grams:
+                for candidate in self._inverted.get(g, ()):
+                    counts[candidate] = counts.get(candidate, 0) + 1
+            for candidate, common in counts.items():
+                if _season_of(candidate) != season:
+                    continue
+                score = 2.0 * common / (len(grams) + len(self._grams[candidate]))
+                if score > best_score:
+                    best_score = score
+                    best_key = self._alias_to_key[candidate]
+        if best_key is not None and best_score >= self.threshold:
+            return best_key, 'fuzzy'
+        return None, None
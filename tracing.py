@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import functools
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# 実行中のトレースとスパン
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+# 直近のトレースを保持する件数
+MAX_RECENT_TRACES = 20
+
+_recent_traces = OrderedDict()
+_recent_lock = threading.Lock()
+
+
+class Span:
+    """処理区間（開始・終了時刻、属性、親スパン）"""
+
+    __slots__ = ('name', 'span_id', 'parent_id', 'start', 'end', 'attributes', 'thread_id', 'status')
+
+    def __init__(self, name, parent_id=None, attributes=None):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.thread_id = threading.get_ident()
+        self.status = 'ok'
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+
+class _NoopSpan:
+    """トレース外で呼ばれた場合のダミースパン"""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """1ジョブ分のスパンの集合"""
+
+    def __init__(self, name, attributes=None):
+        self.trace_id = os.urandom(8).hex()
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.created_at = time.time()
+        # スパンの開始時刻はこの時点からの相対値で出力する
+        self._origin = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def _offset_ms(self, t):
+        return (t - self._origin) * 1000
+
+    def to_dict(self):
+        """スパンの一覧をJSON化可能な辞書として返す"""
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'attributes': self.attributes,
+            'created_at': self.created_at,
+            'spans': [
+                {
+                    'name': s.name,
+                    'span_id': s.span_id,
+                    'parent_id': s.parent_id,
+                    'start_ms': round(self._offset_ms(s.start), 3),
+                    'duration_ms': round(s.duration_ms, 3),
+                    'status': s.status,
+                    'thread_id': s.thread_id,
+                    'attributes': s.attributes
+                }
+                for s in spans
+            ]
+        }
+
+    def to_chrome_trace(self):
+        """Chrome Trace Event Format（chrome://tracing / Perfetto で表示可能）に変換"""
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = []
+        for s in spans:
+            args = dict(s.attributes, span_id=s.span_id, parent_id=s.parent_id, status=s.status)
+            events.append({
+                'name': s.name,
+                'cat': s.name.split('.', 1)[0],
+                'ph': 'X',
+                'ts': round(self._offset_ms(s.start) * 1000, 1),
+                'dur': round(s.duration_ms * 1000, 1),
+                'pid': pid,
+                'tid': s.thread_id,
+                'args': args
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'trace_id': self.trace_id, 'name': self.name}}
+
+    def summary(self):
+        """スパン名ごとの回数・合計時間（ミリ秒）を返す"""
+        with self._lock:
+            spans = list(self.spans)
+        totals = {}
+        for s in spans:
+            item = totals.setdefault(s.name, {'count': 0, 'total_ms': 0.0})
+            item['count'] += 1
+            item['total_ms'] += s.duration_ms
+        for item in totals.values():
+            item['total_ms'] = round(item['total_ms'], 1)
+        return dict(sorted(totals.items(), key=lambda kv: kv[1]['total_ms'], reverse=True))
+
+    def save(self, path, fmt='chrome'):
+        data = self.to_chrome_trace() if fmt == 'chrome' else self.to_dict()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    処理区間を計測する（トレース外では何もしない）
+
+    使用例:
+        with span('http.site_fetch', url=url) as s:
+            ...
+            s.set_attribute('bytes', len(html))
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NOOP_SPAN
+        return
+
+    parent = _current_span.get()
+    s = Span(name, parent.span_id if parent else None, attributes)
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.status = 'error'
+        s.set_attribute('error', str(e))
+        raise
+    finally:
+        s.end = time.perf_counter()
+        _current_span.reset(token)
+        trace.add(s)
+
+
+def traced(name):
+    """関数全体を1つのスパンとして計測するデコレータ"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def start_trace(name, **attributes):
+    """
+    ジョブ単位のトレースを開始する
+
+    すでにトレース中の場合は新しいトレースを作らず、その中のスパンとして扱う。
+    終了したトレースは直近 MAX_RECENT_TRACES 件まで get_trace() で参照できる。
+    """
+    existing = _current_trace.get()
+    if existing is not None:
+        with span(name, **attributes):
+            yield existing
+        return
+
+    trace = Trace(name, attributes)
+    token = _current_trace.set(trace)
+    try:
+        with span(name, **attributes):
+            yield trace
+    finally:
+        _current_trace.reset(token)
+        _remember(trace)
+        trace_file = os.getenv('BLOG_TOOL_TRACE_FILE')
+        if trace_file:
+            try:
+                trace.save(trace_file)
+                print(f"トレースを {trace_file} に保存しました。")
+            except Exception as e:
+                print(f"トレース保存エラー: {e}")
+
+
+def _remember(trace):
+    with _recent_lock:
+        _recent_traces[trace.trace_id] = trace
+        while len(_recent_traces) > MAX_RECENT_TRACES:
+            _recent_traces.popitem(last=False)
+
+
+def get_trace(trace_id):
+    with _recent_lock:
+        return _recent_traces.get(trace_id)
+
+
+def recent_traces():
+    """直近のトレースを新しい順に返す"""
+    with _recent_lock:
+        return list(reversed(_recent_traces.values()))
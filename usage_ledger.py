@@ -0,0 +1,265 @@
+import os
+import json
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+# 呼び出し元の種別
+CALL_SITES = {
+    'article': '記事生成',
+    'image_lookup': '画像検索',
+    'prompt_generation': 'プロンプト生成',
+    'evaluation': 'プロンプト評価',
+    'preview': 'プレビュー',
+    'connection_test': '接続テスト',
+    'other': 'その他',
+}
+
+# 終了したジョブの合計トークン数を保持する件数（超えた分は古い順に破棄）
+MAX_FINISHED_JOBS = 200
+
+# 実行中のジョブ（job_scope で設定）
+_current_job = contextvars.ContextVar('usage_current_job', default=None)
+
+
+class UsageLedger:
+    """
+    LLM呼び出しごとのトークン使用量を記録する台帳（JSON Lines形式で追記）
+
+    1行1呼び出しで、呼び出し元・テンプレート・ジョブ・モデル・トークン数・所要時間を残す。
+    日次のトークン上限（USAGE_DAILY_TOKEN_LIMIT）とジョブ単位の上限（job_scope）を
+    呼び出し前に確認できる。日次の合計は確認のたびにファイルの追記分を読むため、同じファイルに
+    書く他のプロセス（gunicorn の他のワーカー・worker_daemon・CLI）の呼び出しも数える。
+    """
+
+    def __init__(self, path=None, daily_limit=None):
+        self.path = path or os.getenv('USAGE_LEDGER_PATH') or os.path.join(os.getcwd(), 'usage_ledger.jsonl')
+        if daily_limit is None:
+            daily_limit = int(os.getenv('USAGE_DAILY_TOKEN_LIMIT', '0') or 0)
+        self.daily_limit = daily_limit
+        self._lock = threading.Lock()
+        self._daily_totals = {}
+        # 日別の合計に反映済みのファイルの位置（バイト）
+        self._offset = 0
+        self._job_totals = {}
+        self._finished_jobs = OrderedDict()
+
+    def _refresh_daily_totals(self):
+        """日別の合計トークン数に、前回読んだ位置以降の追記分（他のプロセスの記録を含む）を反映する"""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < self._offset:
+                    # ファイルが削除・切り詰められた場合は最初から数え直す
+                    self._daily_totals, self._offset = {}, 0
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            self._daily_totals, self._offset = {}, 0
+            return
+        # 書き込み途中の最後の行は次回に読む
+        data = data[:data.rfind(b'\n') + 1]
+        self._offset += len(data)
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            day = record.get('timestamp', '')[:10]
+            self._daily_totals[day] = self._daily_totals.get(day, 0) + record.get('total_tokens', 0)
+
+    def check_budget(self):
+        """
+        上限に達していないか確認する
+
+        Returns:
+            str|None: 上限に達している場合はその理由、問題なければ None
+        """
+        job = _current_job.get()
+        with self._lock:
+            if self.daily_limit:
+                self._refresh_daily_totals()
+                today = datetime.now().strftime('%Y-%m-%d')
+                used = self._daily_totals.get(today, 0)
+                if used >= self.daily_limit:
+                    return f"本日のトークン上限に達しました（{used}/{self.daily_limit}）"
+            if job and job.get('token_limit'):
+                used = self._job_totals.get(job['job_id'], 0)
+                if used >= job['token_limit']:
+                    return f"ジョブのトークン上限に達しました（{used}/{job['token_limit']}）"
+        return None
+
+    def record(self, call_site, model, usage, latency_ms, template=None, status='ok', backend=None, cost=None):
+        """
+        1回分の呼び出しを記録
+
+        Args:
+            call_site (str): 呼び出し元（CALL_SITES のキー）
+            model (str): 使用したモデル名
+            usage (dict): APIレスポンスの usage ブロック
+            latency_ms (float): 所要時間（ミリ秒）
+            template (str): 使用したテンプレートファイル
+            status (str): 'ok' / 'error' / 'cancelled'（ヘッジで結果を使わなかった呼び出し）
+            backend (str): 呼び出し先（llm_backends.BACKENDS のキー、None の場合は perplexity）
+            cost (float): 料金の概算（米ドル）
+        """
+        usage = usage or {}
+        job = _current_job.get()
+        prompt_tokens = int(usage.get('prompt_tokens') or 0)
+        completion_tokens = int(usage.get('completion_tokens') or 0)
+        total_tokens = int(usage.get('total_tokens') or (prompt_tokens + completion_tokens))
+        cached_tokens = cached_prompt_tokens(usage)
+        record = {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'call_site': call_site or 'other',
+            'template': template or (job.get('template') if job else None),
+            'job_id': job.get('job_id') if job else None,
+            'backend': backend or 'perplexity',
+            'model': model,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': total_tokens,
+            'cached_tokens': cached_tokens,
+            'cost_usd': round(cost or 0.0, 6),
+            'latency_ms': round(latency_ms, 1),
+            'status': status
+        }
+        with self._lock:
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            except Exception as e:
+                print(f"使用量台帳の書き込みエラー: {e}")
+            if record['job_id']:
+                self._job_totals[record['job_id']] = self._job_totals.get(record['job_id'], 0) + total_tokens
+        return record
+
+    def records(self):
+        """記録済みの呼び出しを古い順に返す"""
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        return records
+
+    def job_total(self, job_id):
+        with self._lock:
+            return self._job_totals.get(job_id, 0)
+
+    def finish_job(self, job_id):
+        """ジョブの終了を記録する（終了したジョブの合計は直近 MAX_FINISHED_JOBS 件だけ残す）"""
+        with self._lock:
+            self._finished_jobs[job_id] = True
+            self._finished_jobs.move_to_end(job_id)
+            while len(self._finished_jobs) > MAX_FINISHED_JOBS:
+                old_job_id, _ = self._finished_jobs.popitem(last=False)
+                self._job_totals.pop(old_job_id, None)
+
+    def summary(self, days=None):
+        """
+        日別・テンプレート別・呼び出し元別・モデル別・ルート別に集計
+
+        ルートは「呼び出し元 → 呼び出し先:モデル」（呼び出し先を記録する前の呼び出しは perplexity）。
+
+        Args:
+            days (int): 直近何日分を対象にするか（None の場合は全期間）
+
+        Returns:
+            dict: { 'totals', 'by_day', 'by_template', 'by_call_site', 'by_model', 'by_route' }
+        """
+        records = self.records()
+        if days:
+            cutoff = datetime.now().timestamp() - days * 86400
+            records = [r for r in records if _timestamp(r) >= cutoff]
+
+        def empty():
+            return {'calls': 0, 'errors': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                    'total_tokens': 0, 'cached_tokens': 0, 'cost_usd': 0.0, 'latency_ms': 0.0}
+
+        totals = empty()
+        groups = {'by_day': {}, 'by_template': {}, 'by_call_site': {}, 'by_model': {}, 'by_route': {}}
+        for r in records:
+            keys = {
+                'by_day': r.get('timestamp', '')[:10],
+                'by_template': r.get('template') or '（なし）',
+                'by_call_site': r.get('call_site') or 'other',
+                'by_model': r.get('model') or '不明',
+                'by_route': f"{r.get('call_site') or 'other'} → "
+                            f"{r.get('backend') or 'perplexity'}:{r.get('model') or '不明'}",
+            }
+            for bucket in [totals] + [groups[g].setdefault(k, empty()) for g, k in keys.items()]:
+                bucket['calls'] += 1
+                bucket['errors'] += 1 if r.get('status') not in ('ok', 'cancelled') else 0
+                bucket['prompt_tokens'] += r.get('prompt_tokens', 0)
+                bucket['completion_tokens'] += r.get('completion_tokens', 0)
+                bucket['total_tokens'] += r.get('total_tokens', 0)
+                bucket['cached_tokens'] += r.get('cached_tokens', 0)
+                bucket['cost_usd'] += r.get('cost_usd', 0.0)
+                bucket['latency_ms'] += r.get('latency_ms', 0.0)
+
+        for bucket in [totals] + [b for g in groups.values() for b in g.values()]:
+            bucket['avg_latency_ms'] = round(bucket['latency_ms'] / bucket['calls'], 1) if bucket['calls'] else 0.0
+            bucket['latency_ms'] = round(bucket['latency_ms'], 1)
+            bucket['cost_usd'] = round(bucket['cost_usd'], 6)
+
+        result = {'totals': totals, 'daily_limit': self.daily_limit}
+        for name, group in groups.items():
+            result[name] = dict(sorted(group.items(), key=lambda kv: kv[1]['total_tokens'], reverse=True))
+        result['by_day'] = dict(sorted(groups['by_day'].items(), reverse=True))
+        return result
+
+
+def cached_prompt_tokens(usage):
+    """usage ブロックのうち、API 側で使い回された入力トークン数（報告されない場合は 0）"""
+    details = (usage or {}).get('prompt_tokens_details') or {}
+    return int(details.get('cached_tokens') or (usage or {}).get('cached_tokens') or 0)
+
+
+def _timestamp(record):
+    try:
+        return datetime.fromisoformat(record.get('timestamp', '')).timestamp()
+    except ValueError:
+        return 0
+
+
+@contextmanager
+def job_scope(job_id, template=None, token_limit=None):
+    """
+    ジョブ単位で使用量を集計するためのスコープ
+
+    Args:
+        job_id (str): ジョブID
+        template (str): ジョブで使用するテンプレートファイル
+        token_limit (int): ジョブのトークン上限（None の場合は USAGE_JOB_TOKEN_LIMIT）
+    """
+    if token_limit is None:
+        token_limit = int(os.getenv('USAGE_JOB_TOKEN_LIMIT', '0') or 0)
+    token = _current_job.set({'job_id': job_id, 'template': template, 'token_limit': token_limit})
+    try:
+        yield
+    finally:
+        _current_job.reset(token)
+        get_ledger().finish_job(job_id)
+
+
+_default_ledger = None
+_default_lock = threading.Lock()
+
+
+def get_ledger():
+    """プロセス共通の使用量台帳を返す"""
+    global _default_ledger
+    with _default_lock:
+        if _default_ledger is None:
+            _default_ledger = UsageLedger()
+        return _default_ledger
@@ -0,0 +1,401 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import http.client
+from urllib.parse import urlparse, parse_qs
+
+# 既定の待ち受けアドレス（"ホスト:ポート" または "unix:/path/to/socket"）
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+
+
+def parse_address(address):
+    """
+    待ち受けアドレスを解釈
+
+    Returns:
+        tuple: ('unix', ソケットのパス) または ('tcp', (ホスト, ポート))
+    """
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+
+def default_address():
+    return os.getenv('BLOG_WORKER_ADDRESS', DEFAULT_ADDRESS)
+
+
+# --- サーバー（serve でのみ使用。クライアント側では重いモジュールを読み込まない） ---
+
+class WorkerDaemon:
+    """
+    IntegratedBlogTool を1つ保持し続け、ジョブを受け付けて実行する常駐プロセス
+
+    APIクライアント・HTTP接続プール・画像キャッシュをジョブ間で使い回すため、
+    CLIを毎回起動する場合の初期化・キャッシュ読み込みのコストがかからない。
+    """
+
+    def __init__(self, workers=2, max_pending=20):
+        from integrated_blog_tool import IntegratedBlogTool
+        from jobs import JobManager
+
+        self.tool = IntegratedBlogTool()
+        self.started_at = time.time()
+        self.manager = JobManager(max_workers=workers, max_pending=max_pending)
+        self.manager.register('article', self._run_article, template_param='template')
+        self.manager.register('article_content', self._run_article_content, template_param='template')
+        # 画像キャッシュの事前取得は件数しだいで長くなるため、ジョブの期限を設けない
+        self.manager.register('prefetch_images', self._run_prefetch_images, deadline_seconds=0)
+
+    def _run_article(self, params, job):
+        """記事を生成してWordPressに投稿"""
+        return self.tool.generate_and_post_article(
+            params['theme'],
+            params.get('status', 'draft'),
+            params.get('template', 'prompt_template.txt'),
+            int(params.get('max_tokens', 4096)),
+            params.get('variables')
+        )
+
+    def _run_article_content(self, params, job):
+        """記事本文のみ生成（投稿はしない）"""
+        return self.tool.generate_article_content(
+            params['theme'],
+            params.get('template', 'prompt_template.txt'),
+            int(params.get('max_tokens', 4096)),
+            params.get('variables')
+        )
+
+    def _run_prefetch_images(self, params, job):
+        """画像キャッシュの事前取得"""
+        from image_prefetch import prefetch_images
+
+        def on_progress(done, total, title, ok):
+            job.progress = {'done': done, 'total': total}
+
+        return prefetch_images(self.tool, params.get('titles') or [], workers=int(params.get('workers', 4)),
+                               progress=on_progress)
+
+    def health(self):
+        return {
+            'pid': os.getpid(),
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'kinds': self.manager.kinds,
+            'image_cache_entries': len(self.tool.image_cache),
+            **self.manager.stats()
+        }
+
+    def handle(self, method, path, body):
+        """
+        1件のリクエストを処理
+
+        Returns:
+            tuple: (HTTPステータス, レスポンスの辞書)
+        """
+        from jobs import JobQueueFull
+
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        parts = [p for p in url.path.split('/') if p]
+
+        if method == 'GET' and parts == ['health']:
+            return 200, self.health()
+        if method == 'GET' and parts == ['jobs']:
+            limit = int(query.get('limit', ['20'])[0])
+            return 200, {'jobs': [job.to_dict() for job in self.manager.jobs(limit)]}
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'jobs':
+            # wait=秒 を指定すると完了まで（最大その秒数）待ってから返す
+            wait = float(query.get('wait', ['0'])[0])
+            job = self.manager.wait(parts[1], timeout=wait) if wait > 0 else self.manager.get(parts[1])
+            if not job:
+                return 404, {'error': 'ジョブが見つかりません。'}
+            return 200, job.to_dict()
+        if method == 'POST' and len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel':
+            job = self.manager.cancel(parts[1])
+            if not job:
+                return 404, {'error': 'ジョブが見つかりません。'}
+            return 200, job.to_dict()
+        if method == 'POST' and parts == ['jobs']:
+            try:
+                job = self.manager.submit(body.get('kind'), body.get('params') or {})
+            except JobQueueFull as e:
+                return 429, {'error': str(e)}
+            except ValueError as e:
+                return 400, {'error': str(e)}
+            return 202, job.to_dict()
+        return 404, {'error': 'not found'}
+
+    def serve(self, address):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        import signal
+        import socketserver
+
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _dispatch(self, method):
+                body = {}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    try:
+                        body = json.loads(self.rfile.read(length))
+                    except ValueError:
+                        body = {}
+                try:
+                    status, payload = daemon.handle(method, self.path, body)
+                except Exception as e:
+                    status, payload = 500, {'error': str(e)}
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+        kind, target = parse_address(address)
+        if kind == 'unix':
+            if os.path.exists(target):
+                # 残っているソケットファイルは、応答が無い場合のみ削除する
+                try:
+                    WorkerClient(address, timeout=2).health()
+                except ConnectionError:
+                    os.remove(target)
+                else:
+                    raise RuntimeError(f"ワーカーはすでに起動しています: {address}")
+
+            class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+                daemon_threads = True
+
+            server = UnixHTTPServer(target, Handler)
+            # 同じユーザーのみ接続できるようにする
+            os.chmod(target, 0o600)
+        else:
+            server = ThreadingHTTPServer(target, Handler)
+            server.daemon_threads = True
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+
+        # kill（SIGTERM）でも Ctrl+C と同様に後片付けしてから終了する
+        signal.signal(signal.SIGTERM, stop)
+
+        print(f"ワーカーを起動しました: {address}（同時実行 {self.manager.max_workers}、待ち上限 {self.manager.max_pending}）")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("ワーカーを停止します...")
+        finally:
+            server.server_close()
+            self.manager.shutdown(wait=False)
+            if kind == 'unix' and os.path.exists(target):
+                os.remove(target)
+
+
+# --- クライアント ---
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self._socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+
+class WorkerClient:
+    """ワーカーデーモンに接続する軽量クライアント（標準ライブラリのみ使用）"""
+
+    def __init__(self, address=None, timeout=None):
+        self.address = address or default_address()
+        self.timeout = timeout
+
+    def _connection(self, timeout):
+        kind, target = parse_address(self.address)
+        if kind == 'unix':
+            return _UnixHTTPConnection(target, timeout=timeout)
+        return http.client.HTTPConnection(target[0], target[1], timeout=timeout)
+
+    def request(self, method, path, body=None, timeout=None):
+        """
+        Returns:
+            tuple: (HTTPステータス, レスポンスの辞書)
+
+        Raises:
+            ConnectionError: ワーカーに接続できない場合
+        """
+        conn = self._connection(timeout or self.timeout)
+        try:
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8') if body is not None else None
+            headers = {'Content-Type': 'application/json'} if data is not None else {}
+            conn.request(method, path, body=data, headers=headers)
+            response = conn.getresponse()
+            return response.status, json.loads(response.read() or b'{}')
+        except (OSError, http.client.HTTPException) as e:
+            raise ConnectionError(f"ワーカー（{self.address}）に接続できません: {e}") from e
+        finally:
+            conn.close()
+
+    def health(self):
+        return self.request('GET', '/health')[1]
+
+    def submit(self, kind, params):
+        return self.request('POST', '/jobs', {'kind': kind, 'params': params})
+
+    def get(self, job_id, wait=0):
+        return self.request('GET', f"/jobs/{job_id}?wait={wait}", timeout=wait + 10 if wait else None)[1]
+
+    def wait(self, job_id, timeout=None, poll=30):
+        """完了まで待つ（サーバー側で最大 poll 秒ずつ待機するため、頻繁な問い合わせはしない）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = poll if deadline is None else max(0.0, min(poll, deadline - time.monotonic()))
+            job = self.get(job_id, wait=wait)
+            # 見つからない（status が無い）場合もそのまま返す
+            if job.get('status', 'failed') in ('succeeded', 'failed', 'cancelled'):
+                return job
+            if deadline is not None and time.monotonic() >= deadline:
+                return job
+
+    def cancel(self, job_id):
+        return self.request('POST', f"/jobs/{job_id}/cancel", {})[1]
+
+    def jobs(self, limit=20):
+        return self.request('GET', f"/jobs?limit={limit}")[1].get('jobs', [])
+
+
+def _print_job(job):
+    print(f"ジョブ: {job['job_id']}  種類: {job['kind']}  状態: {job['status']}")
+    if job.get('run_seconds') is not None:
+        print(f"待ち時間: {job['queued_seconds']}秒  実行時間: {job['run_seconds']}秒  使用トークン: {job['tokens_used']}")
+    if job.get('error'):
+        print(f"エラー: {job['error']}")
+    result = job.get('result')
+    if isinstance(result, dict) and 'post_url' in result:
+        print(f"タイトル: {result['title']}")
+        print(f"投稿ID: {result['post_id']}")
+        print(f"投稿URL: {result['post_url']}")
+        print(f"ステータス: {result['status']}")
+    elif result is not None:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+def _submit_and_wait(client, kind, params, args):
+    status, job = client.submit(kind, params)
+    if status != 202:
+        print(f"ジョブを登録できませんでした: {job.get('error')}")
+        sys.exit(1)
+    print(f"ジョブを登録しました: {job['job_id']}")
+    if args.no_wait:
+        return
+    job = client.wait(job['job_id'], timeout=args.timeout)
+    _print_job(job)
+    if job.get('status') != 'succeeded':
+        sys.exit(1)
+
+
+def main():
+    """ワーカーデーモンの起動と、ジョブの登録・確認"""
+    parser = argparse.ArgumentParser(description='ブログツールのワーカーデーモン')
+    parser.add_argument('--address', default=default_address(),
+                        help=f"待ち受け/接続先（ホスト:ポート または unix:/path、既定: BLOG_WORKER_ADDRESS または {DEFAULT_ADDRESS}）")
+    subparsers = parser.add_subparsers(dest='command')
+
+    p_serve = subparsers.add_parser('serve', help='ワーカーを起動')
+    p_serve.add_argument('--workers', type=int, default=2, help='同時に実行するジョブ数')
+    p_serve.add_argument('--max-pending', type=int, default=20, help='実行待ちにできるジョブ数')
+
+    p_article = subparsers.add_parser('article', help='記事を生成して投稿するジョブを登録')
+    p_article.add_argument('theme', help='記事のテーマ')
+    p_article.add_argument('template', nargs='?', default='prompt_template.txt', help='プロンプトテンプレートファイル（ワーカーの作業ディレクトリからの相対パス）')
+    p_article.add_argument('status', nargs='?', default='draft', help='投稿ステータス（draft / publish）')
+    p_article.add_argument('max_tokens', nargs='?', type=int, default=4096, help='最大トークン数')
+    p_article.add_argument('--var', action='append', default=[], metavar='名前=値',
+                           help='テーマ以外のテンプレート変数（例: --var ranking_count=20、複数指定可）')
+    p_article.add_argument('--deadline', type=float,
+                           help='ジョブの期限（秒、既定: ワーカーの BLOG_TOOL_JOB_DEADLINE、0 は期限なし）')
+
+    p_prefetch = subparsers.add_parser('prefetch', help='画像キャッシュの事前取得ジョブを登録')
+    p_prefetch.add_argument('titles', nargs='+', help='作品名')
+
+    for p in (p_article, p_prefetch):
+        p.add_argument('--no-wait', action='store_true', help='登録だけして完了を待たない')
+        p.add_argument('--timeout', type=float, help='完了を待つ最大秒数')
+
+    p_status = subparsers.add_parser('status', help='ジョブの状態を表示')
+    p_status.add_argument('job_id')
+    p_status.add_argument('--wait', type=float, default=0, help='完了まで最大何秒待つか')
+
+    p_cancel = subparsers.add_parser('cancel', help='ジョブを取り消す（実行中の場合は処理の区切りで止まる）')
+    p_cancel.add_argument('job_id')
+
+    p_jobs = subparsers.add_parser('jobs', help='最近のジョブ一覧')
+    p_jobs.add_argument('--limit', type=int, default=20)
+
+    subparsers.add_parser('health', help='ワーカーの状態を表示')
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        try:
+            WorkerDaemon(workers=args.workers, max_pending=args.max_pending).serve(args.address)
+        except (RuntimeError, ValueError, OSError) as e:
+            print(f"ワーカーを起動できませんでした: {e}")
+            sys.exit(1)
+        return
+    if not args.command:
+        parser.print_help()
+        sys.exit(1)
+
+    client = WorkerClient(args.address)
+    try:
+        if args.command == 'article':
+            params = {
+                'theme': args.theme, 'template': args.template, 'status': args.status, 'max_tokens': args.max_tokens,
+                'variables': dict(item.split('=', 1) for item in args.var if '=' in item)
+            }
+            if args.deadline is not None:
+                params['deadline_seconds'] = args.deadline
+            _submit_and_wait(client, 'article', params, args)
+        elif args.command == 'prefetch':
+            _submit_and_wait(client, 'prefetch_images', {'titles': args.titles}, args)
+        elif args.command == 'status':
+            job = client.get(args.job_id, wait=args.wait)
+            if 'job_id' not in job:
+                print(job.get('error'))
+                sys.exit(1)
+            _print_job(job)
+        elif args.command == 'cancel':
+            job = client.cancel(args.job_id)
+            if 'job_id' not in job:
+                print(job.get('error'))
+                sys.exit(1)
+            _print_job(job)
+        elif args.command == 'jobs':
+            for job in client.jobs(args.limit):
+                created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['created_at']))
+                print(f"{created}  {job['job_id']:<40} {job['status']:<10} {job['kind']}")
+        elif args.command == 'health':
+            print(json.dumps(client.health(), ensure_ascii=False, indent=2))
+    except ConnectionError as e:
+        print(e)
+        print("`python worker_daemon.py serve` でワーカーを起動してください。")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
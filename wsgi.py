@@ -0,0 +1,28 @@
+import os
+import sys
+import argparse
+from app import create_app
+
+# WSGIサーバーから読み込むアプリケーション（gunicorn -c gunicorn.conf.py wsgi:app）
+app = create_app()
+
+
+def main():
+    """gunicorn を使えない環境（Windowsなど）向けに、1プロセス・マルチスレッドで起動"""
+    parser = argparse.ArgumentParser(description='ブログツールのWebアプリケーション（デバッグなし）')
+    parser.add_argument('--host', default=os.getenv('BLOG_TOOL_HOST', '127.0.0.1'), help='待ち受けるホスト')
+    parser.add_argument('--port', type=int, default=int(os.getenv('BLOG_TOOL_PORT', '8080')), help='待ち受けるポート')
+    args = parser.parse_args()
+
+    from werkzeug.serving import run_simple
+
+    print(f"http://{args.host}:{args.port} で起動します（Ctrl+C で終了）")
+    try:
+        run_simple(args.host, args.port, app, threaded=True, use_reloader=False, use_debugger=False)
+    except OSError as e:
+        print(f"起動エラー: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()